@@ -0,0 +1,72 @@
+import asyncio
+from types import SimpleNamespace
+
+from xud_docker_bot.build_queue import RemoteBuildScheduler, serve_builds, get_dockerhub_partition, BUILDS, \
+    BUILD_RESULTS
+from xud_docker_bot.config import TravisConfig
+from xud_docker_bot.durable_queue import DurableQueue
+from xud_docker_bot.scheduler import BuildScheduler
+
+
+class FakeTravisClient:
+    def __init__(self):
+        self.requests = []
+
+    def trigger_travis_build2(self, branch, commit_message, images, force=False, platforms=None):
+        self.requests.append((branch, images, platforms))
+        return 100 - len(self.requests), len(self.requests)
+
+    def supersede(self, branch, request_id):
+        return []
+
+
+def test_workers_share_the_gateway_scheduler(tmp_path):
+    path = str(tmp_path / "queue.db")
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        context = SimpleNamespace(
+            loop=loop,
+            config=SimpleNamespace(travis=TravisConfig(batch_window=0.2)),
+            github_client=SimpleNamespace(pulls={}),
+            travis_client=FakeTravisClient(),
+        )
+        scheduler = BuildScheduler(context)
+        workers = [
+            RemoteBuildScheduler(context, i, DurableQueue(BUILDS, path), DurableQueue(BUILD_RESULTS, path))
+            for i in range(2)
+        ]
+        tasks = [
+            asyncio.ensure_future(scheduler.run()),
+            asyncio.ensure_future(serve_builds(DurableQueue(BUILDS, path), DurableQueue(BUILD_RESULTS, path),
+                                               scheduler, 2, poll_interval=0.01)),
+        ] + [asyncio.ensure_future(w.run(poll_interval=0.01)) for w in workers]
+        try:
+            f1 = workers[0].submit("feat/a", ["xud:latest", "lndbtc:latest"], "a", platforms=["linux/amd64"])
+            f2 = workers[1].submit("feat/a", ["arby:latest"], "b", platforms=["linux/amd64"])
+            assert await workers[0].withdraw(f1, ["lndbtc:latest"]) == ["lndbtc:latest"]
+            assert await asyncio.wait_for(f1, 5) == await asyncio.wait_for(f2, 5) == (99, 1)
+            # One batched request for the submissions of both workers
+            assert context.travis_client.requests == [("feat/a", ["xud:latest", "arby:latest"], ["linux/amd64"])]
+
+            # The worker receiving the Docker Hub pushes of a tag learns its platforms
+            owner = workers[get_dockerhub_partition("xud", "latest__feat-a", 2)]
+            for _ in range(100):
+                if owner.get_platforms("xud", "latest__feat-a"):
+                    break
+                await asyncio.sleep(0.01)
+            assert owner.get_platforms("xud", "latest__feat-a") == ["linux/amd64"]
+
+            # Submissions are acknowledged once answered
+            builds = DurableQueue(BUILDS, path)
+            for _ in range(100):
+                if len(builds) == 0:
+                    break
+                await asyncio.sleep(0.01)
+            assert len(builds) == 0
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(run())
@@ -0,0 +1,29 @@
+import multiprocessing
+
+from xud_docker_bot.config import Config
+
+
+def get_worker_config(config, results):
+    results.put((config.travis.api_token, config.discord.token, config.dockerhub.mirror_url,
+                 config.xud_docker.repo_url))
+
+
+def test_spawned_workers_get_the_config():
+    config = Config()
+    config.travis.api_token = "travis-token"
+    config.discord.token = "discord-token"
+    config.dockerhub.mirror_url = "http://localhost:5000"
+    config.xud_docker.repo_url = "/tmp/xud-docker"
+
+    # Workers are spawned like in Server._start_worker
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=get_worker_config, args=(config, results))
+    process.start()
+    try:
+        assert results.get(timeout=30) == (
+            "travis-token", "discord-token", "http://localhost:5000", "/tmp/xud-docker")
+    finally:
+        process.join(timeout=10)
+    # Defaults are not shared between instances
+    assert Config().travis.api_token is None
@@ -0,0 +1,77 @@
+import os
+import subprocess
+
+from xud_docker_bot.dependency_index import DependencyIndex, TEMPLATE_PY
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "test", "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "test", "GIT_COMMITTER_EMAIL": "test@example.com",
+}
+
+
+def git(cwd, *args):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, env={**os.environ, **GIT_ENV})
+
+
+def commit(repo, files):
+    for path, content in files.items():
+        full_path = os.path.join(repo, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w") as f:
+            f.write(content)
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", "update")
+
+
+def template(*images):
+    return "".join('    image = "exchangeunion/%s"\n' % image for image in images)
+
+
+def make_origin(tmp_path):
+    """An xud-docker like repository: xud and arby follow upstream branches, boltz is pinned on master"""
+    origin = str(tmp_path / "origin")
+    git(tmp_path, "init", "-q", "-b", "master", origin)
+    commit(origin, {
+        "images/xud/Dockerfile": "FROM alpine\nARG BRANCH=master\n",
+        "images/arby/Dockerfile": "FROM alpine\nARG BRANCH='v1'\n",
+        "images/boltz/Dockerfile": "FROM alpine\n",
+        "images/utils/Dockerfile": "FROM alpine\n",
+        TEMPLATE_PY: template("xud:latest", "arby:latest", "boltz:1.2.0"),
+    })
+    git(origin, "checkout", "-q", "-b", "feat-xud")
+    commit(origin, {"images/xud/Dockerfile": "FROM alpine\nARG BRANCH=feat\n"})
+    git(origin, "checkout", "-q", "-b", "boltz-latest", "master")
+    commit(origin, {TEMPLATE_PY: template("xud:latest", "arby:latest", "boltz:latest")})
+    git(origin, "checkout", "-q", "-b", "merged", "master")
+    commit(origin, {"images/xud/README.md": "merged\n"})
+    git(origin, "checkout", "-q", "master")
+    git(origin, "merge", "-q", "--no-edit", "merged")
+    return origin
+
+
+def test_index_open_branches(tmp_path):
+    origin = make_origin(tmp_path)
+    clone = str(tmp_path / "clone")
+    git(tmp_path, "clone", "-q", origin, clone)
+    index = DependencyIndex(clone)
+    index.update()
+
+    assert set(index.list_open_branches()) == {"master", "feat-xud", "boltz-latest"}
+    assert index.lookup("xud", "master") == ["master", "boltz-latest"]
+    assert index.lookup("xud", "feat") == ["feat-xud"]
+    assert index.lookup("arby", "v1") == ["master", "boltz-latest", "feat-xud"]
+    # Pinned to a release on every branch but the one which switched to latest, without ARG BRANCH
+    assert index.lookup("boltz", "master") == ["boltz-latest"]
+
+    # feat-xud is deleted, boltz-latest is merged and master moves on
+    git(origin, "branch", "-q", "-D", "feat-xud")
+    git(origin, "merge", "-q", "--no-edit", "boltz-latest")
+    commit(origin, {"images/arby/Dockerfile": "FROM alpine\nARG BRANCH=v2\n"})
+    git(clone, "fetch", "-q", "--prune")
+    index.update()
+
+    assert set(index.list_open_branches()) == {"master"}
+    assert index.lookup("xud", "feat") == []
+    assert index.lookup("arby", "v1") == []
+    assert index.lookup("arby", "v2") == ["master"]
+    assert index.lookup("boltz", "master") == ["master"]
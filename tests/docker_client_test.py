@@ -0,0 +1,121 @@
+import requests
+
+from xud_docker_bot.clients import DockerhubClient
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, payload=None, headers=None):
+        self.status_code = status_code
+        self._payload = payload
+        self.headers = headers or {}
+
+    def json(self):
+        return self._payload
+
+
+def make_registry(monkeypatch, tags):
+    """Fake just enough of registry-1.docker.io to resolve single-arch images."""
+    calls = []
+
+    def head(url, **kwargs):
+        calls.append(("HEAD", url))
+        tag = url.rsplit("/", 1)[1]
+        if tag not in tags:
+            return FakeResponse(404)
+        return FakeResponse(headers={"Docker-Content-Digest": tags[tag]})
+
+    def get(url, **kwargs):
+        calls.append(("GET", url))
+        if "/token" in url:
+            return FakeResponse(payload={"token": "t", "expires_in": 300})
+        ref = url.rsplit("/", 1)[1]
+        if "/manifests/" in url:
+            return FakeResponse(payload={
+                "schemaVersion": 2,
+                "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+                "config": {"digest": "config-" + ref},
+            }, headers={"Docker-Content-Digest": ref})
+        return FakeResponse(payload={"config": {"Labels": {
+            "com.exchangeunion.image.revision": "rev-" + ref,
+        }}})
+
+    def request(session, method, url, **kwargs):
+        return {"HEAD": head, "GET": get}[method](url, **kwargs)
+
+    monkeypatch.setattr("requests.Session.request", request)
+    return calls
+
+
+def test_get_image_skips_unchanged_digest(monkeypatch):
+    tags = {"latest": "sha256:aaa"}
+    calls = make_registry(monkeypatch, tags)
+    client = DockerhubClient()
+
+    image = client.get_image("exchangeunion/xud", "latest")
+    assert image.revision == "rev-config-sha256:aaa"
+
+    calls.clear()
+    assert client.get_image("exchangeunion/xud", "latest") == image
+    assert calls == [("HEAD", "https://registry-1.docker.io/v2/exchangeunion/xud/manifests/latest")]
+
+    tags["latest"] = "sha256:bbb"
+    image = client.get_image("exchangeunion/xud", "latest")
+    assert image.revision == "rev-config-sha256:bbb"
+
+
+def test_get_image_not_found(monkeypatch):
+    make_registry(monkeypatch, {})
+    client = DockerhubClient()
+    assert client.get_image("exchangeunion/xud", "latest__foo") is None
+
+
+def test_rate_limit_headers_and_throttling(monkeypatch):
+    calls = make_registry(monkeypatch, {"latest": "sha256:aaa"})
+    client = DockerhubClient()
+    bucket = client.rate_limit
+
+    def request(session, method, url, **kwargs):
+        calls.append((method, url))
+        if "/token" in url:
+            return FakeResponse(payload={"token": "t", "expires_in": 300})
+        return FakeResponse(429, headers={
+            "RateLimit-Limit": "100;w=21600",
+            "RateLimit-Remaining": "0;w=21600",
+            "Retry-After": "3600",
+        })
+
+    monkeypatch.setattr("requests.Session.request", request)
+    try:
+        client.get_manifest("exchangeunion/xud", "latest")
+    except Exception:
+        pass
+    else:
+        assert False, "429 should raise"
+    # Not retried, and the bucket is empty now
+    assert [c for c in calls if "/manifests/" in c[1]] == [
+        ("GET", "https://registry-1.docker.io/v2/exchangeunion/xud/manifests/latest")]
+    assert bucket.limit == 100 and bucket.window == 21600
+    assert bucket.remaining < 1
+
+
+def test_reads_from_mirror_and_falls_back_to_registry(monkeypatch):
+    calls = make_registry(monkeypatch, {"latest": "sha256:aaa"})
+    registry_request = requests.Session.request
+    mirror_up = [True]
+
+    def request(session, method, url, **kwargs):
+        if url.startswith("http://mirror:5000") and not mirror_up[0]:
+            raise requests.ConnectionError("mirror down")
+        # The fake registry serves the mirror URLs as well
+        return registry_request(session, method, url, **kwargs)
+
+    monkeypatch.setattr("requests.Session.request", request)
+    client = DockerhubClient(mirror_url="http://mirror:5000")
+    assert client.get_image("exchangeunion/xud", "latest").revision == "rev-config-sha256:aaa"
+    # Neither tokens nor the registry are needed while the mirror answers
+    assert calls and all(url.startswith("http://mirror:5000/v2/") for _, url in calls)
+
+    mirror_up[0] = False
+    calls.clear()
+    assert client.get_manifest_digest("exchangeunion/xud", "latest") == "sha256:aaa"
+    assert calls[-1] == ("HEAD", "https://registry-1.docker.io/v2/exchangeunion/xud/manifests/latest")
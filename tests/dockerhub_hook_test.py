@@ -0,0 +1,55 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from xud_docker_bot.config import DockerhubConfig, TravisConfig
+from xud_docker_bot.scheduler import BuildScheduler
+from xud_docker_bot.webhooks import DockerhubHook
+
+
+class FakeTravisClient:
+    def trigger_travis_build2(self, branch, commit_message, images, force=False, platforms=None):
+        return 99, 1
+
+    def supersede(self, branch, request_id):
+        return []
+
+
+def make_push(tag):
+    return json.dumps({"repository": {"name": "xud"}, "push_data": {"pusher": "xubot", "tag": tag}})
+
+
+def test_single_arch_build_is_published_without_waiting_for_other_arches():
+    async def run():
+        context = SimpleNamespace(
+            loop=asyncio.get_running_loop(),
+            config=SimpleNamespace(travis=TravisConfig(batch_window=0), dockerhub=DockerhubConfig()),
+            github_client=SimpleNamespace(pulls={}),
+            travis_client=FakeTravisClient(),
+        )
+        context.build_scheduler = scheduler = BuildScheduler(context)
+        task = asyncio.ensure_future(scheduler.run())
+        await scheduler.submit("foo", ["xud:latest"], "xud", platforms=["linux/arm64"])
+        await scheduler.submit("bar", ["xud"], "xud")
+        task.cancel()
+        assert scheduler.get_platforms("xud", "latest__foo") == ["linux/arm64"]
+        assert scheduler.get_platforms("xud", "latest__bar") is None
+
+        hook = DockerhubHook(context)
+        published = []
+
+        async def publish_push(key):
+            published.append(hook._pending.pop(key).arch_tags)
+
+        hook.publish_push = publish_push
+        await hook.process(make_push("latest__foo__aarch64"))
+        await hook.process(make_push("latest__bar__x86_64"))
+        await asyncio.sleep(0)
+        assert published == [["latest__foo__aarch64"]]
+        await hook.process(make_push("latest__bar__aarch64"))
+        await asyncio.sleep(0)
+        assert published[1] == ["latest__bar__x86_64", "latest__bar__aarch64"]
+        for push in hook._pending.values():
+            push.timer.cancel()
+
+    asyncio.run(run())
@@ -0,0 +1,22 @@
+from xud_docker_bot.durable_queue import DurableQueue
+
+
+def test_claim_ack_and_release(tmp_path):
+    path = str(tmp_path / "queue.db")
+    queue = DurableQueue("events", path)
+    queue.put({"n": 1})
+    queue.put({"n": 2})
+    queue.put({"n": 3}, partition=1)
+    assert DurableQueue("other", path).claim() is None
+
+    item_id, payload = queue.claim()
+    assert payload == {"n": 1}
+    assert queue.claim()[1] == {"n": 2}
+    assert queue.claim() is None
+    queue.ack(item_id)
+    assert len(queue) == 2
+
+    # Unacknowledged items are claimed again by the next consumer of the partition
+    queue.release()
+    assert DurableQueue("events", path).claim()[1] == {"n": 2}
+    assert queue.claim(partition=1)[1] == {"n": 3}
@@ -0,0 +1,71 @@
+import asyncio
+
+from xud_docker_bot.clients import GithubClient
+
+PAGE2 = "https://api.github.com/repositories/1/pulls?state=open&per_page=100&page=2"
+
+
+class FakeResponse:
+    def __init__(self, status, payload=None, headers=None, links=None):
+        self.status = status
+        self._payload = payload
+        self.headers = headers or {}
+        self.links = links or {}
+
+    async def json(self):
+        return self._payload
+
+    async def text(self):
+        return ""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    """Fake just enough of api.github.com to list two pages of open PRs. Pages are answered with 304 when the
+    If-None-Match header carries their ETag.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def get(self, url, headers):
+        self.requests.append((url, dict(headers)))
+        etag, payload, next_url = self.pages[url]
+        if headers.get("If-None-Match") == etag:
+            return FakeResponse(304)
+        links = {"next": {"url": next_url}} if next_url else {}
+        return FakeResponse(200, payload, {"ETag": etag}, links)
+
+
+def make_pr(branch, repo="ExchangeUnion/xud-docker"):
+    return {"head": {"ref": branch, "repo": {"full_name": repo} if repo else None}}
+
+
+def test_get_open_pulls_revalidates_cached_pages():
+    client = GithubClient()
+    page1 = f"{client.api_url}/repos/{client.repo}/pulls?state=open&per_page=100"
+    client._session = session = FakeSession({
+        page1: ('"e1"', [make_pr("foo"), make_pr("bar", "someone/xud-docker")], PAGE2),
+        PAGE2: ('"e2"', [make_pr("baz"), make_pr("gone", None)], None),
+    })
+
+    async def run():
+        return await client.get_open_pulls(), await client.get_open_pulls()
+
+    first, second = asyncio.run(run())
+    # PRs from forks (or deleted forks) are left out, the second listing is served from the cache
+    assert set(first) == {"foo", "baz"}
+    assert second == first
+    assert client.pulls == first
+    assert session.requests == [
+        (page1, {}),
+        (PAGE2, {}),
+        (page1, {"If-None-Match": '"e1"'}),
+        (PAGE2, {"If-None-Match": '"e2"'}),
+    ]
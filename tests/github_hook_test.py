@@ -0,0 +1,113 @@
+import asyncio
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from xud_docker_bot.clients import DockerImage
+from xud_docker_bot.webhooks import GithubHook
+
+REVISION = "0123456789abcdef0123456789abcdef01234567"
+
+
+def make_push(ref, repo="ExchangeUnion/xud-docker", **payload):
+    return json.dumps({"repository": {"full_name": repo}, "ref": ref, "after": REVISION, **payload})
+
+
+def make_hook():
+    return GithubHook(SimpleNamespace(xud_docker=None))
+
+
+def test_ignored_events_are_not_failures():
+    hook = make_hook()
+
+    async def fail(*args):
+        raise AssertionError("not ignored")
+
+    hook.handle_xud_docker_update = fail
+    for body in [
+        json.dumps({"zen": "Keep it logically awesome.", "hook_id": 1}),
+        make_push("refs/tags/v1.0"),
+        make_push("refs/heads/x;id"),
+        "not json",
+    ]:
+        asyncio.run(hook.process(body))
+
+
+def test_processing_errors_are_raised():
+    hook = make_hook()
+
+    async def fail(*args):
+        raise RuntimeError("boom")
+
+    hook.handle_xud_docker_update = fail
+    with pytest.raises(RuntimeError):
+        asyncio.run(hook.process(make_push("refs/heads/master")))
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.submissions = []
+
+    def submit(self, branch, images, message, platforms=None, priority=None, hold=False):
+        self.submissions.append((branch, images, hold))
+        future = asyncio.get_running_loop().create_future()
+        future.set_result((99, 1))
+        return future
+
+    async def release(self, future):
+        pass
+
+
+def test_fast_path_skips_removed_folders():
+    commits = [
+        {"added": ["images/foo/Dockerfile"], "modified": [], "removed": []},
+        {"added": [], "modified": ["images/xud/entrypoint.sh"], "removed": []},
+        {"added": [], "modified": [], "removed": ["images/foo/Dockerfile", "images/arby/Dockerfile"]},
+    ]
+    hook = make_hook()
+    assert hook._get_changed_paths({"commits": commits}) == ["images/xud/entrypoint.sh"]
+
+    async def run(commits):
+        hook.context = SimpleNamespace(
+            loop=asyncio.get_running_loop(),
+            discord_template=SimpleNamespace(publish_message=lambda msg: None),
+            build_scheduler=FakeScheduler(),
+        )
+        hook.queue = asyncio.Queue()
+
+        async def analyse():
+            # The full analysis finds nothing else to build
+            ref, revision, submitted, done = await hook.queue.get()
+            done.set_result([])
+
+        analysis = asyncio.ensure_future(analyse())
+        paths = hook._get_changed_paths({"commits": commits})
+        await hook.handle_xud_docker_update("refs/heads/master", REVISION, "msg", paths)
+        await analysis
+        return hook.context.build_scheduler.submissions
+
+    # A push which only removes an image folder submits nothing before the analysis
+    assert asyncio.run(run([{"added": [], "modified": [], "removed": ["images/foo/Dockerfile"]}])) == []
+    assert asyncio.run(run(commits)) == [("master", ["xud:latest"], True)]
+
+
+def test_unpublished_platforms():
+    # Image labels keep the short upstream revision, webhooks the full one
+    published = {
+        "latest": {"linux/amd64": REVISION[:7], "linux/arm64": REVISION},
+        "latest__partly": {"linux/amd64": REVISION[:7], "linux/arm64": "fedcba9"},
+        "latest__unlabeled": {"linux/amd64": None, "linux/arm64": ""},
+    }
+
+    def get_images(repo, tag):
+        assert repo == "exchangeunion/xud"
+        return [DockerImage("sha256:" + p, "r", rev, datetime.now(), platform=p) for p, rev in published[tag].items()]
+
+    hook = make_hook()
+    hook.context = SimpleNamespace(dockerhub_client=SimpleNamespace(get_images=get_images))
+    assert hook._get_unpublished_platforms("xud", "master", REVISION) == []
+    assert hook._get_unpublished_platforms("xud", "partly", REVISION) == ["linux/arm64"]
+    assert hook._get_unpublished_platforms("xud", "unlabeled", REVISION) == ["linux/amd64", "linux/arm64"]
+    assert hook._get_unpublished_platforms("xud", "master", None) == ["linux/amd64", "linux/arm64"]
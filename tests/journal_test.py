@@ -0,0 +1,36 @@
+import asyncio
+
+from xud_docker_bot.journal import EventJournal, MAX_ATTEMPTS
+
+
+def test_replay_unfinished_events(tmp_path):
+    path = str(tmp_path / "journal.log")
+
+    async def run():
+        journal = EventJournal(path)
+        assert journal.open() == []
+        done = await journal.accept("github", "a")
+        failed = await journal.accept("github", "b")
+        await journal.accept("dockerhub", "c")
+        await journal.mark_done(done)
+        await journal.mark_failed(failed, "error")
+        journal.close()
+
+    asyncio.run(run())
+
+    journal = EventJournal(path)
+    entries = journal.open()
+    journal.close()
+    assert [(e.hook, e.body, e.attempts) for e in entries] == [("github", "b", 1), ("dockerhub", "c", 0)]
+
+    async def fail(entry):
+        journal = EventJournal(path)
+        journal.open()
+        for _ in range(MAX_ATTEMPTS):
+            await journal.mark_failed(entry, "error")
+        # New events never reuse the ids of compacted ones
+        assert (await journal.accept("travis", "d")).event_id == 4
+        journal.close()
+
+    asyncio.run(fail(entries[0]))
+    assert [e.body for e in EventJournal(path).open()] == ["c", "d"]
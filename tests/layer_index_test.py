@@ -0,0 +1,25 @@
+from xud_docker_bot.discord.abc import split_message
+from xud_docker_bot.layer_index import LayerIndex, RepoLayers
+
+
+def test_per_arch_tags_count_with_their_multi_arch_tag():
+    index = LayerIndex(None)
+    index._repos["exchangeunion/xud"] = layers = RepoLayers()
+    layers.put("latest__foo", "d1", {"l1": 10, "l2": 20, "base": 100})
+    layers.put("latest__foo__x86_64", "d2", {"l1": 10, "base": 100})
+    layers.put("latest__foo__aarch64", "d3", {"l2": 20, "base": 100})
+    layers.put("latest", "d4", {"base": 100})
+
+    usage = {u.name: u for u in index.get_tag_usage("exchangeunion/xud")}
+    assert set(usage) == {"latest__foo", "latest"}
+    assert usage["latest__foo"].tags == ["latest__foo", "latest__foo__aarch64", "latest__foo__x86_64"]
+    assert (usage["latest__foo"].unique, usage["latest__foo"].shared) == (30, 100)
+
+
+def test_split_message():
+    msg = "\n".join(["a" * 1500, "b" * 400, "c" * 200, "d" * 3000])
+    chunks = split_message(msg)
+    assert all(len(c) <= 2000 for c in chunks)
+    assert chunks[0] == "a" * 1500 + "\n" + "b" * 400
+    assert chunks[1] == "c" * 200
+    assert chunks[2] == "d" * 1999 + "…"
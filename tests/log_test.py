@@ -0,0 +1,38 @@
+import json
+import logging
+import threading
+
+from xud_docker_bot.log import Lazy, log_context, in_log_context, setup_logging
+
+
+def test_records_carry_correlation_ids(tmp_path):
+    path = tmp_path / "bot.log"
+    setup_logging(str(path))
+    logger = logging.getLogger("xud_docker_bot.test")
+    try:
+        with log_context(event=7):
+            with log_context(ref="refs/heads/master"):
+                logger.debug("Template\n%s", Lazy("\n".join, ["a", "b"]))
+                # Other arguments are formatted right away, later changes don't show up
+                images = ["xud"]
+                logger.debug("Images %s", images)
+                images.append("arby")
+                # Executor threads don't inherit the context unless the call is bound to it
+                t = threading.Thread(target=in_log_context(logger.info, "In %s", "thread"))
+                t.start()
+                t.join()
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("Failed")
+    finally:
+        # Stopping the listener writes the queued records
+        setup_logging()
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+
+    assert records[0]["message"] == "Template\na\nb"
+    assert records[0]["event"] == 7 and records[0]["ref"] == "refs/heads/master"
+    assert records[1]["message"] == "Images ['xud']"
+    assert records[2]["message"] == "In thread" and records[2]["event"] == 7
+    assert records[3]["message"] == "Failed" and "ValueError: boom" in records[3]["exception"]
+    assert "event" not in records[3]
@@ -0,0 +1,52 @@
+import json
+from types import SimpleNamespace
+
+from xud_docker_bot import plan
+from xud_docker_bot.config import Config
+from xud_docker_bot.xud_docker import Retag
+
+
+class FakeXudDockerRepo:
+    """Analyses refs without a repository or registry: master builds xud and retags arby, broken fails"""
+
+    def __init__(self, repo_dir, dockerhub_client, repo_url):
+        self.dependency_index = SimpleNamespace(list_open_branches=lambda: {"master": "r1", "broken": "r2"})
+
+    def ensure_repo(self):
+        pass
+
+    def get_modified_images(self, ref, fetch=True):
+        assert not fetch
+        if ref == "refs/heads/broken":
+            raise RuntimeError("Failed to parse images/xud/Dockerfile")
+        if ref == "refs/heads/empty":
+            raise KeyError()
+        git_ref = SimpleNamespace(revision="r1", commit_message="Bump xud")
+        return git_ref, ["xud:latest"], [Retag("arby", "latest__foo", "sha256:a", "latest", "t1")]
+
+
+def test_plan_reports_errors_per_ref(monkeypatch, capsys):
+    monkeypatch.setattr(plan, "XudDockerRepo", FakeXudDockerRepo)
+    plan.run(Config(), ["master", "refs/heads/broken", "empty"], jobs=2)
+    output = json.loads(capsys.readouterr().out)
+
+    master, broken, empty = output["refs"]
+    assert master["ref"] == "refs/heads/master"
+    assert (master["revision"], master["commit_message"], master["images"]) == ("r1", "Bump xud", ["xud:latest"])
+    assert master["retags"] == [
+        {"image": "arby", "source_tag": "latest__foo", "digest": "sha256:a", "tag": "latest", "tree": "t1"}]
+    assert master["error"] is None
+    # A failed ref does not fail the others
+    assert broken["ref"] == "refs/heads/broken"
+    assert broken["error"] == "Failed to parse images/xud/Dockerfile"
+    assert (broken["revision"], broken["images"]) == (None, [])
+    assert empty["error"] == "KeyError()"
+    assert output["seconds"] >= 0
+
+
+def test_plan_all_branches(monkeypatch, capsys):
+    monkeypatch.setattr(plan, "XudDockerRepo", FakeXudDockerRepo)
+    plan.run(Config(), [], all_branches=True)
+    output = json.loads(capsys.readouterr().out)
+    assert [(p["ref"], p["error"] is None) for p in output["refs"]] == [
+        ("refs/heads/master", True), ("refs/heads/broken", False)]
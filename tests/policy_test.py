@@ -0,0 +1,39 @@
+import pytest
+import requests
+
+from xud_docker_bot.clients.policy import CircuitBreaker, CircuitOpenError, HttpClient, CallPolicy
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # reset_timeout elapsed, one trial call is let through
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_unexpected_error_ends_half_open_trial(monkeypatch):
+    client = HttpClient("test-trial", CallPolicy(retries=0))
+    client.breaker = CircuitBreaker("test-trial", failure_threshold=1, reset_timeout=0)
+    client.breaker.record_failure()
+
+    def request(session, method, url, **kwargs):
+        raise requests.TooManyRedirects()
+
+    monkeypatch.setattr("requests.Session.request", request)
+    with pytest.raises(requests.TooManyRedirects):
+        client.get("http://example.com")
+    # Open again instead of half-open for good, so the next trial call is let through
+    assert client.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(requests.TooManyRedirects):
+        client.get("http://example.com")
@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+from xud_docker_bot.config import TravisConfig
+from xud_docker_bot.scheduler import BuildScheduler, PRIORITY_MANUAL
+
+
+class FakeTravisClient:
+    def __init__(self, remaining_requests):
+        self.remaining_requests = remaining_requests
+        self.requests = []
+
+    def trigger_travis_build2(self, branch, commit_message, images, force=False, platforms=None):
+        self.requests.append((branch, images))
+        self.remaining_requests -= 1
+        return self.remaining_requests, len(self.requests)
+
+    def supersede(self, branch, request_id):
+        return []
+
+
+def make_scheduler(remaining_requests):
+    loop = asyncio.get_running_loop()
+    context = SimpleNamespace(
+        loop=loop,
+        config=SimpleNamespace(travis=TravisConfig(batch_window=0, quota_reserve=4)),
+        github_client=SimpleNamespace(pulls={"feat/pr": {}}),
+        travis_client=FakeTravisClient(remaining_requests),
+    )
+    return BuildScheduler(context), context.travis_client
+
+
+def test_merge_requests_of_same_branch():
+    async def run():
+        scheduler, client = make_scheduler(100)
+        f1 = scheduler.submit("master", ["xud:latest"], "xud")
+        f2 = scheduler.submit("master", ["arby:latest", "xud:latest"], "arby")
+        task = asyncio.ensure_future(scheduler.run())
+        assert await f1 == await f2 == (99, 1)
+        task.cancel()
+        assert client.requests == [("master", ["xud:latest", "arby:latest"])]
+
+    asyncio.run(run())
+
+
+def test_defer_low_priority_requests_when_quota_is_low():
+    async def run():
+        scheduler, client = make_scheduler(5)
+        scheduler.submit("master", ["xud:latest"], "xud")
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0.01)
+        manual = scheduler.submit("foo", ["utils:latest"], "manual", priority=PRIORITY_MANUAL)
+        pr = scheduler.submit("feat/pr", ["xud:latest"], "xud")
+        master = scheduler.submit("master", ["boltz:latest"], "boltz")
+        await master
+        await pr
+        await asyncio.sleep(0.01)
+        assert not manual.done()
+        assert [r.branch for r in scheduler.get_queue()] == ["foo"]
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def test_withdraw_keeps_images_of_other_submissions():
+    async def run():
+        scheduler, client = make_scheduler(100)
+        fast = scheduler.submit("master", ["xud:latest", "utils:latest"], "fast path")
+        upstream = scheduler.submit("master", ["xud:latest"], "upstream")
+        assert await scheduler.withdraw(fast, ["xud:latest", "utils:latest"]) == ["utils:latest"]
+        assert fast.cancelled()
+        task = asyncio.ensure_future(scheduler.run())
+        assert await upstream == (99, 1)
+        task.cancel()
+        assert client.requests == [("master", ["xud:latest"])]
+        assert await scheduler.withdraw(upstream, ["xud:latest"]) == []
+
+    asyncio.run(run())
+
+
+def test_held_submissions_wait_for_release():
+    async def run():
+        scheduler, client = make_scheduler(100)
+        fast = scheduler.submit("master", ["xud:latest"], "fast path", hold=True)
+        other = scheduler.submit("master", ["arby:latest"], "arby")
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0.05)
+        assert client.requests == [] and not other.done()
+        await scheduler.release(fast)
+        assert await fast == await other == (99, 1)
+        task.cancel()
+        assert client.requests == [("master", ["xud:latest", "arby:latest"])]
+
+    asyncio.run(run())
+
+
+def test_manual_builds_merged_into_pending_requests_are_not_batched():
+    async def run():
+        scheduler, client = make_scheduler(100)
+        scheduler.window = 60
+        scheduler.submit("foo", ["xud:latest"], "xud")
+        manual = scheduler.submit("foo", ["utils:latest"], "manual", priority=PRIORITY_MANUAL)
+        task = asyncio.ensure_future(scheduler.run())
+        assert await asyncio.wait_for(manual, 1) == (99, 1)
+        task.cancel()
+        assert client.requests == [("foo", ["xud:latest", "utils:latest"])]
+
+    asyncio.run(run())
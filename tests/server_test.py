@@ -0,0 +1,50 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from xud_docker_bot.durable_queue import DurableQueue
+from xud_docker_bot.server import Server
+
+
+class SlowHook:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.processed = []
+
+    async def process(self, body):
+        self.processed.append(("start", body))
+        await asyncio.sleep(self.seconds)
+        self.processed.append(("end", body))
+
+
+def make_worker(hook):
+    server = Server.__new__(Server)
+    server.context = SimpleNamespace(loop=asyncio.get_running_loop())
+    server._logger = logging.getLogger("xud_docker_bot.Server")
+    server.worker_index = 0
+    server.hooks = {"github": hook}
+    server._in_flight = set()
+    server._last_of_key = {}
+    return server
+
+
+def test_events_outliving_the_visibility_timeout_are_processed_once(tmp_path):
+    async def run():
+        queue = DurableQueue("events", str(tmp_path / "queue.db"), visibility_timeout=0.3)
+        hook = SlowHook(1)
+        server = make_worker(hook)
+        queue.put({"hook": "github", "body": "a1", "key": "github:a"})
+        queue.put({"hook": "github", "body": "a2", "key": "github:a"})
+        queue.put({"hook": "github", "body": "b1", "key": "github:b"})
+        consumer = asyncio.ensure_future(server._consume_events(queue, poll_interval=0.01))
+        await asyncio.sleep(2.5)
+        consumer.cancel()
+        await asyncio.gather(consumer, *server._in_flight, return_exceptions=True)
+        return hook.processed, len(queue)
+
+    processed, remaining = asyncio.run(run())
+    # Every event once, events of the same key in order and other keys alongside them
+    assert sorted(processed) == sorted([(op, b) for b in ["a1", "a2", "b1"] for op in ["start", "end"]])
+    assert processed.index(("end", "a1")) < processed.index(("start", "a2"))
+    assert processed.index(("start", "b1")) < processed.index(("end", "a1"))
+    assert remaining == 0
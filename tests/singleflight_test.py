@@ -0,0 +1,28 @@
+import threading
+import time
+
+from xud_docker_bot.clients.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_result():
+    flight = SingleFlight()
+    calls = []
+
+    def lookup():
+        calls.append(1)
+        time.sleep(0.1)
+        return "sha256:aaa"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("xud:latest", lookup))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == ["sha256:aaa"] * 5
+    assert len(calls) == 1
+
+    # Finished calls are not cached
+    flight.do("xud:latest", lookup)
+    assert len(calls) == 2
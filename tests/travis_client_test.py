@@ -1,4 +1,8 @@
+import asyncio
+from types import SimpleNamespace
+
 from xud_docker_bot.clients import TravisClient
+from xud_docker_bot.clients.travis import extract_failure, TrackedRequest
 
 
 def test1():
@@ -8,4 +12,95 @@ def test1():
 
 
 def test2():
-    print("world")
\ No newline at end of file
+    print("world")
+
+
+def test_extract_failure():
+    lines = ["Step %d/100 : RUN make" % i for i in range(1000)]
+    lines += [
+        "\x1b[31merror: failed to compile xud\x1b[0m",
+        "Downloading 10%\rDownloading 100%\r",
+        'The command "tools/push xud:latest" exited with 1.',
+        "Done. Your build exited with 1.",
+    ]
+    excerpt = extract_failure(iter(lines), max_tail=3)
+    assert excerpt.startswith('The command "tools/push xud:latest" exited with 1.')
+    assert "error: failed to compile xud" in excerpt
+    assert "Downloading 10%" not in excerpt
+    assert "Downloading 100%" in excerpt
+    assert "Step 900/100" not in excerpt
+
+
+def test_build_waiters_share_the_tracker(monkeypatch):
+    client = TravisClient(api_token="t")
+    polls = []
+
+    def get_request(request_id):
+        polls.append(request_id)
+        return {"state": "finished", "builds": [{"id": 42}]}
+
+    monkeypatch.setattr(client, "get_request", get_request)
+    monkeypatch.setattr(client, "get_build", lambda build_id: {"jobs": []})
+
+    async def main():
+        tracked = TrackedRequest(1, "master", {"xud:latest"}, {"amd64"})
+        client._tracked["master"] = [tracked]
+        tracker = asyncio.ensure_future(client.tracking_jobs(tracked))
+        waiters = [asyncio.ensure_future(client.wait_for_builds(1, timeout=5)) for _ in range(3)]
+        await asyncio.sleep(0)
+        # A Travis notification of the branch wakes the tracker up before its next poll
+        client.nudge("master")
+        results = await asyncio.gather(*waiters)
+        await tracker
+        # Commands waiting after the tracker has finished get the builds right away
+        results.append(await client.wait_for_builds(1, timeout=0.1))
+        return results
+
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(asyncio.wait_for(main(), 2)) == [[42]] * 4
+    loop.close()
+    assert polls == [1]
+
+
+def test_supersede_cancels_covered_requests(monkeypatch):
+    client = TravisClient(api_token="t")
+    posts = []
+
+    def post(url, **kwargs):
+        posts.append(url)
+        # Build 12 finished in the meantime
+        status = 409 if url.endswith("/build/12/cancel") else 202
+        return SimpleNamespace(status_code=status, text="")
+
+    monkeypatch.setattr(client._http, "post", post)
+    monkeypatch.setattr(client, "get_request", lambda request_id: {"state": "finished", "builds": [{"id": 21}]})
+    monkeypatch.setattr(client, "get_build", lambda build_id: {"jobs": []})
+    canceled = []
+    client.on_superseded = lambda branch, build_ids: canceled.append((branch, build_ids))
+
+    older = TrackedRequest(1, "master", {"xud:latest"}, {"amd64"}, builds=[11, 12])
+    pending = TrackedRequest(2, "master", {"arby:latest"}, {"amd64"})
+    other = TrackedRequest(3, "master", {"utils:latest"}, {"amd64"}, builds=[31])
+    arm64 = TrackedRequest(4, "master", {"xud:latest"}, {"arm64"}, builds=[41])
+    newer = TrackedRequest(5, "master", {"xud:latest", "arby:latest"}, {"amd64"})
+    client._tracked["master"] = [older, pending, other, arm64, newer]
+
+    # Only requests whose images and arches the newer request covers
+    assert client.supersede("master", 5) == [older]
+    assert pending.superseded and not other.superseded and not arm64.superseded
+    assert client.supersede("master", 5) == []
+
+    # A failed cancel is not reported as canceled
+    client.cancel_superseded("master", older.builds)
+    assert canceled == [("master", [11])]
+
+    # Builds of the pending request are canceled as soon as they show up
+    async def main():
+        tracker = asyncio.ensure_future(client.tracking_jobs(pending))
+        await asyncio.sleep(0)
+        client.nudge("master")
+        await tracker
+
+    asyncio.run(asyncio.wait_for(main(), 2))
+    assert canceled == [("master", [11]), ("master", [21])]
+    assert [url.split("/build/")[1] for url in posts] == ["11/cancel", "12/cancel", "21/cancel"]
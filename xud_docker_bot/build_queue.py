@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from .durable_queue import DurableQueue, get_partition
+from .scheduler import BuildRequest, get_priority, consume_exception, MAX_DISPATCHED_TAGS
+
+if TYPE_CHECKING:
+    from .context import Context
+    from .scheduler import BuildScheduler
+
+# Submissions and withdrawals of worker processes, handled by the gateway process
+BUILDS = "builds"
+
+# Outcomes of submissions and withdrawals, and dispatched tags, partitioned by worker
+BUILD_RESULTS = "build-results"
+
+
+class RemoteBuildScheduler:
+    """Stand-in for BuildScheduler in worker processes.
+
+    Submissions and withdrawals are put into the build queue and handled by the scheduler of the gateway process, so
+    that the requests of a branch are batched, the Travis quota is tracked and older builds are superseded across all
+    workers. The gateway sends the outcome of every submission back, the futures behave like the ones of
+    BuildScheduler.
+    """
+
+    remaining_requests = None
+
+    def __init__(self, context: Context, worker_index: int, queue: DurableQueue, results: DurableQueue):
+        self._logger = logging.getLogger("xud_docker_bot.RemoteBuildScheduler")
+        self.context = context
+        self.worker_index = worker_index
+        self.queue = queue
+        self.results = results
+        # submission id -> future returned by submit
+        self._submissions: Dict[str, asyncio.Future] = {}
+        # withdrawal id -> future resolved with the withdrawn images
+        self._withdrawals: Dict[str, asyncio.Future] = {}
+        # (repo, tag) -> platforms of dispatched builds whose pushes this worker receives
+        self._dispatched: "OrderedDict[Tuple[str, str], Optional[List[str]]]" = OrderedDict()
+        # One thread keeps the messages of a submission in order, e.g. a release after its submission
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="RemoteBuildScheduler")
+
+    def submit(
+            self,
+            branch: str,
+            images: List[str],
+            message: str,
+            platforms: List[str] = None,
+            priority: int = None,
+            hold: bool = False) -> asyncio.Future:
+        if priority is None:
+            # Open PRs are only known to the workers, they refresh them
+            priority = get_priority(branch, self.context.github_client.pulls)
+        submission_id = uuid.uuid4().hex
+        future = self.context.loop.create_future()
+        future.add_done_callback(consume_exception)
+        self._submissions[submission_id] = future
+        put = self._put({"op": "submit", "id": submission_id, "worker": self.worker_index, "branch": branch,
+                         "images": images, "message": message, "platforms": platforms, "priority": priority,
+                         "hold": hold})
+        put.add_done_callback(lambda p: self._on_submitted(submission_id, p))
+        return future
+
+    def _put(self, payload) -> asyncio.Future:
+        # The queue is SQLite, which can wait for the lock of another process
+        return self.context.loop.run_in_executor(self._executor, self.queue.put, payload)
+
+    def _on_submitted(self, submission_id: str, put: asyncio.Future) -> None:
+        if put.cancelled() or not put.exception():
+            return
+        future = self._submissions.pop(submission_id, None)
+        if future and not future.done():
+            future.set_exception(put.exception())
+
+    async def withdraw(self, future: asyncio.Future, images: List[str]) -> List[str]:
+        """Like BuildScheduler.withdraw, but answered by the gateway"""
+        submission_id = next((i for i, f in self._submissions.items() if f is future), None)
+        if not submission_id:
+            return []
+        withdrawal_id = uuid.uuid4().hex
+        reply = self.context.loop.create_future()
+        self._withdrawals[withdrawal_id] = reply
+        await self._put({"op": "withdraw", "id": withdrawal_id, "worker": self.worker_index,
+                        "submission": submission_id, "images": images})
+        try:
+            return await reply
+        finally:
+            self._withdrawals.pop(withdrawal_id, None)
+
+    async def release(self, future: asyncio.Future) -> None:
+        submission_id = next((i for i, f in self._submissions.items() if f is future), None)
+        if submission_id:
+            await self._put({"op": "release", "id": uuid.uuid4().hex, "submission": submission_id})
+
+    def get_platforms(self, repo: str, tag: str) -> Optional[List[str]]:
+        return self._dispatched.get((repo, tag))
+
+    def get_queue(self) -> List[BuildRequest]:
+        return []
+
+    def flush(self) -> None:
+        pass
+
+    def _handle_result(self, payload) -> None:
+        op = payload["op"]
+        if op == "dispatched":
+            key = (payload["repo"], payload["tag"])
+            self._dispatched.pop(key, None)
+            self._dispatched[key] = payload["platforms"]
+            while len(self._dispatched) > MAX_DISPATCHED_TAGS:
+                self._dispatched.popitem(last=False)
+        elif op == "withdrawn":
+            reply = self._withdrawals.get(payload["id"])
+            if reply and not reply.done():
+                reply.set_result(payload["images"])
+        else:
+            future = self._submissions.pop(payload["id"], None)
+            if not future or future.done():
+                return
+            if op == "result":
+                future.set_result(tuple(payload["result"]))
+            elif op == "error":
+                future.set_exception(RuntimeError(payload["error"]))
+            else:
+                future.cancel()
+
+    async def run(self, poll_interval: float = 0.5):
+        loop = self.context.loop
+        # Results claimed by a previous process of this worker belong to its submissions, they are dropped
+        await loop.run_in_executor(None, self.results.release, self.worker_index)
+        while True:
+            item = await loop.run_in_executor(None, self.results.claim, self.worker_index)
+            if not item:
+                await asyncio.sleep(poll_interval)
+                continue
+            item_id, payload = item
+            try:
+                self._handle_result(payload)
+            except Exception:
+                self._logger.exception("Failed to handle build result: %r", payload)
+            await loop.run_in_executor(None, self.results.ack, item_id)
+
+
+def get_dockerhub_partition(repo: str, tag: str, workers: int) -> int:
+    """Get the worker which receives the Docker Hub pushes of the tag, see Server._intake"""
+    return get_partition("dockerhub:{}:{}".format(repo, tag), workers)
+
+
+async def serve_builds(queue: DurableQueue, results: DurableQueue, scheduler: BuildScheduler, workers: int,
+                       poll_interval: float = 0.5):
+    """Handle the submissions and withdrawals of worker processes with the scheduler of the gateway.
+
+    Submissions are acknowledged once their outcome is put into the results queue. Submissions of a previous gateway
+    process which were never answered are submitted again on start.
+    """
+    logger = logging.getLogger("xud_docker_bot.build_queue")
+    loop = asyncio.get_running_loop()
+    # submission id -> future of the local submission
+    submissions: Dict[str, asyncio.Future] = {}
+
+    def answer(item_id, payload, worker) -> None:
+        results.put(payload, worker)
+        queue.ack(item_id)
+
+    def send_outcome(item_id, submission_id, worker, future: asyncio.Future):
+        submissions.pop(submission_id, None)
+        if future.cancelled():
+            payload = {"op": "cancelled", "id": submission_id}
+        elif future.exception():
+            payload = {"op": "error", "id": submission_id, "error": str(future.exception())}
+        else:
+            payload = {"op": "result", "id": submission_id, "result": list(future.result())}
+        loop.run_in_executor(None, answer, item_id, payload, worker)
+
+    def on_dispatched(repo, tag, platforms):
+        # The Docker Hub hook of that worker waits for the pushes of these platforms
+        loop.run_in_executor(None, results.put, {"op": "dispatched", "repo": repo, "tag": tag, "platforms": platforms},
+                             get_dockerhub_partition(repo, tag, workers))
+
+    scheduler.on_dispatched = on_dispatched
+    await loop.run_in_executor(None, queue.release, 0)
+
+    while True:
+        item = await loop.run_in_executor(None, queue.claim)
+        if not item:
+            await asyncio.sleep(poll_interval)
+            continue
+        item_id, payload = item
+        if payload["id"] in submissions:
+            # Still waiting to be dispatched after the visibility timeout
+            continue
+        try:
+            if payload["op"] == "submit":
+                future = scheduler.submit(payload["branch"], payload["images"], payload["message"],
+                                          platforms=payload["platforms"], priority=payload["priority"],
+                                          hold=payload.get("hold", False))
+                submissions[payload["id"]] = future
+                future.add_done_callback(
+                    lambda f, i=item_id, s=payload["id"], w=payload["worker"]: send_outcome(i, s, w, f))
+                continue
+            elif payload["op"] == "withdraw":
+                future = submissions.get(payload["submission"])
+                withdrawn = await scheduler.withdraw(future, payload["images"]) if future else []
+                await loop.run_in_executor(
+                    None, answer, item_id, {"op": "withdrawn", "id": payload["id"], "images": withdrawn},
+                    payload["worker"])
+                continue
+            elif payload["op"] == "release":
+                future = submissions.get(payload["submission"])
+                if future:
+                    await scheduler.release(future)
+        except Exception:
+            logger.exception("Failed to handle build queue item: %r", payload)
+        await loop.run_in_executor(None, queue.ack, item_id)
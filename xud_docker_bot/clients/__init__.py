@@ -1,2 +1,3 @@
-from .docker import DockerhubClient, DockerRegistryClient, DockerImage
+from .docker import DockerhubClient, DockerRegistryClient, DockerImage, Layer
 from .travis import TravisClient, TravisClientError
+from .github import GithubClient, GithubClientError
@@ -1,10 +1,22 @@
-from dataclasses import dataclass
-from typing import Dict, Optional, List
+from dataclasses import dataclass, field
+from typing import Dict, Optional, List, Tuple
 from collections import namedtuple
 from datetime import datetime
+import logging
+import time
 
 import requests
 
+from .policy import HttpClient, CallPolicy
+from .rate_limit import get_bucket, DEFAULT_RETRY_AFTER
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+DOCKERHUB_AUTH_URL = "https://auth.docker.io/token"
+DOCKERHUB_REGISTRY_URL = "https://registry-1.docker.io"
+DOCKERHUB_HUB_URL = "https://hub.docker.com/v2"
+
 
 @dataclass
 class Resource:
@@ -16,33 +28,130 @@ class DockerRegistryClientError(Exception):
     pass
 
 
-Tag = namedtuple("Tag", ["name", "size"])
+Tag = namedtuple("Tag", ["name", "size", "last_updated"], defaults=(None,))
+Layer = namedtuple("Layer", ["digest", "size"])
+
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.v1+json",
+]
 
 
 class DockerRegistryClient:
-    def __init__(self, token_url: str, registry_url: str):
+    """Registry v2 client.
+
+    With a mirror_url (a pull-through cache like registry:2 with proxy.remoteurl set to the registry), manifests and
+    blobs are read from the mirror and only read from the registry while the mirror is unavailable. Writes always go
+    to the registry. Without a token_url requests are sent unauthenticated, e.g. to a local registry:2.
+    """
+
+    def __init__(self, token_url: Optional[str], registry_url: str, username: str = None, password: str = None,
+                 mirror_url: str = None):
         self.token_url = token_url
         self.registry_url = registry_url
+        self.mirror_url = mirror_url
+        self.username = username
+        self.password = password
+        # (repo, actions) -> (token, expiry in time.monotonic() seconds)
+        self._tokens: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._auth_http = HttpClient("docker-auth", CallPolicy(read_timeout=10))
+        self._registry_http = HttpClient("docker-registry", CallPolicy(read_timeout=10, retry_throttled=False))
+        # The mirror is on the LAN, when it doesn't answer quickly the registry is asked instead
+        self._mirror_http = HttpClient("docker-mirror", CallPolicy(connect_timeout=0.5, read_timeout=5, retries=0))
+        # Manifest GETs count against the pull rate limit, HEAD requests don't
+        self.rate_limit = get_bucket("docker-registry")
+        # Concurrent identical lookups (e.g. per-arch webhooks of the same tag) share one request
+        self._flight = SingleFlight()
 
-    def get_token(self, repo):
+    @property
+    def can_push(self) -> bool:
+        return bool(self.username and self.password)
+
+    def get_token(self, repo, actions="pull"):
+        cached = self._tokens.get((repo, actions))
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return self._flight.do(("token", repo, actions), self._get_token, repo, actions)
+
+    def _get_token(self, repo, actions):
         try:
-            r = requests.get("{}?service=registry.docker.io&scope=repository:{}:pull".format(self.token_url, repo))
-            return r.json()["token"]
+            url = "{}?service=registry.docker.io&scope=repository:{}:{}".format(self.token_url, repo, actions)
+            if self.can_push:
+                # Authenticated pulls get a higher rate limit than anonymous ones
+                r = self._auth_http.get(url, auth=(self.username, self.password))
+            else:
+                r = self._auth_http.get(url)
+            j = r.json()
+            token = j["token"]
         except Exception as e:
             raise DockerRegistryClientError("Failed to get token for repository: {}".format(repo)) from e
+        # Keep a safety margin so that a token never expires in the middle of a request
+        expires_in = j.get("expires_in", 60)
+        self._tokens[(repo, actions)] = (token, time.monotonic() + max(expires_in - 10, 0))
+        return token
+
+    def _authorization(self, repo, actions="pull") -> Dict[str, str]:
+        if not self.token_url:
+            return {}
+        return {"Authorization": "Bearer " + self.get_token(repo, actions)}
+
+    def _registry_request(self, method: str, url: str, **kwargs) -> requests.Response:
+        if method == "GET" and "/manifests/" in url:
+            self.rate_limit.consume()
+        r = self._registry_http.request(method, url, **kwargs)
+        self.rate_limit.update(r.headers)
+        if r.status_code == requests.codes.too_many_requests:
+            retry_after = r.headers.get("Retry-After", "")
+            self.rate_limit.throttled(int(retry_after) if retry_after.isdigit() else DEFAULT_RETRY_AFTER)
+            raise DockerRegistryClientError("Docker Hub pull rate limit exceeded")
+        return r
+
+    def _read(self, method: str, repo: str, path: str, headers: Dict[str, str]) -> requests.Response:
+        """Send a read request to the mirror, or to the registry if there is no mirror or it failed"""
+        if self.mirror_url:
+            try:
+                r = self._mirror_http.request(method, f"{self.mirror_url}/v2/{repo}/{path}", headers=headers)
+                if r.status_code < 500:
+                    return r
+                logger.warning("Registry mirror responded %d to %s %s/%s", r.status_code, method, repo, path)
+            except Exception as e:
+                logger.warning("Registry mirror failed %s %s/%s: %r", method, repo, path, e)
+        headers = dict(headers, **self._authorization(repo))
+        return self._registry_request(method, f"{self.registry_url}/v2/{repo}/{path}", headers=headers)
+
+    def get_manifest_digest(self, repo: str, tag: str) -> Optional[str]:
+        """Resolve the manifest digest of a tag with a HEAD request.
+
+        This does not transfer the manifest body, and Docker Hub does not count
+        HEAD requests against the pull rate limit. Returns None if the tag does
+        not exist.
+        """
+        return self._flight.do(("digest", repo, tag), self._get_manifest_digest, repo, tag)
+
+    def _get_manifest_digest(self, repo: str, tag: str) -> Optional[str]:
+        try:
+            r = self._read("HEAD", repo, f"manifests/{tag}", {"Accept": ",".join(MANIFEST_MEDIA_TYPES)})
+            if r.status_code == requests.codes.ok:
+                digest = r.headers.get("Docker-Content-Digest")
+                if not digest:
+                    raise RuntimeError("Missing Docker-Content-Digest header")
+                return digest
+            elif r.status_code == requests.codes.not_found:
+                return None
+            else:
+                r.raise_for_status()
+        except Exception as e:
+            raise DockerRegistryClientError("Failed to get manifest digest: {}:{}".format(repo, tag)) from e
 
     def get_manifest(self, repo: str, tag: str) -> Optional[Resource]:
+        # Wait before joining the flight, so that urgent lookups of the same manifest don't wait for budget
+        self.rate_limit.wait()
+        return self._flight.do(("manifest", repo, tag), self._get_manifest, repo, tag)
+
+    def _get_manifest(self, repo: str, tag: str) -> Optional[Resource]:
         try:
-            url = f"{self.registry_url}/v2/{repo}/manifests/{tag}"
-            media_types = [
-                "application/vnd.docker.distribution.manifest.list.v2+json",
-                "application/vnd.docker.distribution.manifest.v2+json",
-                "application/vnd.docker.distribution.manifest.v1+json",
-            ]
-            r = requests.get(url, headers={
-                "Authorization": "Bearer " + self.get_token(repo),
-                "Accept": ",".join(media_types),
-            })
+            r = self._read("GET", repo, f"manifests/{tag}", {"Accept": ",".join(MANIFEST_MEDIA_TYPES)})
             if r.status_code == requests.codes.ok:
                 payload = r.json()
                 digest = r.headers.get("Docker-Content-Digest")
@@ -54,12 +163,30 @@ class DockerRegistryClient:
         except Exception as e:
             raise DockerRegistryClientError("Failed to get manifest: {}:{}".format(repo, tag)) from e
 
+    def copy_manifest(self, repo: str, reference: str, tag: str) -> str:
+        """Point the tag at the manifest of reference without pulling or pushing any layers.
+
+        The manifest is uploaded byte for byte, so the tag ends up with the same digest. Returns that digest.
+        """
+        self.rate_limit.wait()
+        try:
+            r = self._read("GET", repo, f"manifests/{reference}", {"Accept": ",".join(MANIFEST_MEDIA_TYPES)})
+            r.raise_for_status()
+            media_type = r.headers["Content-Type"]
+            url = f"{self.registry_url}/v2/{repo}/manifests/{tag}"
+            r = self._registry_request("PUT", url, data=r.content, headers=dict(
+                self._authorization(repo, "pull,push"), **{"Content-Type": media_type}))
+            r.raise_for_status()
+            return r.headers.get("Docker-Content-Digest")
+        except Exception as e:
+            raise DockerRegistryClientError("Failed to copy manifest {}@{} to tag {}".format(repo, reference, tag)) from e
+
     def get_blob(self, repo: str, digest: str) -> Optional[Resource]:
+        return self._flight.do(("blob", repo, digest), self._get_blob, repo, digest)
+
+    def _get_blob(self, repo: str, digest: str) -> Optional[Resource]:
         try:
-            url = f"{self.registry_url}/v2/{repo}/blobs/{digest}"
-            r = requests.get(url, headers={
-                "Authorization": "Bearer {}".format(self.get_token(repo))
-            })
+            r = self._read("GET", repo, f"blobs/{digest}", {})
             if r.status_code == requests.codes.ok:
                 payload = r.json()
                 digest = r.headers.get("Docker-Content-Digest")
@@ -76,16 +203,29 @@ class DockerImage:
     revision: str
     app_revision: str
     created_at: datetime
+    platform: Optional[str] = None  # like "linux/amd64"
+    tree: Optional[str] = None  # git tree hash of images/<image> the image was built from
+    layers: List[Layer] = field(default_factory=list)
 
 
 class DockerhubClient(DockerRegistryClient):
-    def __init__(self):
-        super().__init__(token_url="https://auth.docker.io/token", registry_url="https://registry-1.docker.io")
-        self.hub_url = "https://hub.docker.com/v2"
+    def __init__(self, username: str = None, password: str = None, auth_url: Optional[str] = DOCKERHUB_AUTH_URL,
+                 registry_url: str = DOCKERHUB_REGISTRY_URL, hub_url: str = DOCKERHUB_HUB_URL, mirror_url: str = None):
+        super().__init__(token_url=auth_url, registry_url=registry_url, username=username, password=password,
+                         mirror_url=mirror_url)
+        self.hub_url = hub_url
+        self._hub_http = HttpClient("dockerhub")
+        # (repo, tag) -> manifest digest, as of the last lookup
+        self.tag_digests: Dict[Tuple[str, str], str] = {}
+        # manifest digest -> images of all platforms, manifests are immutable so entries never go stale
+        self._images: Dict[str, List[DockerImage]] = {}
 
     def get_tag(self, repo: str, tag: str) -> Optional[Dict]:
+        return self._flight.do(("tag", repo, tag), self._get_tag, repo, tag)
+
+    def _get_tag(self, repo: str, tag: str) -> Optional[Dict]:
         url = f"{self.hub_url}/repositories/{repo}/tags/{tag}"
-        r = requests.get(url)
+        r = self._hub_http.get(url)
         if r.status_code == requests.codes.ok:
             return r.json()
         elif r.status_code == requests.codes.not_found:
@@ -95,17 +235,15 @@ class DockerhubClient(DockerRegistryClient):
 
     def get_tags(self, repo) -> List[Tag]:
         tags = []
-        url = f"https://hub.docker.com/v2/repositories/{repo}/tags"
-        while True:
-            j = requests.get(url).json()
-            url = j["next"]
-            if not url:
-                break
+        url = f"{self.hub_url}/repositories/{repo}/tags?page_size=100"
+        while url:
+            j = self._hub_http.get(url).json()
             for item in j["results"]:
-                tags.append(Tag(item["name"], item["full_size"]))
+                tags.append(Tag(item["name"], item["full_size"], item.get("last_updated")))
+            url = j["next"]
         return tags
 
-    def _get_single_manifest(self, r1, repo):
+    def _get_single_manifest(self, r1, repo, platform=None):
         digest = r1.payload["config"]["digest"]
 
         r2 = self.get_blob(repo, digest)
@@ -113,14 +251,52 @@ class DockerhubClient(DockerRegistryClient):
 
         revision = labels.get("com.exchangeunion.image.revision", None)
         app_revision = labels.get("com.exchangeunion.application.revision", None)
+        tree = labels.get("com.exchangeunion.image.tree", None)
+
+        if not platform and "architecture" in r2.payload:
+            platform = "{}/{}".format(r2.payload.get("os", "linux"), r2.payload["architecture"])
+
+        layers = [Layer(layer["digest"], layer["size"]) for layer in r1.payload.get("layers", [])]
 
         # FIXME created_at
-        return DockerImage(digest=digest, revision=revision, app_revision=app_revision, created_at=datetime.now())
+        return DockerImage(digest=digest, revision=revision, app_revision=app_revision, created_at=datetime.now(),
+                           platform=platform, tree=tree, layers=layers)
 
     def get_image(self, repo, tag) -> Optional[DockerImage]:
+        """Get the amd64 image of a tag"""
+        for image in self.get_images(repo, tag):
+            if image.platform in [None, "linux/amd64"]:
+                return image
+        return None
+
+    def get_images(self, repo, tag) -> List[DockerImage]:
+        """Get the images of all platforms of a tag.
+
+        The tag is resolved with a HEAD request first, the manifests and config
+        blobs are only fetched when the tag points to a digest we haven't seen.
+        """
+        return self._flight.do(("images", repo, tag), self._get_images, repo, tag)
+
+    def _get_images(self, repo, tag) -> List[DockerImage]:
+        digest = self.get_manifest_digest(repo, tag)
+        if not digest:
+            self.tag_digests.pop((repo, tag), None)
+            return []
+
+        self.tag_digests[(repo, tag)] = digest
+        images = self._images.get(digest)
+        if images is not None:
+            return images
+
+        # Fetch by digest so that the cached result matches the digest exactly
+        images = self._fetch_images(repo, digest)
+        self._images[digest] = images
+        return images
+
+    def _fetch_images(self, repo, tag) -> List[DockerImage]:
         r1 = self.get_manifest(repo, tag)
         if not r1:
-            return None
+            return []
 
         schema_version = r1.payload["schemaVersion"]
         if schema_version != 2:
@@ -129,18 +305,21 @@ class DockerhubClient(DockerRegistryClient):
         media_type = r1.payload["mediaType"]
 
         if media_type == "application/vnd.docker.distribution.manifest.v2+json":
-            return self._get_single_manifest(r1, repo)
+            return [self._get_single_manifest(r1, repo)]
         elif media_type == "application/vnd.docker.distribution.manifest.list.v2+json":
+            result = []
             for manifest in r1.payload["manifests"]:
                 digest = manifest["digest"]
                 p = manifest["platform"]
-                arch = p["architecture"]
-                if arch == "amd64":
-                    r2 = self.get_manifest(repo, digest)
-                    return self._get_single_manifest(r2, repo)
+                platform = "{}/{}".format(p["os"], p["architecture"])
+                r2 = self.get_manifest(repo, digest)
+                result.append(self._get_single_manifest(r2, repo, platform))
+            return result
+        else:
+            raise RuntimeError("Unsupported media type %s" % media_type)
 
     def login(self, username, password) -> str:
-        r = requests.post("https://hub.docker.com/v2/users/login", json={
+        r = self._hub_http.post(f"{self.hub_url}/users/login", json={
             "username": username,
             "password": password,
         })
@@ -150,7 +329,7 @@ class DockerhubClient(DockerRegistryClient):
             raise RuntimeError("Failed to login")
 
     def logout(self, token) -> None:
-        r = requests.post("https://hub.docker.com/v2/logout", headers={
+        r = self._hub_http.post(f"{self.hub_url}/logout", headers={
             "Authorization": f"JWT {token}"
         })
         if r.status_code == 200:
@@ -160,7 +339,7 @@ class DockerhubClient(DockerRegistryClient):
             raise RuntimeError("Failed to logout")
 
     def remove_tag(self, token, repo, tag) -> None:
-        r = requests.delete(f"https://hub.docker.com/v2/repositories/{repo}/tags/{tag}", headers={
+        r = self._hub_http.delete(f"{self.hub_url}/repositories/{repo}/tags/{tag}", headers={
             "Authorization": f"JWT {token}"
         })
         if r.status_code != 204:
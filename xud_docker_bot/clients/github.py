@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional, Any, Tuple
+
+import aiohttp
+
+from .policy import CallPolicy, CircuitOpenError, get_breaker
+
+
+class GithubClientError(Exception):
+    pass
+
+
+class GithubServerError(GithubClientError):
+    pass
+
+
+@dataclass
+class CachedResponse:
+    etag: str
+    payload: Any
+    next_url: Optional[str]
+
+
+class GithubClient:
+    def __init__(self, token: str = None, repo: str = "ExchangeUnion/xud-docker"):
+        self._logger = logging.getLogger("xud_docker_bot.GithubClient")
+        self.api_url = "https://api.github.com"
+        self.token = token
+        self.repo = repo
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.policy = CallPolicy()
+        self.breaker = get_breaker("github")
+        # url -> last 200 response, revalidated with If-None-Match
+        self._cache: Dict[str, CachedResponse] = {}
+        # branch -> open PR of the last get_open_pulls
+        self.pulls: Dict[str, Dict] = {}
+        self._pulls_lock: Optional[asyncio.Lock] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created lazily because aiohttp sessions must be created inside the running event loop
+        if not self._session:
+            headers = {"Accept": "application/vnd.github.v3+json"}
+            if self.token:
+                headers["Authorization"] = "token " + self.token
+            timeout = aiohttp.ClientTimeout(sock_connect=self.policy.connect_timeout,
+                                            sock_read=self.policy.read_timeout)
+            self._session = aiohttp.ClientSession(headers=headers, timeout=timeout)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def _get(self, url: str) -> Tuple[Any, Optional[str]]:
+        """GET a resource and the URL of its next page. Connection errors, timeouts and 5xx responses are retried."""
+        attempts = 1 + self.policy.retries
+        for attempt in range(attempts):
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError as e:
+                raise GithubClientError("GitHub API is unavailable") from e
+            try:
+                result = await self._get_once(url)
+                self.breaker.record_success()
+                return result
+            except (aiohttp.ClientError, asyncio.TimeoutError, GithubServerError) as e:
+                self.breaker.record_failure()
+                if attempt == attempts - 1:
+                    raise GithubClientError("Failed to get %s" % url) from e
+                self._logger.debug("GET %s failed (attempt %d/%d): %r", url, attempt + 1, attempts, e)
+            await asyncio.sleep(self.policy.get_delay(attempt))
+
+    async def _get_once(self, url: str) -> Tuple[Any, Optional[str]]:
+        """Unchanged resources are answered with 304 by GitHub, which does not count against the rate limit"""
+        headers = {}
+        cached = self._cache.get(url)
+        if cached:
+            headers["If-None-Match"] = cached.etag
+        async with self._get_session().get(url, headers=headers) as r:
+            if r.status == 304 and cached:
+                return cached.payload, cached.next_url
+            if r.status >= 500:
+                raise GithubServerError("GitHub API responded %s for %s" % (r.status, url))
+            if r.status != 200:
+                raise GithubClientError("GitHub API responded %s for %s: %s" % (r.status, url, await r.text()))
+            payload = await r.json()
+            next_url = None
+            if "next" in r.links:
+                next_url = str(r.links["next"]["url"])
+            etag = r.headers.get("ETag")
+            if etag:
+                self._cache[url] = CachedResponse(etag, payload, next_url)
+            self._logger.debug("GET %s (rate limit remaining: %s)", url, r.headers.get("X-RateLimit-Remaining"))
+            return payload, next_url
+
+    async def get_open_pulls(self) -> Dict[str, Dict]:
+        """List all open PRs of the repository as a branch -> PR map. Only PRs from branches of the repository itself
+        are included.
+        """
+        if not self._pulls_lock:
+            self._pulls_lock = asyncio.Lock()
+        async with self._pulls_lock:
+            result = {}
+            url = f"{self.api_url}/repos/{self.repo}/pulls?state=open&per_page=100"
+            while url:
+                payload, url = await self._get(url)
+                for pr in payload:
+                    head = pr["head"]
+                    if head["repo"] and head["repo"]["full_name"].lower() == self.repo.lower():
+                        result[head["ref"]] = pr
+            self.pulls = result
+            return result
+
+    async def get_pr(self, branch: str) -> Optional[Dict]:
+        pulls = await self.get_open_pulls()
+        return pulls.get(branch)
@@ -0,0 +1,168 @@
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+@dataclass
+class CallPolicy:
+    connect_timeout: float = 3.05
+    read_timeout: float = 15
+    retries: int = 2  # extra attempts of idempotent calls
+    backoff: float = 0.5  # base delay of the exponential backoff
+    max_backoff: float = 4
+    retry_throttled: bool = True  # retry 429 responses, pointless for long rate limit windows
+
+    def get_delay(self, attempt: int) -> float:
+        # Full jitter: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Fail fast while a dependency is down.
+
+    The breaker opens after failure_threshold consecutive failures. While open, calls raise CircuitOpenError
+    immediately. After reset_timeout seconds a single trial call is let through (half-open), its result closes or
+    re-opens the breaker.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError("Circuit breaker %s is %s" % (self.name, self.state))
+
+    def record_success(self) -> None:
+        with self._lock:
+            previous = self.state
+            self.state = self.CLOSED
+            self.failures = 0
+        if previous != self.CLOSED:
+            _notify(self, previous)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            previous = self.state
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+        if previous != self.state:
+            _notify(self, previous)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_listeners: List[Callable[[CircuitBreaker, str], None]] = []
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Get the circuit breaker of a dependency, clients talking to the same dependency share it"""
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(name)
+    return _breakers[name]
+
+
+def get_breakers() -> List[CircuitBreaker]:
+    return list(_breakers.values())
+
+
+def add_breaker_listener(listener: Callable[[CircuitBreaker, str], None]) -> None:
+    """Register a callback which is called with (breaker, previous state) whenever a breaker changes state"""
+    _listeners.append(listener)
+
+
+def _notify(breaker: CircuitBreaker, previous: str) -> None:
+    logger.warning("Circuit breaker %s: %s -> %s", breaker.name, previous, breaker.state)
+    for listener in _listeners:
+        try:
+            listener(breaker, previous)
+        except Exception:
+            logger.exception("Failed to notify circuit breaker listener")
+
+
+class HttpClient:
+    """Outbound HTTP calls to one dependency with timeouts, retries and a circuit breaker"""
+
+    def __init__(self, name: str, policy: CallPolicy = None):
+        self.name = name
+        self.policy = policy or CallPolicy()
+        self.breaker = get_breaker(name)
+        self.session = requests.Session()
+
+    def request(self, method: str, url: str, idempotent: Optional[bool] = None, **kwargs) -> requests.Response:
+        """Send a request. Idempotent requests are retried on connection errors, timeouts, 429 and 5xx responses."""
+        policy = self.policy
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempts = 1 + policy.retries if idempotent else 1
+        kwargs.setdefault("timeout", (policy.connect_timeout, policy.read_timeout))
+
+        for attempt in range(attempts):
+            self.breaker.before_call()
+            last = attempt == attempts - 1
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.breaker.record_failure()
+                if last:
+                    raise
+                logger.debug("%s %s failed (attempt %d/%d)", method, url, attempt + 1, attempts, exc_info=True)
+            except BaseException:
+                # Not retried, but it still ends the trial call of a half-open breaker
+                self.breaker.record_failure()
+                raise
+            else:
+                throttled = r.status_code == requests.codes.too_many_requests
+                if r.status_code < 500 and not (throttled and policy.retry_throttled):
+                    # A rate limited dependency is still up
+                    self.breaker.record_success()
+                    return r
+                self.breaker.record_failure()
+                if last:
+                    return r
+                logger.debug("%s %s responded %d (attempt %d/%d)", method, url, r.status_code, attempt + 1, attempts)
+                r.close()
+            time.sleep(policy.get_delay(attempt))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds to back off after a 429 response without a Retry-After header
+DEFAULT_RETRY_AFTER = 60
+
+# Non-urgent calls re-check the budget at least this often while waiting
+MAX_WAIT = 60
+
+
+def parse_rate_limit_header(value: Optional[str]) -> Optional[Tuple[int, Optional[int]]]:
+    """Parse headers like "RateLimit-Remaining: 76;w=21600" into (76, 21600)"""
+    if not value:
+        return None
+    parts = value.split(";")
+    try:
+        count = int(parts[0].strip())
+    except ValueError:
+        return None
+    window = None
+    for part in parts[1:]:
+        key, _, v = part.strip().partition("=")
+        if key == "w" and v.isdigit():
+            window = int(v)
+    return count, window
+
+
+class TokenBucket:
+    """Client-side view of a server enforced rate limit like the Docker Hub pull rate limit.
+
+    The bucket is seeded (and corrected) from the RateLimit-Limit and RateLimit-Remaining headers of every response,
+    refills at limit/window tokens per second in between and is emptied by 429 responses. Calls only take tokens,
+    they never wait, except calls made inside background(): those wait until the bucket holds more than reserve
+    tokens, so that urgent calls (analysing a push) always find budget left.
+    """
+
+    def __init__(self, name: str, reserve: int = 0):
+        self.name = name
+        self.reserve = reserve
+        self.limit: Optional[int] = None
+        self.window: Optional[int] = None
+        self._remaining: Optional[float] = None  # unknown until the first response with rate limit headers
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _refill(self, now: float) -> None:
+        if self._remaining is not None and self.limit and self.window:
+            self._remaining = min(self.limit, self._remaining + (now - self._updated) * self.limit / self.window)
+        self._updated = now
+
+    @property
+    def remaining(self) -> Optional[float]:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._remaining
+
+    def update(self, headers) -> None:
+        """Sync the bucket with the rate limit headers of a response"""
+        remaining = parse_rate_limit_header(headers.get("RateLimit-Remaining"))
+        if not remaining:
+            return
+        limit = parse_rate_limit_header(headers.get("RateLimit-Limit"))
+        with self._lock:
+            self._refill(time.monotonic())
+            self._remaining = remaining[0]
+            if limit:
+                self.limit, self.window = limit[0], limit[1] or remaining[1]
+
+    def consume(self) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._remaining is not None:
+                self._remaining = max(self._remaining - 1, 0)
+
+    def throttled(self, retry_after: float = DEFAULT_RETRY_AFTER) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._remaining = 0
+            self._blocked_until = now + retry_after
+        logger.warning("Rate limit %s exceeded, non-urgent calls wait for %d seconds", self.name, retry_after)
+
+    @contextmanager
+    def background(self):
+        """Mark the calls of the current thread as non-urgent"""
+        previous = getattr(self._local, "background", False)
+        self._local.background = True
+        try:
+            yield
+        finally:
+            self._local.background = previous
+
+    def wait(self) -> None:
+        """Wait for budget if the current thread makes non-urgent calls. Urgent calls return right away."""
+        if not getattr(self._local, "background", False):
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                elif self._remaining is None or self._remaining >= self.reserve + 1:
+                    return
+                elif self.limit and self.window:
+                    delay = (self.reserve + 1 - self._remaining) * self.window / self.limit
+                else:
+                    return
+            logger.debug("Waiting %.1f seconds for %s budget", delay, self.name)
+            time.sleep(min(delay, MAX_WAIT))
+
+
+_buckets: Dict[str, TokenBucket] = {}
+
+
+def get_bucket(name: str) -> TokenBucket:
+    """Get the token bucket of a rate limit, clients sharing the limit share the bucket"""
+    if name not in _buckets:
+        _buckets[name] = TokenBucket(name)
+    return _buckets[name]
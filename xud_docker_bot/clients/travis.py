@@ -1,10 +1,15 @@
-from requests import post, get
+from requests import codes
 import logging
-from typing import List
+import re
+from typing import List, Iterable, Optional, Dict, Set, Callable
+from collections import deque, OrderedDict
 import asyncio
 from asyncio import sleep
 from dataclasses import dataclass
 
+from .policy import HttpClient, CallPolicy
+from .singleflight import SingleFlight
+
 
 class TravisClientError(Exception):
     pass
@@ -18,12 +23,68 @@ class TravisClientError(Exception):
 # approved rejected
 
 
+@dataclass
+class TrackedRequest:
+    request_id: int
+    branch: str
+    images: Set[str]
+    arch: Set[str]
+    builds: Optional[List[int]] = None  # known once Travis has created the builds
+    superseded: bool = False
+    nudge: Optional[asyncio.Event] = None  # set to look for the builds right away instead of at the next poll
+
+
 @dataclass
 class Job:
     job_id: int
     build_id: int
     state: str
-    log: str
+    log: Optional[str]  # failure excerpt of an errored job, never the full log
+
+
+# Seconds between checks whether Travis has created the builds of a request
+REQUEST_POLL_INTERVAL = 3
+
+# Builds of this many recent requests are kept for commands which start waiting after the builds are known
+MAX_RESOLVED_REQUESTS = 100
+
+# Only this many bytes at the end of a job log are downloaded
+LOG_TAIL_BYTES = 64 * 1024
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+FAILED_STEP = re.compile(r'^The command "(.*)" (exited with \d+|failed.*)\.$')
+ERROR_LINE = re.compile(r"\b(error|fatal|failed)\b", re.IGNORECASE)
+
+
+def extract_failure(lines: Iterable[str], max_errors: int = 20, max_tail: int = 10) -> str:
+    """Scan log lines and return a short excerpt describing the failure.
+
+    The excerpt contains the last failing step reported by Travis, the last
+    error-like lines and the last few lines of the log. Memory usage is bounded
+    by max_errors and max_tail regardless of the log size.
+    """
+    failed_step = None
+    errors = deque(maxlen=max_errors)
+    tail = deque(maxlen=max_tail)
+    for line in lines:
+        # Travis uses carriage returns for progress bars, only the last frame matters
+        line = ANSI_ESCAPE.sub("", line).rstrip().split("\r")[-1].rstrip()
+        if not line:
+            continue
+        if FAILED_STEP.match(line):
+            failed_step = line
+        elif ERROR_LINE.search(line):
+            errors.append(line)
+        tail.append(line)
+
+    parts = []
+    if failed_step:
+        parts.append(failed_step)
+    if errors:
+        parts.append("\n".join(errors))
+    if tail:
+        parts.append("...\n" + "\n".join(tail))
+    return "\n\n".join(parts)
 
 
 class TravisClient:
@@ -32,9 +93,21 @@ class TravisClient:
         self.api_token = api_token
         self.repo = "ExchangeUnion%2Fxud-docker"
         self.api_url = "https://api.travis-ci.org"
+        self._http = HttpClient("travis")
+        # Logs are served from S3 and can be slow, the circuit breaker is separate from the API
+        self._log_http = HttpClient("travis-logs", CallPolicy(read_timeout=30))
+        self._flight = SingleFlight()
+        # branch -> in-flight requests, oldest first
+        self._tracked: Dict[str, List[TrackedRequest]] = {}
+        # Called with (branch, build ids) whenever superseded builds are canceled, possibly from an executor thread
+        self.on_superseded: Optional[Callable[[str, List[int]], None]] = None
+        # request id -> futures resolved with the build ids by the tracker of the request
+        self._build_waiters: Dict[int, List[asyncio.Future]] = {}
+        # request id -> build ids, of recently resolved requests
+        self._request_builds: "OrderedDict[int, List[int]]" = OrderedDict()
 
     def trigger_travis_build(self, branch: str, message: str):
-        r = post(f"{self.api_url}/repo/{self.repo}/requests", json={
+        r = self._http.post(f"{self.api_url}/repo/{self.repo}/requests", json={
             "request": {
                 "message": message,
                 "branch": branch,
@@ -58,23 +131,113 @@ class TravisClient:
         else:
             raise RuntimeError("Cannot map Docker platform {} to Travis platform".format(platform))
 
-    async def tracking_jobs(self, request_id):
+    def supersede(self, branch: str, request_id: int) -> List[TrackedRequest]:
+        """Mark older requests for the branch which the request fully covers as superseded. Returns the ones whose
+        builds are known, to cancel with cancel_superseded.
+
+        Builds of older requests which Travis hasn't created yet are canceled by their tracker as soon as they show
+        up. Call it on the loop thread, the tracked requests are owned by the trackers.
+        """
+        tracked = self._tracked.get(branch, [])
+        newer = next((t for t in tracked if t.request_id == request_id), None)
+        if not newer:
+            return []
+        result = []
+        for t in tracked:
+            if t is newer or t.superseded:
+                continue
+            if t.images <= newer.images and t.arch <= newer.arch:
+                self._logger.debug("Request %s is superseded by %s", t.request_id, request_id)
+                t.superseded = True
+                if t.builds is not None:
+                    result.append(t)
+        return result
+
+    def cancel_superseded(self, branch: str, build_ids: List[int]) -> None:
+        """Cancel the builds of a superseded request. Calls the Travis API, run it in an executor thread."""
+        canceled = []
+        for build_id in build_ids:
+            try:
+                self.cancel_travis_build(build_id)
+                canceled.append(build_id)
+            except Exception:
+                self._logger.exception("Failed to cancel superseded build %s", build_id)
+        if canceled and self.on_superseded:
+            self.on_superseded(branch, canceled)
+
+    def nudge(self, branch: str) -> None:
+        """Make the trackers of the branch look for their builds right away, e.g. when Travis reports a new build"""
+        for t in self._tracked.get(branch, []):
+            if t.builds is None and t.nudge:
+                t.nudge.set()
+
+    async def wait_for_builds(self, request_id: int, timeout: float) -> List[int]:
+        """Wait until the tracker of the request knows its builds.
+
+        Raises asyncio.TimeoutError if Travis hasn't created the builds within timeout seconds.
+        """
+        if request_id in self._request_builds:
+            return self._request_builds[request_id]
+        future = asyncio.get_running_loop().create_future()
+        self._build_waiters.setdefault(request_id, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            waiters = self._build_waiters.get(request_id, [])
+            if future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._build_waiters[request_id]
+
+    def _resolve_builds(self, request_id: int, builds: List[int]) -> None:
+        self._request_builds[request_id] = builds
+        while len(self._request_builds) > MAX_RESOLVED_REQUESTS:
+            self._request_builds.popitem(last=False)
+        for future in self._build_waiters.pop(request_id, []):
+            if not future.done():
+                future.set_result(builds)
+
+    async def tracking_jobs(self, tracked: TrackedRequest):
+        request_id = tracked.request_id
         self._logger.debug("Start tracking jobs of request %s", request_id)
+        try:
+            await self._tracking_jobs(tracked)
+        finally:
+            if tracked.builds is None:
+                for future in self._build_waiters.pop(request_id, []):
+                    if not future.done():
+                        future.set_exception(TravisClientError("Stopped tracking request %s" % request_id))
+            self._tracked[tracked.branch].remove(tracked)
+            if not self._tracked[tracked.branch]:
+                del self._tracked[tracked.branch]
+
+    async def _tracking_jobs(self, tracked: TrackedRequest):
+        request_id = tracked.request_id
         builds = []
+        loop = asyncio.get_running_loop()
+        tracked.nudge = asyncio.Event()
         while True:
-            await sleep(3)
-            r = self.get_request(request_id)
+            try:
+                await asyncio.wait_for(tracked.nudge.wait(), REQUEST_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            tracked.nudge.clear()
+            r = await loop.run_in_executor(None, self.get_request, request_id)
             state = r["state"]
             if state == "finished":
                 for build in r["builds"]:
                     builds.append(build["id"])
                 break
         self._logger.debug("Request %s builds: %s", request_id, ", ".join(map(str, builds)))
+        tracked.builds = builds
+        self._resolve_builds(request_id, builds)
+        if tracked.superseded:
+            await loop.run_in_executor(None, self.cancel_superseded, tracked.branch, list(builds))
 
-        # request -> builds -> jobs
+        # request -> builds -> jobs, the calls run in executor threads since retries back off with time.sleep()
         jobs = []
         for build in builds:
-            r = self.get_build(build)
+            r = await loop.run_in_executor(None, self.get_build, build)
             for job in r["jobs"]:
                 job_id = job["id"]
                 jobs.append(Job(job_id=job_id, build_id=build, state=None, log=None))
@@ -87,11 +250,12 @@ class TravisClient:
                 if job.state in ["passed", "failed", "errored", "canceled"]:
                     finished_jobs = finished_jobs + 1
                     continue
-                r = self.get_job(job.job_id)
+                r = await loop.run_in_executor(None, self.get_job, job.job_id)
                 job.state = r["state"]
                 self._logger.debug("Job %s state: %s", job.job_id, job.state)
                 if job.state == "errored":
-                    job.log = self.get_job_log(job.job_id)
+                    job.log = await loop.run_in_executor(None, self.get_job_log, job.job_id)
+                    self._logger.debug("Job %s failure excerpt\n%s", job.job_id, job.log)
             if finished_jobs == len(jobs):
                 break
             await sleep(10)
@@ -103,7 +267,8 @@ class TravisClient:
             commit_message: str,
             images: List[str],
             force: bool = False,
-            platforms: List[str] = None):
+            platforms: List[str] = None,
+            track: bool = True):
 
         script = "tools/push {}".format(" ".join(images))
 
@@ -137,7 +302,7 @@ class TravisClient:
                 "depth": False
             }
 
-        r = post(f"{self.api_url}/repo/{self.repo}/requests", json=payload, headers={
+        r = self._http.post(f"{self.api_url}/repo/{self.repo}/requests", json=payload, headers={
             "Travis-API-Version": "3",
             "Authorization": "token " + self.api_token,
         })
@@ -148,44 +313,75 @@ class TravisClient:
         request_id = j["request"]["id"]
         self._logger.debug("Triggered %s build for branch %s", self.repo, branch)
 
-        asyncio.get_running_loop().create_task(self.tracking_jobs(request_id))
+        if not track:
+            return remaining_requests, request_id
+
+        tracked = TrackedRequest(request_id, branch, set(images), set(arch))
+        # Registered right away so that the request can supersede older ones before its tracking task starts
+        self._tracked.setdefault(branch, []).append(tracked)
+        asyncio.get_running_loop().create_task(self.tracking_jobs(tracked))
 
         return remaining_requests, request_id
 
     def get_request(self, request_id):
-        r = get(f"{self.api_url}/repo/{self.repo}/request/{request_id}", headers={
+        return self._flight.do(("request", request_id), self._get_request, request_id)
+
+    def _get_request(self, request_id):
+        r = self._http.get(f"{self.api_url}/repo/{self.repo}/request/{request_id}", headers={
             "Travis-API-Version": "3",
             "Authorization": "token " + self.api_token,
         })
         return r.json()
 
     def get_build(self, build_id):
-        r = get(f"{self.api_url}/build/{build_id}", headers={
+        r = self._http.get(f"{self.api_url}/build/{build_id}", headers={
             "Travis-API-Version": "3",
         })
         return r.json()
 
     def get_job(self, job_id):
-        r = get(f"{self.api_url}/job/{job_id}", headers={
+        r = self._http.get(f"{self.api_url}/job/{job_id}", headers={
             "Travis-API-Version": "3",
         })
         return r.json()
 
-    def get_job_log(self, job_id):
-        r = get(f"{self.api_url}/job/{job_id}/log.txt", headers={
+    def get_job_log(self, job_id, tail_bytes: int = LOG_TAIL_BYTES) -> str:
+        """Get a failure excerpt of the job log.
+
+        Only the last tail_bytes bytes of the log are requested. If the server
+        ignores the Range header the log is streamed line by line, so the full
+        log is never held in memory.
+        """
+        r = self._log_http.get(f"{self.api_url}/job/{job_id}/log.txt", headers={
             "Travis-API-Version": "3",
-        })
-        return r.text
+            "Range": f"bytes=-{tail_bytes}",
+        }, stream=True)
+        try:
+            if r.status_code == codes.requested_range_not_satisfiable:
+                # The log is empty
+                return ""
+            r.raise_for_status()
+            # Only split on line feeds, iter_lines() would also split the carriage returns of progress bars
+            lines = (line.decode(errors="replace") for line in r.iter_lines(delimiter=b"\n"))
+            if r.status_code == codes.partial_content:
+                # The first line is most likely cut in the middle
+                next(lines, None)
+            return extract_failure(lines)
+        finally:
+            r.close()
 
     def cancel_travis_build(self, build_id: str):
-        r = post(f"{self.api_url}/build/{build_id}/cancel", headers={
+        r = self._http.post(f"{self.api_url}/build/{build_id}/cancel", idempotent=True, headers={
             "Travis-API-Version": "3",
             "Authorization": "token " + self.api_token,
         })
+        # Like 403 without permission or 409 for a finished build, the build is not canceled
+        if not 200 <= r.status_code < 300:
+            raise TravisClientError("Failed to cancel build {}: {} {}".format(build_id, r.status_code, r.text))
         self._logger.debug("Canceled build: %s", build_id)
 
     def restart_travis_build(self, build_id: str):
-        r = post(f"{self.api_url}/build/{build_id}/restart", headers={
+        r = self._http.post(f"{self.api_url}/build/{build_id}/restart", headers={
             "Travis-API-Version": "3",
             "Authorization": "token " + self.api_token,
         })
@@ -193,7 +389,7 @@ class TravisClient:
 
     def get_builds_of_github_repo(self, repo):
         repo = repo.replace("/", "%2F")
-        r = get(f"{self.api_url}/repo/github/{repo}/builds", headers={
+        r = self._http.get(f"{self.api_url}/repo/github/{repo}/builds", headers={
             "Travis-API-Version": "3",
             "Authorization": "token " + self.api_token,
         })
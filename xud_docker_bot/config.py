@@ -1,4 +1,9 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import List
+
+from .clients.docker import DOCKERHUB_AUTH_URL, DOCKERHUB_REGISTRY_URL, DOCKERHUB_HUB_URL
+
+XUD_DOCKER_REPO_URL = "https://github.com/ExchangeUnion/xud-docker.git"
 
 
 @dataclass
@@ -10,15 +15,46 @@ class DiscordConfig:
 @dataclass
 class TravisConfig:
     api_token: str = None
+    batch_window: int = 10  # seconds to collect images of a branch into one build request
+    quota_reserve: int = 10  # remaining requests kept for master and PR builds
+    quota_reset: int = 3600  # seconds until the Travis request quota is assumed to be restored
+    no_auto_cancel: List[str] = field(default_factory=list)  # branches whose superseded builds keep running
+
+
+@dataclass
+class GithubConfig:
+    token: str = None
 
 
 @dataclass
 class DockerhubConfig:
     username: str = None
     password: str = None
+    aggregate_timeout: int = 1800  # seconds to wait for the other per-arch pushes of a tag
+    pull_reserve: int = 20  # registry pulls kept for analysing pushes, non-urgent lookups wait above it
+    auth_url: str = DOCKERHUB_AUTH_URL  # empty for a registry without token authentication
+    registry_url: str = DOCKERHUB_REGISTRY_URL
+    hub_url: str = DOCKERHUB_HUB_URL
+    mirror_url: str = None  # pull-through cache to read manifests and blobs from, like http://localhost:5000
 
 
+@dataclass
+class XudDockerConfig:
+    repo_url: str = XUD_DOCKER_REPO_URL
+
+
+@dataclass
+class ServerConfig:
+    shutdown_timeout: int = 30  # seconds to drain in-flight events on shutdown, the rest is replayed on start
+    lag_threshold: float = 0.5  # seconds the event loop may be blocked before the blocking call is recorded
+
+
+@dataclass
 class Config:
-    discord = DiscordConfig()
-    travis = TravisConfig()
-    dockerhub = DockerhubConfig()
+    # Instance fields, so that the configuration is pickled along when worker processes are spawned
+    server: ServerConfig = field(default_factory=ServerConfig)
+    discord: DiscordConfig = field(default_factory=DiscordConfig)
+    travis: TravisConfig = field(default_factory=TravisConfig)
+    dockerhub: DockerhubConfig = field(default_factory=DockerhubConfig)
+    github: GithubConfig = field(default_factory=GithubConfig)
+    xud_docker: XudDockerConfig = field(default_factory=XudDockerConfig)
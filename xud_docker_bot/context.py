@@ -1,7 +1,18 @@
 import asyncio
-from .clients import TravisClient, DockerhubClient
+import os
+from typing import Union
+
+from .clients import TravisClient, DockerhubClient, GithubClient
 from .config import Config
 from .discord import DiscordTemplate
+from .xud_docker import XudDockerRepo
+from .scheduler import BuildScheduler
+from .build_queue import RemoteBuildScheduler, BUILDS, BUILD_RESULTS
+from .layer_index import LayerIndex
+from .durable_queue import DurableQueue
+from .notifications import NotificationPublisher, NOTIFICATIONS
+from .metrics import register_gauge
+from .watchdog import LoopWatchdog, StallPublisher, STALLS
 
 
 class Context:
@@ -9,10 +20,54 @@ class Context:
     travis_client: TravisClient
     discord_template: DiscordTemplate
     dockerhub_client: DockerhubClient
+    xud_docker: XudDockerRepo
+    github_client: GithubClient
+    build_scheduler: Union[BuildScheduler, RemoteBuildScheduler]
+    layer_index: LayerIndex
+    loop_watchdog: LoopWatchdog
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, worker_index: int = None):
+        """Worker processes (worker_index is set) publish Discord messages through the notification queue, submit
+        builds to the scheduler of the gateway process through the build queue, report their event loop stalls through
+        the stall queue and use their own xud-docker repository.
+        """
         self.config = config
+        self.worker_index = worker_index
         self.travis_client = TravisClient(config.travis.api_token)
         self.loop = asyncio.get_event_loop()
-        self.discord_template = DiscordTemplate(self)
-        self.dockerhub_client = DockerhubClient()
+        self.loop_watchdog = watchdog = LoopWatchdog(config.server.lag_threshold)
+        register_gauge("xud_docker_bot_loop_lag_seconds", "Event loop lag of the last heartbeat", lambda: watchdog.lag)
+        register_gauge("xud_docker_bot_loop_max_lag_seconds", "Largest event loop lag since start",
+                       lambda: watchdog.max_lag)
+        register_gauge("xud_docker_bot_loop_stalls", "Event loop stalls over the lag threshold since start",
+                       lambda: watchdog.stall_count)
+        if worker_index is None:
+            self.discord_template = DiscordTemplate(self)
+        else:
+            self.discord_template = NotificationPublisher(DurableQueue(NOTIFICATIONS))
+            watchdog.on_stall = StallPublisher(DurableQueue(STALLS), worker_index)
+        self.dockerhub_client = DockerhubClient(
+            config.dockerhub.username, config.dockerhub.password, auth_url=config.dockerhub.auth_url,
+            registry_url=config.dockerhub.registry_url, hub_url=config.dockerhub.hub_url,
+            mirror_url=config.dockerhub.mirror_url)
+        rate_limit = self.dockerhub_client.rate_limit
+        rate_limit.reserve = config.dockerhub.pull_reserve
+        register_gauge("xud_docker_bot_registry_pulls_remaining",
+                       "Docker Hub pulls left in the current rate limit window", lambda: rate_limit.remaining)
+        register_gauge("xud_docker_bot_registry_pulls_limit",
+                       "Docker Hub pulls allowed per rate limit window", lambda: rate_limit.limit)
+        self.github_client = GithubClient(config.github.token)
+        if worker_index is None:
+            self.build_scheduler = BuildScheduler(self)
+        else:
+            self.build_scheduler = RemoteBuildScheduler(
+                self, worker_index, DurableQueue(BUILDS), DurableQueue(BUILD_RESULTS))
+        register_gauge("xud_docker_bot_pending_build_requests", "Build requests waiting to be dispatched",
+                       lambda: len(self.build_scheduler.get_queue()))
+        register_gauge("xud_docker_bot_travis_requests_remaining", "Travis API requests left",
+                       lambda: self.build_scheduler.remaining_requests)
+        self.layer_index = LayerIndex(self.dockerhub_client)
+        repo_dir = os.path.expanduser("~/.xud-docker-bot/xud-docker")
+        if worker_index is not None:
+            repo_dir += "-%d" % worker_index
+        self.xud_docker = XudDockerRepo(repo_dir, self.dockerhub_client, config.xud_docker.repo_url)
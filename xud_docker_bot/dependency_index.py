@@ -0,0 +1,132 @@
+import logging
+import re
+import threading
+from subprocess import CalledProcessError
+from typing import Dict, List, Set, Tuple
+
+from xud_docker_bot.utils import execute
+
+# Upstream GitHub repositories and the xud-docker image built from each of them
+UPSTREAM_IMAGES = {
+    "ExchangeUnion/xud": "xud",
+    "ExchangeUnion/market-maker-tools": "arby",
+    "BoltzExchange/boltz-lnd": "boltz",
+}
+
+TEMPLATE_PY = "images/utils/launcher/config/template.py"
+
+BRANCH_ARG = re.compile(r"^ARG BRANCH=[\"']?([^\"'\s]+)", re.MULTILINE)
+TEMPLATE_IMAGE = re.compile(r"exchangeunion/([a-z0-9-]+):([A-Za-z0-9_.-]+)")
+
+
+class DependencyIndex:
+    """Map open xud-docker branches to the upstream images and branches they reference.
+
+    A branch references an upstream image if it has an images/<image>/ folder. The upstream branch is taken from
+    the "ARG BRANCH=..." lines of that folder (master by default). Images which are only pinned to released versions
+    in the utils template are skipped because upstream pushes never change them.
+
+    The index is updated incrementally, only branches whose head revision moved since the last update are scanned
+    again.
+    """
+
+    def __init__(self, repo_dir):
+        self._logger = logging.getLogger("xud_docker_bot.DependencyIndex")
+        self.repo_dir = repo_dir
+        self.ready = False
+        # xud-docker branch -> indexed head revision
+        self._revisions: Dict[str, str] = {}
+        # xud-docker branch -> image -> upstream branches
+        self._dependencies: Dict[str, Dict[str, Set[str]]] = {}
+        # (image, upstream branch) -> xud-docker branches
+        self._reverse: Dict[Tuple[str, str], Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def _git(self, cmd) -> str:
+        return execute(f"git {cmd}", cwd=self.repo_dir)
+
+    def list_open_branches(self) -> Dict[str, str]:
+        """Return master and every remote branch which has not been merged into master yet"""
+        fmt = "%(refname:strip=3) %(objectname)"
+        output = self._git(f"for-each-ref --format='{fmt}' refs/remotes/origin/master")
+        output += self._git(f"for-each-ref --format='{fmt}' --no-merged origin/master refs/remotes/origin")
+        result = {}
+        for line in output.splitlines():
+            branch, revision = line.split()
+            if branch == "HEAD":
+                continue
+            result[branch] = revision
+        return result
+
+    def _grep(self, pattern, revision, path) -> str:
+        try:
+            return self._git(f"grep -h -E '{pattern}' {revision} -- {path}")
+        except CalledProcessError as e:
+            # git grep exits with 1 when nothing matches
+            if e.returncode == 1:
+                return ""
+            raise
+
+    def _scan(self, revision) -> Dict[str, Set[str]]:
+        images = set(self._git(f"ls-tree --name-only {revision} images/").split())
+        images = {path.replace("images/", "") for path in images}
+
+        template_tags: Dict[str, Set[str]] = {}
+        for image, tag in TEMPLATE_IMAGE.findall(self._grep("exchangeunion/", revision, TEMPLATE_PY)):
+            template_tags.setdefault(image, set()).add(tag)
+
+        result = {}
+        for image in UPSTREAM_IMAGES.values():
+            if image not in images:
+                continue
+            tags = template_tags.get(image)
+            if tags and not any(tag.startswith("latest") for tag in tags):
+                continue
+            branches = set(BRANCH_ARG.findall(self._grep("^ARG BRANCH=", revision, f"images/{image}")))
+            result[image] = branches or {"master"}
+        return result
+
+    def _put(self, branch, revision, dependencies: Dict[str, Set[str]]) -> None:
+        self._remove(branch)
+        self._revisions[branch] = revision
+        self._dependencies[branch] = dependencies
+        for image, upstream_branches in dependencies.items():
+            for upstream_branch in upstream_branches:
+                self._reverse.setdefault((image, upstream_branch), set()).add(branch)
+
+    def _remove(self, branch) -> None:
+        self._revisions.pop(branch, None)
+        dependencies = self._dependencies.pop(branch, {})
+        for image, upstream_branches in dependencies.items():
+            for upstream_branch in upstream_branches:
+                key = (image, upstream_branch)
+                self._reverse[key].discard(branch)
+                if not self._reverse[key]:
+                    del self._reverse[key]
+
+    def update(self) -> None:
+        """Re-index branches which moved since the last update. Call this after every git fetch."""
+        heads = self.list_open_branches()
+        with self._lock:
+            for branch in set(self._revisions) - set(heads):
+                self._logger.debug("Remove branch %s from the dependency index", branch)
+                self._remove(branch)
+            changed = {b: r for b, r in heads.items() if self._revisions.get(b) != r}
+
+        for branch, revision in changed.items():
+            try:
+                dependencies = self._scan(revision)
+            except Exception:
+                self._logger.exception("Failed to index branch %s (%s)", branch, revision)
+                continue
+            self._logger.debug("Indexed branch %s (%s): %r", branch, revision, dependencies)
+            with self._lock:
+                self._put(branch, revision, dependencies)
+
+        self.ready = True
+
+    def lookup(self, image, upstream_branch) -> List[str]:
+        """Return xud-docker branches which build the image from the upstream branch, master first"""
+        with self._lock:
+            branches = self._reverse.get((image, upstream_branch), set())
+            return sorted(branches, key=lambda b: (b != "master", b))
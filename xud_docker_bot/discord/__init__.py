@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional, Iterable
 
 from discord.ext import commands
 import logging
@@ -8,12 +8,22 @@ import re
 from .cog_system import SystemCog
 from .cog_dockerhub import DockerhubCog
 from .cog_travis import TravisCog
+from ..clients.policy import CircuitBreaker, add_breaker_listener
 
 if TYPE_CHECKING:
     from ..context import Context
 
 
-__all__ = ["DiscordTemplate"]
+__all__ = ["DiscordTemplate", "get_breaker_message"]
+
+
+def get_breaker_message(breaker: CircuitBreaker, previous: str) -> Optional[str]:
+    if breaker.state == CircuitBreaker.OPEN and previous == CircuitBreaker.CLOSED:
+        return "🔌 **{}** keeps failing, calls fail fast for the next {} seconds".format(
+            breaker.name, breaker.reset_timeout)
+    elif breaker.state == CircuitBreaker.CLOSED:
+        return "✅ **{}** is back".format(breaker.name)
+    return None
 
 
 class DiscordTemplate:
@@ -49,9 +59,27 @@ class DiscordTemplate:
 
         self.bot = bot
         self._channel = None
+        self._channel_id = context.config.discord.channel
+        add_breaker_listener(self._on_breaker_state_change)
+
+    def _on_breaker_state_change(self, breaker: CircuitBreaker, previous: str):
+        msg = get_breaker_message(breaker, previous)
+        if msg:
+            # Outbound calls also run in executor threads
+            self.bot.loop.call_soon_threadsafe(self.publish_message, msg)
+
+    def is_ready(self) -> bool:
+        return self.bot.is_ready()
 
-    def publish_message(self, message: str):
-        self.bot.loop.create_task(self._channel.send(message))
+    def publish_message(self, message: str, reactions: Iterable[str] = ()):
+        self.bot.loop.create_task(self.publish_message_async(message, reactions))
 
-    async def publish_message_async(self, message: str):
-        return await self._channel.send(message)
+    async def publish_message_async(self, message: str, reactions: Iterable[str] = ()):
+        # The HTTP server starts before the Discord bot, hold messages until the bot is connected
+        await self.bot.wait_until_ready()
+        if not self._channel:
+            self._channel = self.bot.get_channel(self._channel_id)
+        result = await self._channel.send(message)
+        for reaction in reactions:
+            await result.add_reaction(reaction)
+        return result
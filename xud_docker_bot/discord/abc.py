@@ -1,15 +1,39 @@
 from __future__ import annotations
 
 import logging
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List
 
 from discord.ext import commands
 
 if TYPE_CHECKING:
     from ..context import Context
 
+# Discord rejects longer messages
+MAX_MESSAGE_LENGTH = 2000
+
+
+def split_message(msg: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Split a message at line breaks into messages Discord accepts. Longer lines are truncated."""
+    chunks = []
+    chunk = ""
+    for line in msg.split("\n"):
+        if len(line) > limit:
+            line = line[:limit - 1] + "…"
+        if chunk and len(chunk) + 1 + len(line) > limit:
+            chunks.append(chunk)
+            chunk = line
+        else:
+            chunk = chunk + "\n" + line if chunk else line
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
 
 class BaseCog(commands.Cog):
     def __init__(self, context: Context):
         self.logger = logging.getLogger("xud_docker_bot.discord." + self.__class__.__name__)
         self.context = context
+
+    async def send_long(self, ctx, msg: str) -> None:
+        for chunk in split_message(msg):
+            await ctx.send(chunk)
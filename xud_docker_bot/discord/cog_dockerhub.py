@@ -17,6 +17,36 @@ class DockerhubCog(BaseCog, name="DockerHub Category"):
             self.logger.debug("Iterating tag in %s repo: %r", repo, t)
             await ctx.send(f"• `{t.name}`  ~{humanize.naturalsize(t.size, binary=True)}")
 
+    @command(brief="Show storage of a repository split into bytes unique to and shared by tags")
+    async def du(self, ctx, repo: str):
+        assert repo
+        full_repo = f"exchangeunion/{repo}"
+        index = self.context.layer_index
+        await self.context.loop.run_in_executor(None, index.update, full_repo)
+
+        def size(n):
+            return humanize.naturalsize(n, binary=True)
+
+        tags = index.get_tag_usage(full_repo)
+        branches = index.get_branch_usage(full_repo)
+        msg = "Repository **{}** stores **{}** of layers in **{}** tag(s) of **{}** branch(es).".format(
+            full_repo, size(index.get_total_size(full_repo)), len(tags), len(branches))
+
+        msg += "\n\n**Branches** (unique / shared):"
+        for u in branches[:10]:
+            msg += "\n• `{}` {} / {} in {} tag(s)".format(u.name, size(u.unique), size(u.shared), len(u.tags))
+
+        msg += "\n\n**Tags** (unique / shared, with their per-arch tags):"
+        for u in tags[:10]:
+            msg += "\n• `{}` {} / {}".format(u.name, size(u.unique), size(u.shared))
+
+        candidates = [u for u in branches if u.name != "master" and u.unique > 0]
+        if candidates:
+            msg += "\n\n**Cleanup candidates:**"
+            for u in candidates[:5]:
+                msg += "\n• remove {} tag(s) of `{}` to free {}".format(len(u.tags), u.name, size(u.unique))
+        await self.send_long(ctx, msg)
+
     @command()
     async def cleanup(self, ctx, repo: str):
         assert repo
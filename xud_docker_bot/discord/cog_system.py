@@ -13,6 +13,24 @@ class SystemCog(BaseCog):
         for emoji in ('👍', '👎'):
             await message.add_reaction(emoji)
 
+    @command(brief="Show the event loop lag and the calls which blocked the loop recently")
+    async def lag(self, ctx):
+        watchdog = self.context.loop_watchdog
+        msg = "Event loop lag: **{:.0f} ms** (max {:.2f} s), **{}** stall(s) over {} s".format(
+            watchdog.lag * 1000, watchdog.max_lag, watchdog.stall_count, watchdog.threshold)
+        # The watchdog thread appends stalls while the message is built
+        for stall in reversed(list(watchdog.stalls)):
+            msg += "\n• {} blocked for {:.2f} s at `{}`".format(
+                stall.started_at.strftime("%Y-%m-%d %H:%M:%S"), stall.lag, stall.culprit)
+        if watchdog.workers > 0:
+            msg = "Gateway: " + msg
+            msg += "\n{} worker(s): **{}** stall(s) over {} s".format(
+                watchdog.workers, watchdog.worker_stall_count, watchdog.threshold)
+            for stall in reversed(list(watchdog.worker_stalls)):
+                msg += "\n• {} worker {} blocked for {:.2f} s at `{}`".format(
+                    stall.started_at.strftime("%Y-%m-%d %H:%M:%S"), stall.worker, stall.lag, stall.culprit)
+        await ctx.send(msg)
+
     # @Cog.listener()
     # async def on_reaction_add(self, reaction, user):
     #     pass
@@ -1,13 +1,16 @@
 from __future__ import annotations
 import argparse
+import asyncio
+from subprocess import CalledProcessError
 from typing import TYPE_CHECKING
-from asyncio import sleep
 
 from discord.ext import commands
 from discord.ext.commands import Context
 
 from .abc import BaseCog
 from ..clients import TravisClientError
+from ..scheduler import PRIORITY_MANUAL, PRIORITY_NAMES
+from ..xud_docker import is_valid_branch
 
 if TYPE_CHECKING:
     pass
@@ -44,25 +47,12 @@ DESCRIPTION
     -f, --force      Force build images
 """
 
+# Seconds to wait for Travis to create the builds of a build request
+BUILDS_TIMEOUT = 300
+
 BUILD_BRIEF = "Trigger a Travis build for Docker images"
 BUILD_USAGE = "-- %s\n\n%s" % (BUILD_BRIEF, BUILD_HELP)
 
-# FIXME remove the hardcoded available_images
-available_images = [
-    "bitcoind",
-    "litecoind",
-    "geth",
-    "lndbtc",
-    "lndltc",
-    "lndbtc-simnet",
-    "lndltc-simnet",
-    "connext",
-    "xud",
-    "arby",
-    "boltz",
-    "webui",
-    "utils",
-]
 
 
 class TravisCog(BaseCog, name="Travis Category"):
@@ -85,6 +75,21 @@ class TravisCog(BaseCog, name="Travis Category"):
             await ctx.send(msg)
             return
 
+        if not is_valid_branch(args.branch):
+            await ctx.send("🚨 Invalid branch: " + args.branch)
+            return
+
+        xud_docker = self.context.xud_docker
+        if not xud_docker.ready:
+            await ctx.send("🚨 The xud-docker repository is not ready yet, please try again later")
+            return
+        try:
+            available_images = await self.context.loop.run_in_executor(
+                None, xud_docker.get_branch_catalog, args.branch)
+        except CalledProcessError:
+            await ctx.send("🚨 Invalid branch: " + args.branch)
+            return
+
         for image in args.image:
             if ":" in image:
                 image = image.split(":")[0]
@@ -95,31 +100,45 @@ class TravisCog(BaseCog, name="Travis Category"):
 
         try:
             client = self.context.travis_client
-            remaining_requests, request_id = client.trigger_travis_build2(
+            scheduler = self.context.build_scheduler
+            future = scheduler.submit(
                 args.branch,
-                "Triggered from Discord by {}".format(ctx.author),
                 args.image,
-                force=args.force,
-                platforms=args.platform
+                "Triggered from Discord by {}".format(ctx.author),
+                platforms=args.platform,
+                priority=PRIORITY_MANUAL,
             )
+            if scheduler.remaining_requests is not None and \
+                    scheduler.remaining_requests <= scheduler.reserves[PRIORITY_MANUAL]:
+                msg = "⏳ Travis request quota is low (%s left), `%s` is queued. See `.queue` for details." % (
+                    scheduler.remaining_requests, cmd)
+                await ctx.send(msg)
+            remaining_requests, request_id = await future
             msg = "✅ Successfully created build request `%s` for `%s` (remaining requests: %s)" % (request_id, cmd, remaining_requests)
             await ctx.send(msg)
 
-            while True:
-                await sleep(3)
-                r = client.get_request(request_id)
-                builds = r["builds"]
-                if len(builds) > 0:
-                    build_urls = []
-                    for build in builds:
-                        url = "https://travis-ci.org/github/ExchangeUnion/xud-docker/builds/%s" % build["id"]
-                        build_urls.append(url)
-                    msg = "✅ Successfully triggered builds for `%s`:\n%s" % (
-                        cmd,
-                        "\n".join(["<{}>".format(url) for url in build_urls])
-                    )
-                    await ctx.send(msg)
-                    break
+            # The scheduler tracks the request, wait for its tracker to see the builds
+            try:
+                builds = await client.wait_for_builds(request_id, BUILDS_TIMEOUT)
+            except asyncio.TimeoutError:
+                msg = "⏳ Travis has not created builds for request `%s` (`%s`) after %d seconds" % (
+                    request_id, cmd, BUILDS_TIMEOUT)
+                await ctx.send(msg)
+                return
+            except TravisClientError as e:
+                msg = "🚨 Failed to get builds of request `%s` (`%s`): %s" % (request_id, cmd, e)
+                await ctx.send(msg)
+                return
+            if len(builds) == 0:
+                msg = "🚨 Travis did not create any builds for request `%s` (`%s`)" % (request_id, cmd)
+                await ctx.send(msg)
+                return
+            build_urls = ["https://travis-ci.org/github/ExchangeUnion/xud-docker/builds/%s" % b for b in builds]
+            msg = "✅ Successfully triggered builds for `%s`:\n%s" % (
+                cmd,
+                "\n".join(["<{}>".format(url) for url in build_urls])
+            )
+            await ctx.send(msg)
 
         except TravisClientError as e:
             msg = "🚨 Failed to create build request for `%s`: %s" % (cmd, e)
@@ -130,3 +149,23 @@ class TravisCog(BaseCog, name="Travis Category"):
         if ctx.message.channel.id != self.context.config.discord.channel:
             return
         await self.build(ctx, "xud")
+
+    @commands.command(brief="Show pending Travis build requests")
+    async def queue(self, ctx: Context):
+        if ctx.message.channel.id != self.context.config.discord.channel:
+            return
+        scheduler = self.context.build_scheduler
+        remaining = scheduler.remaining_requests
+        if remaining is None:
+            remaining = "unknown"
+        requests = scheduler.get_queue()
+        msg = "**{}** pending build request(s), remaining Travis requests: **{}**".format(len(requests), remaining)
+        for r in requests:
+            if r.holds:
+                state = "verifying"
+            elif scheduler.is_deferred(r):
+                state = "deferred"
+            else:
+                state = "batching"
+            msg += "\n• **{}** ({}, {}): {}".format(r.branch, PRIORITY_NAMES[r.priority], state, ", ".join(r.images))
+        await ctx.send(msg)
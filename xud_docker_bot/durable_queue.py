@@ -0,0 +1,85 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Optional, Tuple
+
+DEFAULT_PATH = os.path.expanduser("~/.xud-docker-bot/queue.db")
+
+
+def get_partition(key: str, partitions: int) -> int:
+    """Get the partition of a key, stable across processes and restarts"""
+    return zlib.crc32(key.encode()) % partitions
+
+
+class DurableQueue:
+    """A queue in a SQLite database shared by the processes of a multi-process deployment.
+
+    Items are put into a partition and claimed by the consumer of that partition in order. Claimed items are deleted
+    once acknowledged. Items which are not acknowledged within visibility_timeout seconds (e.g. the consumer crashed)
+    can be claimed again.
+    """
+
+    def __init__(self, name: str, path: str = DEFAULT_PATH, visibility_timeout: float = 600):
+        self.name = name
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        # Consumers call the queue from executor threads, the connection is shared and serialized
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            partition INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            claimed_at REAL
+        )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS queue_partition ON queue (name, partition, id)")
+
+    def put(self, payload: Any, partition: int = 0) -> None:
+        with self._lock:
+            self._db.execute("INSERT INTO queue (name, partition, payload) VALUES (?, ?, ?)",
+                             (self.name, partition, json.dumps(payload)))
+
+    def claim(self, partition: int = 0) -> Optional[Tuple[int, Any]]:
+        """Claim the oldest unclaimed item of the partition. Returns (item id, payload) or None if there is none."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT id, payload FROM queue WHERE name = ? AND partition = ? "
+                    "AND (claimed_at IS NULL OR claimed_at < ?) ORDER BY id LIMIT 1",
+                    (self.name, partition, now - self.visibility_timeout)).fetchone()
+                if row:
+                    self._db.execute("UPDATE queue SET claimed_at = ? WHERE id = ?", (now, row[0]))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return row[0], json.loads(row[1])
+
+    def ack(self, item_id: int) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM queue WHERE id = ?", (item_id,))
+
+    def renew(self, item_id: int) -> None:
+        """Extend the claim of an item which is still being processed, so that it is not claimed again"""
+        with self._lock:
+            self._db.execute("UPDATE queue SET claimed_at = ? WHERE id = ?", (time.time(), item_id))
+
+    def release(self, partition: int = 0) -> None:
+        """Make all claimed items of the partition available again, e.g. when its consumer restarts"""
+        with self._lock:
+            self._db.execute("UPDATE queue SET claimed_at = NULL WHERE name = ? AND partition = ?",
+                             (self.name, partition))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM queue WHERE name = ?", (self.name,)).fetchone()[0]
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+DEFAULT_PATH = os.path.expanduser("~/.xud-docker-bot/journal.log")
+
+# Events which failed this many times are not replayed again
+MAX_ATTEMPTS = 3
+
+
+@dataclass
+class JournalEntry:
+    event_id: int
+    hook: str
+    body: str
+    attempts: int = 0  # failed attempts so far
+
+
+class EventJournal:
+    """Append-only journal of accepted webhook events.
+
+    Every record is a JSON line. "accept" records carry the event, "done" and "failed" records mark its outcome.
+    Appends are buffered for flush_delay seconds and written with a single fsync per batch, each append returns
+    once its batch is on disk.
+
+    On start, open() returns the events which are neither done nor failed MAX_ATTEMPTS times, so that they can be
+    replayed, and compacts the journal down to them.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH, flush_delay: float = 0.01):
+        self._logger = logging.getLogger("xud_docker_bot.EventJournal")
+        self.path = path
+        self.flush_delay = flush_delay
+        self._next_id = 1
+        self._file = None
+        self._buffer: List[str] = []
+        self._flushed: Optional[asyncio.Future] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[int, JournalEntry]:
+        entries: Dict[int, JournalEntry] = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn write of the last batch before a crash, it was never acknowledged
+                    continue
+                event_id = record["id"]
+                self._next_id = max(self._next_id, event_id + 1)
+                op = record["op"]
+                if op == "accept":
+                    entries[event_id] = JournalEntry(event_id, record["hook"], record["body"], record["attempts"])
+                elif op == "done":
+                    entries.pop(event_id, None)
+                elif op == "failed" and event_id in entries:
+                    entries[event_id].attempts += 1
+                    if entries[event_id].attempts >= MAX_ATTEMPTS:
+                        self._logger.error("Give up %s event %s after %d attempts: %s", entries[event_id].hook,
+                                           event_id, MAX_ATTEMPTS, record.get("error"))
+                        del entries[event_id]
+        return entries
+
+    def open(self) -> List[JournalEntry]:
+        """Load the events to replay and compact the journal. Call once before appending."""
+        entries = list(self._load().values())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for entry in entries:
+                f.write(self._format_accept(entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a")
+        if entries:
+            self._logger.info("Replaying %d unfinished event(s)", len(entries))
+        return entries
+
+    def _format_accept(self, entry: JournalEntry) -> str:
+        return json.dumps({"op": "accept", "id": entry.event_id, "hook": entry.hook, "body": entry.body,
+                           "attempts": entry.attempts}) + "\n"
+
+    def _write_lines(self, lines: List[str]) -> None:
+        if not lines:
+            return
+        with self._lock:
+            self._file.write("".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    async def _flush(self) -> None:
+        lines, self._buffer = self._buffer, []
+        future, self._flushed = self._flushed, None
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_lines, lines)
+            future.set_result(None)
+        except Exception as e:
+            self._logger.exception("Failed to write %d journal record(s)", len(lines))
+            future.set_exception(e)
+
+    async def _append(self, line: str) -> None:
+        self._buffer.append(line)
+        if not self._flushed:
+            loop = asyncio.get_running_loop()
+            self._flushed = loop.create_future()
+            loop.call_later(self.flush_delay, lambda: loop.create_task(self._flush()))
+        await asyncio.shield(self._flushed)
+
+    async def accept(self, hook: str, body: str) -> JournalEntry:
+        entry = JournalEntry(self._next_id, hook, body)
+        self._next_id += 1
+        await self._append(self._format_accept(entry))
+        return entry
+
+    async def mark_done(self, entry: JournalEntry) -> None:
+        await self._append(json.dumps({"op": "done", "id": entry.event_id}) + "\n")
+
+    async def mark_failed(self, entry: JournalEntry, error: str) -> None:
+        await self._append(json.dumps({"op": "failed", "id": entry.event_id, "error": error}) + "\n")
+
+    def close(self) -> None:
+        if self._buffer:
+            self._write_lines(self._buffer)
+            self._buffer = []
+        if self._file:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,149 @@
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Set
+
+from xud_docker_bot.clients import DockerhubClient
+
+ARCH_SUFFIXES = ["__x86_64", "__aarch64"]
+
+
+def get_base_tag(tag: str) -> str:
+    """Get the multi-arch tag of a per-arch tag, like "latest__feat-foo" for "latest__feat-foo__x86_64" """
+    for suffix in ARCH_SUFFIXES:
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)]
+    return tag
+
+
+def get_tag_branch(tag: str) -> str:
+    """Get the xud-docker branch of a tag, like "feat-foo" for "latest__feat-foo__x86_64" """
+    parts = get_base_tag(tag).split("__", 1)
+    if len(parts) == 2:
+        return parts[1]
+    return "master"
+
+
+@dataclass
+class Usage:
+    name: str
+    tags: List[str] = field(default_factory=list)
+    unique: int = 0  # bytes freed when all tags are removed
+    shared: int = 0  # bytes still referenced by other tags
+
+
+@dataclass
+class RepoLayers:
+    # tag -> manifest digest the layers were indexed from
+    digests: Dict[str, str] = field(default_factory=dict)
+    # tag -> layer digest -> size
+    tag_layers: Dict[str, Dict[str, int]] = field(default_factory=dict)
+    # layer digest -> tags
+    layer_tags: Dict[str, Set[str]] = field(default_factory=dict)
+
+    def remove(self, tag: str) -> None:
+        self.digests.pop(tag, None)
+        for layer in self.tag_layers.pop(tag, {}):
+            tags = self.layer_tags[layer]
+            tags.discard(tag)
+            if not tags:
+                del self.layer_tags[layer]
+
+    def put(self, tag: str, digest: str, layers: Dict[str, int]) -> None:
+        self.remove(tag)
+        self.digests[tag] = digest
+        self.tag_layers[tag] = layers
+        for layer in layers:
+            self.layer_tags.setdefault(layer, set()).add(tag)
+
+
+class LayerIndex:
+    """Map layer digests to the tags using them, so that the storage of a repository can be split into bytes
+    unique to a tag (or branch) and bytes shared with others.
+
+    The index is built from the manifests cached by DockerhubClient and only tags whose digest changed are indexed
+    again.
+    """
+
+    def __init__(self, dockerhub_client: DockerhubClient):
+        self._logger = logging.getLogger("xud_docker_bot.LayerIndex")
+        self.dockerhub_client = dockerhub_client
+        self._repos: Dict[str, RepoLayers] = {}
+        self._lock = threading.Lock()
+
+    def _index_tag(self, repo: str, tag: str) -> None:
+        client = self.dockerhub_client
+        images = client.get_images(repo, tag)
+        digest = client.tag_digests.get((repo, tag))
+        with self._lock:
+            layers = self._repos.setdefault(repo, RepoLayers())
+            if not digest:
+                layers.remove(tag)
+                return
+            if layers.digests.get(tag) == digest:
+                return
+            layers.put(tag, digest, {layer.digest: layer.size for img in images for layer in img.layers})
+
+    def update(self, repo: str) -> None:
+        """Index new or moved tags of the repository and forget removed ones. Manifest pulls are not urgent and wait
+        for rate limit budget.
+        """
+        with self.dockerhub_client.rate_limit.background():
+            self._update(repo)
+
+    def _update(self, repo: str) -> None:
+        tags = {t.name for t in self.dockerhub_client.get_tags(repo)}
+        with self._lock:
+            layers = self._repos.setdefault(repo, RepoLayers())
+            for tag in set(layers.digests) - tags:
+                layers.remove(tag)
+        for tag in tags:
+            try:
+                self._index_tag(repo, tag)
+            except Exception:
+                self._logger.exception("Failed to index layers of %s:%s", repo, tag)
+
+    def add_tag(self, repo: str, tag: str) -> None:
+        """Index a newly pushed tag. Repositories which have never been indexed are skipped."""
+        if repo in self._repos:
+            self._index_tag(repo, tag)
+
+    def _get_usage(self, layers: RepoLayers, name: str, tags: List[str]) -> Usage:
+        usage = Usage(name, sorted(tags))
+        tags = set(tags)
+        sizes = {}
+        for tag in tags:
+            sizes.update(layers.tag_layers[tag])
+        for layer, size in sizes.items():
+            if layers.layer_tags[layer] <= tags:
+                usage.unique += size
+            else:
+                usage.shared += size
+        return usage
+
+    def get_tag_usage(self, repo: str) -> List[Usage]:
+        with self._lock:
+            layers = self._repos.get(repo, RepoLayers())
+            # A multi-arch tag references the layers of its per-arch tags, they are only freed together
+            tags: Dict[str, List[str]] = {}
+            for tag in layers.tag_layers:
+                tags.setdefault(get_base_tag(tag), []).append(tag)
+            result = [self._get_usage(layers, tag, arch_tags) for tag, arch_tags in tags.items()]
+        return sorted(result, key=lambda u: u.unique, reverse=True)
+
+    def get_branch_usage(self, repo: str) -> List[Usage]:
+        with self._lock:
+            layers = self._repos.get(repo, RepoLayers())
+            branches: Dict[str, List[str]] = {}
+            for tag in layers.tag_layers:
+                branches.setdefault(get_tag_branch(tag), []).append(tag)
+            result = [self._get_usage(layers, branch, tags) for branch, tags in branches.items()]
+        return sorted(result, key=lambda u: u.unique, reverse=True)
+
+    def get_total_size(self, repo: str) -> int:
+        with self._lock:
+            layers = self._repos.get(repo, RepoLayers())
+            sizes = {}
+            for tag_layers in layers.tag_layers.values():
+                sizes.update(tag_layers)
+            return sum(sizes.values())
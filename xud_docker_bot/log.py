@@ -0,0 +1,119 @@
+import atexit
+import contextvars
+import copy
+import functools
+import json
+import logging
+import queue
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Callable, Dict, Optional
+
+DEFAULT_FILENAME = "bot.log"
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+# Correlation ids (like the webhook event id and the xud-docker ref) of the work in progress
+_log_context: contextvars.ContextVar[Dict[str, object]] = contextvars.ContextVar("log_context", default={})
+
+_listener: Optional[QueueListener] = None
+
+_exception_formatter = logging.Formatter()
+
+
+@contextmanager
+def log_context(**ids):
+    """Add correlation ids to the records logged in this context, including tasks created in it"""
+    token = _log_context.set({**_log_context.get(), **ids})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def in_log_context(fn: Callable, *args) -> Callable:
+    """Bind fn to the current correlation ids, for run_in_executor which does not copy the context"""
+    return functools.partial(contextvars.copy_context().run, fn, *args)
+
+
+class Lazy:
+    """Build a large log argument only when the record is written, e.g. Lazy("\\n".join, lines) with %s"""
+
+    def __init__(self, fn: Callable, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": "%s.%03d" % (self.formatTime(record, "%Y-%m-%d %H:%M:%S"), record.msecs),
+            "level": record.levelname,
+            "process": record.process,
+            "thread": record.threadName,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", {}))
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        elif record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class ContextQueueHandler(QueueHandler):
+    def format(self, record: logging.LogRecord) -> str:
+        # The exception is kept apart for the "exception" field
+        return record.getMessage()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Format the message in the calling thread, while the arguments are as they were logged, and attach the
+        correlation ids of the calling thread. Only records with Lazy arguments are formatted by the listener thread.
+        """
+        context = _log_context.get()
+        if isinstance(record.args, tuple) and any(isinstance(arg, Lazy) for arg in record.args):
+            record = copy.copy(record)
+        else:
+            exc_text = _exception_formatter.formatException(record.exc_info) if record.exc_info else None
+            stack_info = record.stack_info
+            record = super().prepare(record)
+            record.exc_text, record.stack_info = exc_text, stack_info
+        record.context = context
+        return record
+
+
+def setup_logging(filename=DEFAULT_FILENAME, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT) -> None:
+    """Write JSON records to a size-rotated file from a background thread. Calling it again replaces the file."""
+    global _listener
+    if _listener:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+
+    records = queue.Queue()
+    file_handler = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, ContextQueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(ContextQueueHandler(records))
+    root.setLevel(logging.ERROR)
+    logging.getLogger("xud_docker_bot").setLevel(logging.DEBUG)
+
+    _listener = QueueListener(records, file_handler, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def _stop_listener():
+    # Write the records still in the queue
+    if _listener:
+        _listener.stop()
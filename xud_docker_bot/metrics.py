@@ -0,0 +1,29 @@
+import logging
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# name -> (help, function returning the current value or None if unknown)
+_gauges: Dict[str, Tuple[str, Callable[[], Optional[float]]]] = {}
+
+
+def register_gauge(name: str, help: str, fn: Callable[[], Optional[float]]) -> None:
+    """Register a gauge whose value is read from fn whenever the metrics are scraped"""
+    _gauges[name] = (help, fn)
+
+
+def render() -> str:
+    """Render all gauges in the Prometheus text exposition format"""
+    lines = []
+    for name, (help, fn) in sorted(_gauges.items()):
+        try:
+            value = fn()
+        except Exception:
+            logger.exception("Failed to read gauge %s", name)
+            continue
+        if value is None:
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value:g}")
+    return "\n".join(lines) + "\n"
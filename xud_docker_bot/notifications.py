@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Iterable
+
+from .clients.policy import CircuitBreaker, add_breaker_listener
+from .discord import get_breaker_message
+from .durable_queue import DurableQueue
+
+if TYPE_CHECKING:
+    from .discord import DiscordTemplate
+
+NOTIFICATIONS = "notifications"
+
+
+class NotificationPublisher:
+    """Stand-in for DiscordTemplate in worker processes. Messages are put into the notification queue and sent by
+    the gateway process, the only one connected to Discord.
+    """
+
+    def __init__(self, queue: DurableQueue):
+        self._logger = logging.getLogger("xud_docker_bot.NotificationPublisher")
+        self.queue = queue
+        add_breaker_listener(self._on_breaker_state_change)
+
+    def _on_breaker_state_change(self, breaker: CircuitBreaker, previous: str):
+        msg = get_breaker_message(breaker, previous)
+        if msg:
+            self.publish_message(msg)
+
+    def is_ready(self) -> bool:
+        # Messages are kept in the queue until the gateway is connected
+        return True
+
+    def publish_message(self, message: str, reactions: Iterable[str] = ()):
+        self.queue.put({"message": message, "reactions": list(reactions)})
+
+
+async def forward_notifications(queue: DurableQueue, discord_template: DiscordTemplate, poll_interval: float = 0.5):
+    """Send the messages published by worker processes to Discord"""
+    logger = logging.getLogger("xud_docker_bot.notifications")
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await loop.run_in_executor(None, queue.claim)
+        if not item:
+            await asyncio.sleep(poll_interval)
+            continue
+        item_id, payload = item
+        try:
+            await discord_template.publish_message_async(payload["message"], payload["reactions"])
+        except Exception:
+            logger.exception("Failed to send notification: %r", payload)
+        await loop.run_in_executor(None, queue.ack, item_id)
@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from typing import List, Dict, Optional
+
+from .clients import DockerhubClient, TravisClient
+from .config import Config
+from .xud_docker import XudDockerRepo, Retag
+
+
+@dataclass
+class RefPlan:
+    ref: str
+    revision: Optional[str] = None
+    commit_message: Optional[str] = None
+    images: List[str] = field(default_factory=list)
+    retags: List[Dict[str, str]] = field(default_factory=list)
+    seconds: float = 0
+    error: Optional[str] = None
+    request_id: Optional[int] = None
+
+
+class Planner:
+    """Work out what to build for many xud-docker refs at once, e.g. after a registry outage or a Travis incident.
+
+    The repository is fetched once, then refs are analysed in parallel. They share the registry and git caches of a
+    single DockerhubClient and XudDockerRepo, and utils images are built in separate worktrees.
+    """
+
+    def __init__(self, config: Config, jobs: int = 4):
+        self._logger = logging.getLogger("xud_docker_bot.Planner")
+        self.dockerhub_client = DockerhubClient(
+            config.dockerhub.username, config.dockerhub.password, auth_url=config.dockerhub.auth_url,
+            registry_url=config.dockerhub.registry_url, hub_url=config.dockerhub.hub_url,
+            mirror_url=config.dockerhub.mirror_url)
+        self.dockerhub_client.rate_limit.reserve = config.dockerhub.pull_reserve
+        self.travis_client = TravisClient(config.travis.api_token)
+        repo_dir = os.path.expanduser("~/.xud-docker-bot/xud-docker")
+        self.xud_docker = XudDockerRepo(repo_dir, self.dockerhub_client, config.xud_docker.repo_url)
+        self.jobs = jobs
+
+    def get_all_refs(self) -> List[str]:
+        """Get master and every branch which has not been merged into master yet"""
+        return ["refs/heads/" + branch for branch in self.xud_docker.dependency_index.list_open_branches()]
+
+    def _plan_ref(self, ref) -> RefPlan:
+        start = time.monotonic()
+        plan = RefPlan(ref)
+        try:
+            # Leave the pull rate limit reserve to the bot analysing live pushes
+            with self.dockerhub_client.rate_limit.background():
+                git_ref, images, retags = self.xud_docker.get_modified_images(ref, fetch=False)
+            plan.revision = git_ref.revision
+            plan.commit_message = git_ref.commit_message
+            plan.images = images
+            plan.retags = [retag._asdict() for retag in retags]
+        except Exception as e:
+            self._logger.exception("Failed to plan xud-docker %s", ref)
+            plan.error = str(e) or repr(e)
+        plan.seconds = round(time.monotonic() - start, 3)
+        return plan
+
+    def plan(self, refs: List[str]) -> List[RefPlan]:
+        with ThreadPoolExecutor(self.jobs) as executor:
+            return list(executor.map(self._plan_ref, refs))
+
+    def submit(self, plans: List[RefPlan]) -> None:
+        """Retag and trigger Travis builds of the planned refs. Images which fail to retag are built instead."""
+        for plan in plans:
+            if plan.error:
+                continue
+            branch = plan.ref.replace("refs/heads/", "")
+            images = list(plan.images)
+            for retag in [Retag(**r) for r in plan.retags]:
+                try:
+                    self.dockerhub_client.copy_manifest(f"exchangeunion/{retag.image}", retag.digest, retag.tag)
+                    self.xud_docker.record_published(retag.image, retag.tag, retag.tree, retag.digest)
+                except Exception:
+                    self._logger.exception("Failed to retag exchangeunion/%s:%s as %s", retag.image,
+                                           retag.source_tag, retag.tag)
+                    images.append(f"{retag.image}:latest")
+            if len(images) == 0:
+                continue
+            try:
+                _, plan.request_id = self.travis_client.trigger_travis_build2(
+                    branch, plan.commit_message, images, track=False)
+            except Exception as e:
+                self._logger.exception("Failed to create Travis build request for branch %s", branch)
+                plan.error = str(e) or repr(e)
+
+
+def run(config: Config, refs: List[str], all_branches=False, jobs=4, submit=False) -> None:
+    """Print the build plan of the refs (branch names or refs/heads/...) as JSON"""
+    start = time.monotonic()
+    planner = Planner(config, jobs)
+    planner.xud_docker.ensure_repo()
+    if all_branches:
+        refs = planner.get_all_refs()
+    else:
+        refs = [ref if ref.startswith("refs/") else "refs/heads/" + ref for ref in refs]
+
+    plans = planner.plan(refs)
+    if submit:
+        planner.submit(plans)
+
+    json.dump({
+        "refs": [asdict(plan) for plan in plans],
+        "seconds": round(time.monotonic() - start, 3),
+    }, sys.stdout, indent=2)
+    sys.stdout.write("\n")
@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set, Tuple
+
+from .xud_docker import get_branch_tag
+
+if TYPE_CHECKING:
+    from .context import Context
+
+
+# Build request priorities, lower values are dispatched first
+PRIORITY_MASTER = 0
+PRIORITY_PR = 1
+PRIORITY_BRANCH = 2
+PRIORITY_MANUAL = 3
+
+# Platforms of this many recently dispatched tags are kept for the Docker Hub push notifications
+MAX_DISPATCHED_TAGS = 1000
+
+PRIORITY_NAMES = {
+    PRIORITY_MASTER: "master",
+    PRIORITY_PR: "pr",
+    PRIORITY_BRANCH: "branch",
+    PRIORITY_MANUAL: "manual",
+}
+
+
+@dataclass
+class BuildRequest:
+    branch: str
+    priority: int
+    due: float  # loop time when the batch window closes
+    images: List[str] = field(default_factory=list)
+    messages: List[str] = field(default_factory=list)
+    platforms: Optional[List[str]] = None
+    futures: List[asyncio.Future] = field(default_factory=list)
+    # image -> futures of the submissions which requested it
+    owners: Dict[str, List[asyncio.Future]] = field(default_factory=dict)
+    # futures of submissions which keep the request from being dispatched until they are verified
+    holds: Set[asyncio.Future] = field(default_factory=set)
+
+    def merge(self, images: List[str], message: str, platforms: Optional[List[str]]) -> None:
+        for image in images:
+            if image not in self.images:
+                self.images.append(image)
+        if message and message not in self.messages:
+            self.messages.append(message)
+        if self.platforms is None or platforms is None:
+            # None means all platforms
+            self.platforms = None
+        else:
+            self.platforms = self.platforms + [p for p in platforms if p not in self.platforms]
+
+    @property
+    def message(self) -> str:
+        return "\n".join(self.messages)
+
+
+def get_priority(branch: str, pulls) -> int:
+    """Get the priority of a branch build, pulls are the branches with an open PR"""
+    if branch == "master":
+        return PRIORITY_MASTER
+    elif branch in pulls:
+        return PRIORITY_PR
+    else:
+        return PRIORITY_BRANCH
+
+
+def consume_exception(future: asyncio.Future) -> None:
+    # Most submitters never await the result, failures are already logged and reported by the scheduler
+    if not future.cancelled():
+        future.exception()
+
+
+class BuildScheduler:
+    """Batch and prioritize Travis build requests.
+
+    Images requested for the same branch within the batch window are merged into a single "tools/push" invocation
+    so that a burst of pushes costs one Travis request instead of one per push.
+
+    Requests are dispatched by priority: master, then branches with an open PR, then other branches and finally
+    manual builds. The remaining Travis request quota reported by the API is tracked, and once it drops to the
+    reserve of a priority, requests of that priority stay queued (and keep merging) until the quota resets. Master
+    builds are never deferred.
+    """
+
+    def __init__(self, context: Context):
+        self._logger = logging.getLogger("xud_docker_bot.BuildScheduler")
+        self.context = context
+        config = context.config.travis
+        self.window = config.batch_window
+        self.quota_reset = config.quota_reset
+        self.reserves = {
+            PRIORITY_MASTER: 0,
+            PRIORITY_PR: config.quota_reserve // 2,
+            PRIORITY_BRANCH: config.quota_reserve,
+            PRIORITY_MANUAL: config.quota_reserve,
+        }
+        self.remaining_requests: Optional[int] = None
+        self._quota_reset_at = 0.0
+        self._pending: Dict[str, BuildRequest] = {}
+        self._wakeup = asyncio.Event()
+        self.no_auto_cancel = set(config.no_auto_cancel)
+        # (repo, tag) -> platforms of the last build dispatched for the tag, None for all platforms
+        self._dispatched: "OrderedDict[Tuple[str, str], Optional[List[str]]]" = OrderedDict()
+        # Called with (repo, tag, platforms) for every dispatched tag, e.g. to tell worker processes
+        self.on_dispatched: Optional[Callable[[str, str, Optional[List[str]]], None]] = None
+        context.travis_client.on_superseded = self._on_superseded
+
+    def submit(
+            self,
+            branch: str,
+            images: List[str],
+            message: str,
+            platforms: List[str] = None,
+            priority: int = None,
+            hold: bool = False) -> asyncio.Future:
+        """Queue images of a branch to build. The returned future resolves to (remaining_requests, request_id) of
+        the Travis request that includes them. A held submission keeps the request from being dispatched until it
+        is released.
+        """
+        loop = self.context.loop
+        if priority is None:
+            priority = get_priority(branch, self.context.github_client.pulls)
+
+        future = loop.create_future()
+        future.add_done_callback(consume_exception)
+
+        # Somebody is waiting for manual builds, don't hold them for the batch window
+        due = loop.time() if priority == PRIORITY_MANUAL else loop.time() + self.window
+
+        request = self._pending.get(branch)
+        if request:
+            request.merge(images, message, platforms)
+            request.priority = min(request.priority, priority)
+            request.due = min(request.due, due)
+            self._logger.debug("Merged images %s into pending build request of branch %s: %s",
+                               ", ".join(images), branch, ", ".join(request.images))
+        else:
+            request = BuildRequest(branch, priority, due, platforms=list(platforms) if platforms else None)
+            request.merge(images, message, platforms)
+            self._pending[branch] = request
+            self._logger.debug("Scheduled build request of branch %s (priority %s): %s",
+                               branch, PRIORITY_NAMES[priority], ", ".join(request.images))
+        request.futures.append(future)
+        if hold:
+            request.holds.add(future)
+        for image in images:
+            request.owners.setdefault(image, []).append(future)
+        self._wakeup.set()
+        return future
+
+    async def withdraw(self, future: asyncio.Future, images: List[str]) -> List[str]:
+        """Withdraw images of a submission (identified by the future returned by submit) which turned out to be
+        unnecessary. Images also requested by other submissions stay. Returns the images removed from the pending
+        request, nothing can be withdrawn once the request is dispatched.
+        """
+        request = next((r for r in self._pending.values() if future in r.futures), None)
+        if not request:
+            return []
+        withdrawn = []
+        for image in images:
+            owners = request.owners.get(image, [])
+            if future not in owners:
+                continue
+            owners.remove(future)
+            if not owners:
+                del request.owners[image]
+                request.images.remove(image)
+                withdrawn.append(image)
+        if not any(future in owners for owners in request.owners.values()):
+            request.futures.remove(future)
+            request.holds.discard(future)
+            future.cancel()
+        if not request.images:
+            del self._pending[request.branch]
+            for f in request.futures:
+                f.cancel()
+        if withdrawn:
+            self._logger.debug("Withdrew images %s from pending build request of branch %s",
+                               ", ".join(withdrawn), request.branch)
+        return withdrawn
+
+    async def release(self, future: asyncio.Future) -> None:
+        """Let the request of a held submission be dispatched"""
+        for request in self._pending.values():
+            if future in request.holds:
+                request.holds.discard(future)
+                self._wakeup.set()
+
+    def flush(self) -> None:
+        """Dispatch pending requests without waiting for their batch window, e.g. on shutdown. Requests deferred
+        because of the quota stay pending.
+        """
+        now = self.context.loop.time()
+        for request in self._pending.values():
+            request.due = min(request.due, now)
+        self._wakeup.set()
+
+    def is_deferred(self, request: BuildRequest) -> bool:
+        if self.remaining_requests is None:
+            return False
+        if self.context.loop.time() >= self._quota_reset_at:
+            # Assume the quota is back, the next response tells us the real value
+            self.remaining_requests = None
+            return False
+        return self.remaining_requests <= self.reserves[request.priority]
+
+    def _record_dispatched(self, request: BuildRequest) -> None:
+        for image in request.images:
+            repo, _, tag = image.partition(":")
+            key = (repo, get_branch_tag(request.branch, tag or "latest"))
+            self._dispatched.pop(key, None)
+            self._dispatched[key] = request.platforms
+            if self.on_dispatched:
+                self.on_dispatched(*key, request.platforms)
+        while len(self._dispatched) > MAX_DISPATCHED_TAGS:
+            self._dispatched.popitem(last=False)
+
+    def get_platforms(self, repo: str, tag: str) -> Optional[List[str]]:
+        """Get the platforms the last dispatched build of the tag (like "xud", "latest__foo") pushes. Returns None
+        for all platforms, or if no build of the tag was dispatched by this scheduler.
+        """
+        return self._dispatched.get((repo, tag))
+
+    def get_queue(self) -> List[BuildRequest]:
+        return sorted(self._pending.values(), key=lambda r: (r.priority, r.due))
+
+    async def run(self):
+        loop = self.context.loop
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+            next_due = None
+            for request in self.get_queue():
+                if request.holds:
+                    # Released later, which wakes the loop up
+                    continue
+                if request.due > now:
+                    next_due = min(next_due or request.due, request.due)
+                    continue
+                if self.is_deferred(request):
+                    next_due = min(next_due or self._quota_reset_at, self._quota_reset_at)
+                    continue
+                del self._pending[request.branch]
+                await self._dispatch(request)
+
+            timeout = None if next_due is None else max(next_due - loop.time(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _update_quota(self, remaining_requests: int) -> None:
+        if self.remaining_requests is None:
+            self._quota_reset_at = self.context.loop.time() + self.quota_reset
+        self.remaining_requests = remaining_requests
+
+    async def _dispatch(self, request: BuildRequest) -> None:
+        branch = request.branch
+        try:
+            client = self.context.travis_client
+            result: Tuple[int, int] = client.trigger_travis_build2(
+                branch, request.message, request.images, platforms=request.platforms)
+            remaining_requests, request_id = result
+            self._update_quota(remaining_requests)
+            self._record_dispatched(request)
+            self._logger.debug("Created Travis build request %s for branch %s images: %s (%s request(s) left)",
+                               request_id, branch, ", ".join(request.images), remaining_requests)
+            if branch not in self.no_auto_cancel:
+                # The tracked requests are chosen here on the loop, only canceling them calls the Travis API
+                for tracked in client.supersede(branch, request_id):
+                    await self.context.loop.run_in_executor(
+                        None, client.cancel_superseded, tracked.branch, list(tracked.builds))
+            for future in request.futures:
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            self._logger.exception("Failed to create Travis build request for branch %s images: %s",
+                                   branch, ", ".join(request.images))
+            self.context.discord_template.publish_message(
+                "🚨 Failed to create Travis build request for branch **{}**: {}".format(
+                    branch, ", ".join(request.images)))
+            for future in request.futures:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _on_superseded(self, branch: str, build_ids: List[int]) -> None:
+        self.context.loop.call_soon_threadsafe(
+            self.context.discord_template.publish_message,
+            "🚫 Canceled superseded Travis build(s) of branch **{}**:\n{}".format(
+                branch,
+                "\n".join("<https://travis-ci.org/github/ExchangeUnion/xud-docker/builds/{}>".format(b)
+                          for b in build_ids)))
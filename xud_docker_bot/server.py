@@ -2,54 +2,353 @@ from __future__ import annotations
 
 import asyncio
 import logging
-from typing import TYPE_CHECKING
+import multiprocessing
+import signal
+from typing import TYPE_CHECKING, Dict, List, Set
 
 from aiohttp import web
 
+from .build_queue import serve_builds, BUILDS, BUILD_RESULTS
 from .context import Context
-from .web_handles import index
+from .durable_queue import DurableQueue, get_partition
+from .journal import EventJournal, JournalEntry
+from .log import log_context, setup_logging
+from .notifications import forward_notifications, NOTIFICATIONS
+from .watchdog import collect_stalls, STALLS
+from .web_handles import index, ready, metrics
 from .webhooks import DockerhubHook, GithubHook, TravisHook
+from .webhooks.abc import Hook
 
 if TYPE_CHECKING:
     from .config import Config
 
+# Queue of webhook events accepted by worker processes
+EVENTS = "events"
+
+# Seconds between checks of the worker processes
+SUPERVISE_INTERVAL = 5
+
+# Events a worker processes at the same time, events of the same ref or tag are processed one after another
+MAX_EVENTS_IN_FLIGHT = 8
+
+
+def run_worker(config: Config, worker_index: int, workers: int, host: str, port: int) -> None:
+    """Entry point of worker processes"""
+    # Rotating one file from several processes would lose records
+    setup_logging("bot-worker-%d.log" % worker_index)
+    Server(config, workers=workers, worker_index=worker_index).run_worker(host, port)
+
 
 class Server:
-    def __init__(self, config: Config):
-        self.context = Context(config)
+    """Run the bot in one process, or as a gateway process with worker processes when workers > 0.
+
+    Worker processes share the HTTP port. They put webhook events into a durable queue partitioned by worker, and
+    each worker processes the events of its partition (events of the same ref or tag always go to the same worker).
+    The gateway process is the only one connected to Discord. It sends the messages workers put into the
+    notification queue and handles Discord commands.
+    """
+
+    def __init__(self, config: Config, workers: int = 0, worker_index: int = None):
+        self.context = Context(config, worker_index)
         self._logger = logging.getLogger("xud_docker_bot.Server")
+        self.workers = workers
+        self.worker_index = worker_index
+        self.github_hook = GithubHook(self.context)
+        self.dockerhub_hook = DockerhubHook(self.context)
+        self.hooks: Dict[str, Hook] = {
+            "dockerhub": self.dockerhub_hook,
+            "github": self.github_hook,
+            "travis": TravisHook(self.context),
+        }
+        self.journal = EventJournal()
+        self._accepting = True
+        self._in_flight: Set[asyncio.Task] = set()
+        # partition key -> last queued event of the key, the next one waits for it
+        self._last_of_key: Dict[str, asyncio.Task] = {}
+
+    async def _start_http(self, host, port, handlers, reuse_port=False) -> web.AppRunner:
+        app = web.Application()
+        app["context"] = self.context
+        app.add_routes([web.get("/", index), web.get("/ready", ready), web.get("/metrics", metrics)])
+        app.add_routes([web.post("/webhooks/" + name, handler) for name, handler in handlers.items()])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, host=host, port=port, reuse_port=reuse_port)
+        await site.start()
+        self._logger.info("HTTP Server start listening on %s:%d", host, port)
+        return runner
 
     def run(self, host, port):
+        if self.workers > 0:
+            self._run_gateway(host, port)
+            return
+
         self._logger.info("Starting...")
         loop = self.context.loop
-        app = web.Application()
-        app["context"] = self.context
+        try:
+            loop.run_until_complete(self._serve(host, port))
+        finally:
+            loop.close()
 
-        github_hook = GithubHook(self.context)
+    def _journaled(self, name):
+        async def handle(request: web.Request) -> web.Response:
+            if not self._accepting:
+                return web.Response(status=503)
+            body = await request.text()
+            # Acknowledged only once the event is on disk, it is processed in the background
+            entry = await self.journal.accept(name, body)
+            self._start_event(entry)
+            return web.Response()
 
-        app.add_routes([
-            web.get("/", index),
-            web.post("/webhooks/dockerhub", DockerhubHook(self.context).handle),
-            web.post("/webhooks/github", github_hook.handle),
-            web.post("/webhooks/travis", TravisHook(self.context).handle),
-        ])
-        runner = web.AppRunner(app)
-        loop.run_until_complete(runner.setup())
-        site = web.TCPSite(runner, host=host, port=port)
+        return handle
 
-        self._logger.info("HTTP Server start listening on %s:%d", host, port)
+    def _start_event(self, entry: JournalEntry) -> None:
+        task = self.context.loop.create_task(self._process_event(entry))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _process_event(self, entry: JournalEntry) -> None:
+        try:
+            with log_context(event=entry.event_id, hook=entry.hook):
+                await self.hooks[entry.hook].process(entry.body)
+        except asyncio.CancelledError:
+            # Interrupted by the shutdown, the event is replayed on start
+            raise
+        except Exception as e:
+            self._logger.exception("Failed to process %s event %s", entry.hook, entry.event_id)
+            await self.journal.mark_failed(entry, repr(e))
+            return
+        await self.journal.mark_done(entry)
 
+    async def _serve(self, host, port):
+        loop = self.context.loop
         token = self.context.config.discord.token
         assert token
         bot = self.context.discord_template.bot
 
+        stop = self._add_signal_handlers()
+
+        replay = await loop.run_in_executor(None, self.journal.open)
+        # Start listening before anything slow so that webhooks are accepted (and journaled) right away
+        runner = await self._start_http(host, port, {name: self._journaled(name) for name in self.hooks})
+        for entry in replay:
+            self._start_event(entry)
+
+        tasks = [loop.create_task(coro) for coro in [
+            bot.start(token),
+            self.github_hook.init_repo(),
+            self.github_hook.process_queue(),
+            self.context.build_scheduler.run(),
+            self.context.loop_watchdog.run(),
+        ]]
+        await self._run_until_stopped(tasks, stop)
+        await self._shutdown(runner, tasks + [stop])
+
+    async def _shutdown(self, runner: web.AppRunner, tasks: List[asyncio.Task]) -> None:
+        """Stop accepting events, drain in-flight ones up to the shutdown timeout and leave the rest in the journal
+        (or the event queue of workers)
+        """
+        timeout = self.context.config.server.shutdown_timeout
+        self._logger.info("Shutting down, draining %d in-flight event(s) for up to %d seconds",
+                          len(self._in_flight), timeout)
+        self._accepting = False
+        await runner.cleanup()
+
+        # Don't hold builds and notifications for their batch windows any longer
+        self.context.build_scheduler.flush()
+        pending = set(self._in_flight) | set(self.dockerhub_hook.flush())
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout=timeout)
+        if pending:
+            self._logger.warning("%d event(s) not finished in time, they are processed again on start", len(pending))
+        await self._cancel(list(pending) + tasks)
+
+    async def _cancel(self, tasks: List[asyncio.Task]) -> None:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.worker_index is None:
+            bot = self.context.discord_template.bot
+            if bot.is_ready():
+                await bot.logout()
+        await self.context.github_client.close()
+        self.journal.close()
+        self._logger.info("Stopped")
+
+    def _add_signal_handlers(self) -> asyncio.Task:
+        """Returns a task which finishes on SIGINT or SIGTERM"""
+        stopping = asyncio.Event()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            self.context.loop.add_signal_handler(sig, stopping.set)
+        return self.context.loop.create_task(stopping.wait())
+
+    async def _run_until_stopped(self, tasks: List[asyncio.Task], stop: asyncio.Task) -> None:
+        await asyncio.wait(tasks + [stop], return_when=asyncio.FIRST_COMPLETED)
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.exception():
+                self._logger.error("Stopping because a background task failed", exc_info=task.exception())
+
+    def _start_worker(self, worker_index, host, port) -> multiprocessing.Process:
+        # Spawned instead of forked, the gateway has threads and an event loop already
+        process = multiprocessing.get_context("spawn").Process(
+            target=run_worker, args=(self.context.config, worker_index, self.workers, host, port),
+            name="worker-%d" % worker_index, daemon=True)
+        process.start()
+        self._logger.info("Started worker %d (pid %d)", worker_index, process.pid)
+        return process
+
+    async def _supervise(self, processes: List[multiprocessing.Process], host, port):
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    self._logger.error("Worker %d exited with code %s, restarting", i, process.exitcode)
+                    processes[i] = self._start_worker(i, host, port)
+
+    def _run_gateway(self, host, port):
+        self._logger.info("Starting gateway with %d worker(s)...", self.workers)
+        loop = self.context.loop
         try:
-            loop.run_until_complete(asyncio.gather(
-                site.start(),
-                bot.start(token),
-                github_hook.process_queue()
-            ))
-        except KeyboardInterrupt:
-            loop.run_until_complete(bot.logout())
+            loop.run_until_complete(self._serve_gateway(host, port))
         finally:
             loop.close()
+
+    async def _serve_gateway(self, host, port):
+        loop = self.context.loop
+        token = self.context.config.discord.token
+        assert token
+        bot = self.context.discord_template.bot
+
+        stop = self._add_signal_handlers()
+        processes = [self._start_worker(i, host, port) for i in range(self.workers)]
+        self.context.loop_watchdog.workers = self.workers
+        supervisor = loop.create_task(self._supervise(processes, host, port))
+        tasks = [loop.create_task(coro) for coro in [
+            bot.start(token),
+            forward_notifications(DurableQueue(NOTIFICATIONS), self.context.discord_template),
+            # Discord commands validate images against the repository and submit builds
+            self.github_hook.init_repo(),
+            self.context.build_scheduler.run(),
+            # Builds submitted by workers are batched and dispatched here
+            serve_builds(DurableQueue(BUILDS), DurableQueue(BUILD_RESULTS), self.context.build_scheduler,
+                         self.workers),
+            self.context.loop_watchdog.run(),
+            collect_stalls(DurableQueue(STALLS), self.context.loop_watchdog),
+        ]]
+        await self._run_until_stopped(tasks + [supervisor], stop)
+
+        # Workers drain their events while builds and notifications are still served here
+        supervisor.cancel()
+        timeout = self.context.config.server.shutdown_timeout
+        self._logger.info("Shutting down, stopping %d worker(s) within %d seconds", len(processes), timeout)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = loop.time() + timeout
+        while any(p.is_alive() for p in processes) and loop.time() < deadline:
+            # Submissions of draining workers don't wait for their batch windows
+            self.context.build_scheduler.flush()
+            await asyncio.sleep(0.5)
+        for i, process in enumerate(processes):
+            if process.is_alive():
+                self._logger.warning("Worker %d did not stop in time, killing it", i)
+                process.kill()
+            await loop.run_in_executor(None, process.join)
+        await self._cancel(tasks + [supervisor, stop])
+
+    def _intake(self, name, queue: DurableQueue):
+        hook = self.hooks[name]
+
+        async def handle(request: web.Request) -> web.Response:
+            if not self._accepting:
+                return web.Response(status=503)
+            body = await request.text()
+            try:
+                key = "{}:{}".format(name, hook.get_partition_key(body))
+            except Exception:
+                self._logger.debug("Failed to get the partition key of %s webhook", name)
+                key = name
+            partition = get_partition(key, self.workers)
+            await self.context.loop.run_in_executor(
+                None, queue.put, {"hook": name, "body": body, "key": key}, partition)
+            return web.Response()
+
+        return handle
+
+    async def _consume_events(self, queue: DurableQueue, poll_interval: float = 0.5):
+        loop = self.context.loop
+        partition = self.worker_index
+        slots = asyncio.Semaphore(MAX_EVENTS_IN_FLIGHT)
+        # Events claimed by a previous process of this worker were not processed
+        await loop.run_in_executor(None, queue.release, partition)
+        while True:
+            await slots.acquire()
+            item = await loop.run_in_executor(None, queue.claim, partition)
+            if not item:
+                slots.release()
+                await asyncio.sleep(poll_interval)
+                continue
+            item_id, payload = item
+            # Processing waits until builds are dispatched, only events of the same key wait for each other
+            key = payload.get("key", payload["hook"])
+            previous = self._last_of_key.get(key)
+            task = loop.create_task(self._process_queued_event(queue, item_id, payload, previous))
+            self._last_of_key[key] = task
+            self._in_flight.add(task)
+            task.add_done_callback(lambda t, k=key: self._on_queued_event_done(t, k, slots))
+
+    def _on_queued_event_done(self, task: asyncio.Task, key: str, slots: asyncio.Semaphore) -> None:
+        self._in_flight.discard(task)
+        if self._last_of_key.get(key) is task:
+            del self._last_of_key[key]
+        slots.release()
+
+    async def _renew_claim(self, queue: DurableQueue, item_id) -> None:
+        # Events can take longer than the visibility timeout, e.g. while builds wait for the Travis quota
+        while True:
+            await asyncio.sleep(queue.visibility_timeout / 3)
+            await self.context.loop.run_in_executor(None, queue.renew, item_id)
+
+    async def _process_queued_event(self, queue: DurableQueue, item_id, payload, previous: asyncio.Task = None):
+        renew = self.context.loop.create_task(self._renew_claim(queue, item_id))
+        try:
+            if previous:
+                await asyncio.wait([previous])
+            with log_context(event=item_id, hook=payload["hook"]):
+                await self.hooks[payload["hook"]].process(payload["body"])
+        except asyncio.CancelledError:
+            # Interrupted by the shutdown, the event is claimed again on start
+            raise
+        except Exception:
+            self._logger.exception("Failed to process %s webhook", payload["hook"])
+        finally:
+            renew.cancel()
+        await self.context.loop.run_in_executor(None, queue.ack, item_id)
+
+    def run_worker(self, host, port):
+        self._logger.info("Starting worker %d...", self.worker_index)
+        loop = self.context.loop
+        try:
+            loop.run_until_complete(self._serve_worker(host, port))
+        finally:
+            loop.close()
+
+    async def _serve_worker(self, host, port):
+        loop = self.context.loop
+        queue = DurableQueue(EVENTS)
+        stop = self._add_signal_handlers()
+        runner = await self._start_http(
+            host, port, {name: self._intake(name, queue) for name in self.hooks}, reuse_port=True)
+        consumer = loop.create_task(self._consume_events(queue))
+        tasks = [loop.create_task(coro) for coro in [
+            self.github_hook.init_repo(),
+            self.github_hook.process_queue(),
+            # Answers of the gateway to the submissions of draining events
+            self.context.build_scheduler.run(),
+            self.context.loop_watchdog.run(),
+        ]]
+        await self._run_until_stopped(tasks + [consumer], stop)
+        # Stop claiming events, the ones left in the queue are processed after the restart
+        consumer.cancel()
+        await self._shutdown(runner, tasks + [consumer, stop])
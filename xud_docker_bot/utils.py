@@ -1,13 +1,19 @@
 from subprocess import check_output, STDOUT, CalledProcessError
+from typing import List, Union
 import logging
+import shlex
 
 logger = logging.getLogger(__name__)
 
 
-def execute(cmd: str) -> str:
+def execute(cmd: Union[str, List[str]], cwd: str = None) -> str:
+    """Run a command and return its output. Pass an argument list for commands with untrusted arguments, it is run
+    without a shell.
+    """
     try:
-        output = check_output(cmd, shell=True, stderr=STDOUT)
+        output = check_output(cmd, shell=isinstance(cmd, str), stderr=STDOUT, cwd=cwd)
         return output.decode()
     except CalledProcessError as e:
-        logger.debug("Failed to execute command (exit code %d)\n$ %s\n%s", e.returncode, e.cmd, e.output.decode().strip())
+        line = e.cmd if isinstance(e.cmd, str) else " ".join(shlex.quote(arg) for arg in e.cmd)
+        logger.debug("Failed to execute command (exit code %d)\n$ %s\n%s", e.returncode, line, e.output.decode().strip())
         raise e
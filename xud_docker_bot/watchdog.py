@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Deque, List, Optional
+
+from .durable_queue import DurableQueue
+
+# Frames of this package point at the blocking call better than the innermost (library) frame
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Stalls kept for the .lag command
+MAX_STALLS = 10
+
+# Queue of the stalls of worker processes, collected by the gateway process
+STALLS = "stalls"
+
+
+@dataclass
+class Stall:
+    started_at: datetime
+    lag: float  # seconds the loop was blocked (so far, while the stall goes on)
+    culprit: str  # like "xud_docker_bot/webhooks/github.py:120 in _retag"
+    stack: List[str] = field(default_factory=list)
+    worker: Optional[int] = None  # index of the worker process whose loop was blocked, None for this process
+
+
+def _format_frame(frame: traceback.FrameSummary) -> str:
+    filename = frame.filename
+    if filename.startswith(PACKAGE_DIR):
+        filename = os.path.relpath(filename, os.path.dirname(PACKAGE_DIR))
+    return "{}:{} in {}".format(filename, frame.lineno, frame.name)
+
+
+def get_culprit(stack: traceback.StackSummary) -> str:
+    """Get the innermost frame of this package, the call which blocks the loop"""
+    for frame in reversed(stack):
+        if frame.filename.startswith(PACKAGE_DIR):
+            return _format_frame(frame)
+    return _format_frame(stack[-1])
+
+
+class LoopWatchdog:
+    """Measure the lag of the event loop and catch the calls which block it.
+
+    A heartbeat on the loop sleeps for interval seconds and measures how much later it wakes up. A helper thread checks
+    the heartbeat, and when it is overdue by more than threshold seconds, it samples the stack of the loop thread while
+    the loop is still blocked and records the innermost frame of this package as the culprit.
+
+    on_stall is called from the helper thread with every stall once the loop runs again. Worker processes use it to
+    report their stalls to the gateway process, which keeps them in worker_stalls.
+    """
+
+    def __init__(self, threshold: float = 0.5, interval: float = 0.1):
+        self._logger = logging.getLogger("xud_docker_bot.LoopWatchdog")
+        self.threshold = threshold
+        self.interval = interval
+        self.lag = 0.0  # of the last heartbeat
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.stalls: Deque[Stall] = deque(maxlen=MAX_STALLS)
+        self.workers = 0  # worker processes reporting their stalls to this one
+        self.worker_stall_count = 0
+        self.worker_stalls: Deque[Stall] = deque(maxlen=MAX_STALLS)
+        self.on_stall: Optional[Callable[[Stall], None]] = None
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._stopped = threading.Event()
+
+    async def run(self):
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        threading.Thread(target=self._monitor, name="LoopWatchdog", daemon=True).start()
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self.lag = max(now - self._beat - self.interval, 0)
+                self.max_lag = max(self.max_lag, self.lag)
+                self._beat = now
+        finally:
+            self._stopped.set()
+
+    def _monitor(self):
+        stall, stall_beat = None, None
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            lag = time.monotonic() - beat - self.interval
+            if stall and stall_beat != beat:
+                # The loop ran again
+                self._report(stall)
+                stall = None
+            if lag < self.threshold:
+                continue
+            if stall:
+                # Still blocked by the same call
+                stall.lag = lag
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            stall, stall_beat = Stall(datetime.now(), lag, get_culprit(stack), stack.format()), beat
+            self.stalls.append(stall)
+            self.stall_count += 1
+            self._logger.warning("Event loop blocked for %.2f seconds at %s\n%s", lag, stall.culprit,
+                                 "".join(stall.stack))
+        if stall:
+            self._report(stall)
+
+    def _report(self, stall: Stall):
+        if self.on_stall:
+            try:
+                self.on_stall(stall)
+            except Exception:
+                self._logger.exception("Failed to report event loop stall at %s", stall.culprit)
+
+    def add_worker_stall(self, stall: Stall):
+        self.worker_stalls.append(stall)
+        self.worker_stall_count += 1
+
+
+class StallPublisher:
+    """on_stall of the watchdog of a worker process, puts its stalls into the stall queue"""
+
+    def __init__(self, queue: DurableQueue, worker_index: int):
+        self.queue = queue
+        self.worker_index = worker_index
+
+    def __call__(self, stall: Stall):
+        self.queue.put({
+            "worker": self.worker_index,
+            "started_at": stall.started_at.isoformat(),
+            "lag": stall.lag,
+            "culprit": stall.culprit,
+        })
+
+
+async def collect_stalls(queue: DurableQueue, watchdog: LoopWatchdog, poll_interval: float = 0.5):
+    """Keep the stalls reported by worker processes for the .lag command of the gateway process"""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await loop.run_in_executor(None, queue.claim)
+        if not item:
+            await asyncio.sleep(poll_interval)
+            continue
+        item_id, payload = item
+        watchdog.add_worker_stall(Stall(datetime.fromisoformat(payload["started_at"]), payload["lag"],
+                                        payload["culprit"], worker=payload["worker"]))
+        await loop.run_in_executor(None, queue.ack, item_id)
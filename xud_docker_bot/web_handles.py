@@ -1,5 +1,22 @@
 from aiohttp import web
 
+from . import metrics as metrics_registry
+
 
 async def index(request):
     return web.Response(text="Welcome to xud-docker-bot!")
+
+
+async def ready(request):
+    context = request.app["context"]
+    subsystems = {
+        "http": True,
+        "discord": context.discord_template.is_ready(),
+        "xud_docker": context.xud_docker.ready,
+    }
+    status = 200 if all(subsystems.values()) else 503
+    return web.json_response(subsystems, status=status)
+
+
+async def metrics(request):
+    return web.Response(text=metrics_registry.render(), content_type="text/plain")
@@ -3,8 +3,9 @@ from typing import TYPE_CHECKING
 from abc import abstractmethod
 import logging
 
+from aiohttp import web
+
 if TYPE_CHECKING:
-    from aiohttp import web
     from ..context import Context
 
 
@@ -13,6 +14,14 @@ class Hook:
         self.logger = logging.getLogger("xud_docker_bot.webhooks." + self.__class__.__name__)
         self.context = context
 
-    @abstractmethod
     async def handle(self, request: web.Request) -> web.Response:
+        await self.process(await request.text())
+        return web.Response()
+
+    @abstractmethod
+    async def process(self, body: str) -> None:
         pass
+
+    def get_partition_key(self, body: str) -> str:
+        """Events with the same key are processed in order by the same worker process"""
+        return ""
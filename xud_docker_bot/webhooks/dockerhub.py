@@ -1,10 +1,11 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import TYPE_CHECKING
+import asyncio
+import json
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
 import humanize
-from aiohttp import web
 
 from .abc import Hook
 
@@ -23,7 +24,28 @@ class Image:
     app_revision: str
 
 
+# Per-arch tag suffix -> platform, a push is complete once the tags of all platforms of the build are pushed
+ARCH_SUFFIXES = {
+    "__x86_64": "linux/amd64",
+    "__aarch64": "linux/arm64",
+}
+
+
+@dataclass
+class PendingPush:
+    timer: asyncio.TimerHandle
+    suffixes: List[str]  # per-arch tag suffixes the build pushes
+    pushers: List[str] = field(default_factory=list)
+    arch_tags: List[str] = field(default_factory=list)
+
+
 class DockerhubHook(Hook):
+    def __init__(self, context):
+        super().__init__(context)
+        # (repo, tag without arch suffix) -> per-arch pushes seen so far
+        self._pending: Dict[Tuple[str, str], PendingPush] = {}
+        self.timeout = context.config.dockerhub.aggregate_timeout
+
     def normalize_pusher(self, pusher):
         if pusher == "reliveyy":
             pusher = "Yang"
@@ -61,25 +83,96 @@ class DockerhubHook(Hook):
         images = self.inspect_tag("exchangeunion/{}".format(repo), tag)
         return images
 
-    async def handle(self, request: web.Request) -> web.Response:
+    def _is_manifest_list_updated(self, repo, tag, arch_tags) -> bool:
+        """Check that the manifest list of the tag references the manifests of all pushed per-arch tags"""
+        client = self.context.dockerhub_client
+        manifest = client.get_manifest(repo, tag)
+        if not manifest:
+            return False
+        listed = {m["digest"] for m in manifest.payload.get("manifests", [])}
+        return all(client.get_manifest_digest(repo, t) in listed for t in arch_tags)
+
+    def parse_push(self, repo, tag, arch_tags) -> List[Image]:
+        """Inspect the multi-arch tag once. Fall back to the per-arch tags if the manifest list is not updated yet."""
+        try:
+            if self._is_manifest_list_updated("exchangeunion/{}".format(repo), tag, arch_tags):
+                return self.parse_tag(repo, tag)
+        except Exception:
+            self.logger.debug("Failed to inspect %s:%s, inspect per-arch tags instead", repo, tag)
+        images = []
+        for t in arch_tags:
+            images.extend(self.parse_tag(repo, t))
+        return images
+
+    def _strip_arch_suffix(self, tag):
+        for suffix in ARCH_SUFFIXES:
+            if tag.endswith(suffix):
+                return tag[:-len(suffix)]
+        return None
+
+    def _get_expected_suffixes(self, repo, tag) -> List[str]:
+        """Single-arch builds (like .build -p linux/arm64) only push the tags of their platforms"""
+        platforms = self.context.build_scheduler.get_platforms(repo, tag)
+        suffixes = [s for s, p in ARCH_SUFFIXES.items() if platforms is None or p in platforms]
+        return suffixes or list(ARCH_SUFFIXES)
+
+    def get_partition_key(self, body: str) -> str:
+        # Per-arch pushes of a tag are aggregated by one worker
+        j = json.loads(body)
+        tag = j["push_data"]["tag"]
+        return "{}:{}".format(j["repository"]["name"], self._strip_arch_suffix(tag) or tag)
+
+    async def process(self, body: str) -> None:
         try:
-            j = await request.json()
+            j = json.loads(body)
             repo = j["repository"]["name"]
             push_data = j["push_data"]
             pusher = self.normalize_pusher(push_data["pusher"])
             tag = push_data["tag"]
             self.logger.debug("DockerHub tag %s pushed", tag)
 
-            if tag.endswith("__x86_64"):
-                tag1 = tag.replace("__x86_64", "")
-            elif tag.endswith("__aarch64"):
-                tag1 = tag.replace("__aarch64", "")
-            else:
-                return web.Response()
+            tag1 = self._strip_arch_suffix(tag)
+            if not tag1:
+                return
+
+            key = (repo, tag1)
+            push = self._pending.get(key)
+            if not push:
+                loop = self.context.loop
+                timer = loop.call_later(self.timeout, lambda: loop.create_task(self.publish_push(key)))
+                push = PendingPush(timer, self._get_expected_suffixes(repo, tag1))
+                self._pending[key] = push
+            if pusher not in push.pushers:
+                push.pushers.append(pusher)
+            if tag not in push.arch_tags:
+                push.arch_tags.append(tag)
+
+            if all(tag1 + s in push.arch_tags for s in push.suffixes):
+                push.timer.cancel()
+                self.context.loop.create_task(self.publish_push(key))
+        except:
+            self.logger.debug("Failed to process dockerhub webhook")
 
-            images = self.parse_tag(repo, tag)
+    def flush(self) -> List[asyncio.Task]:
+        """Publish pending pushes right away instead of waiting for the missing arches, e.g. on shutdown"""
+        tasks = []
+        for key, push in list(self._pending.items()):
+            push.timer.cancel()
+            tasks.append(self.context.loop.create_task(self.publish_push(key)))
+        return tasks
+
+    async def publish_push(self, key: Tuple[str, str]):
+        push = self._pending.pop(key, None)
+        if not push:
+            return
+        repo, tag1 = key
+        try:
+            images = await self.context.loop.run_in_executor(None, self.parse_push, repo, tag1, push.arch_tags)
 
-            msg = "%s pushed %s:**%s**" % (pusher, repo, tag1.replace("__", r"\__"))
+            msg = "%s pushed %s:**%s**" % (", ".join(push.pushers), repo, tag1.replace("__", r"\__"))
+            missing = [ARCH_SUFFIXES[s] for s in push.suffixes if tag1 + s not in push.arch_tags]
+            if missing:
+                msg += " (%s not pushed within %d seconds)" % (", ".join(missing), self.timeout)
             for img in images:
                 r1 = img.revision
                 if r1:
@@ -107,5 +200,17 @@ class DockerhubHook(Hook):
                 )
             self.context.discord_template.publish_message(msg)
         except:
-            self.logger.debug("Failed to process dockerhub webhook")
-        return web.Response()
+            self.logger.exception("Failed to publish %s:%s push", repo, tag1)
+
+        try:
+            full_repo = "exchangeunion/{}".format(repo)
+            for tag in [tag1] + push.arch_tags:
+                await self.context.loop.run_in_executor(None, self.context.layer_index.add_tag, full_repo, tag)
+        except:
+            self.logger.exception("Failed to index layers of %s:%s", repo, tag1)
+
+        try:
+            # Later pushes of branches with the same images/<repo> tree are retagged from this tag
+            await self.context.loop.run_in_executor(None, self.context.xud_docker.record_published, repo, tag1)
+        except:
+            self.logger.exception("Failed to index the tree of %s:%s", repo, tag1)
@@ -1,39 +1,93 @@
-import os
+import asyncio
+import json
+import logging
+from typing import List, Optional, Tuple
 
-from aiohttp import web
 from collections import namedtuple
+from asyncio import Event as AsyncEvent, sleep
 from asyncio.queues import Queue
 from subprocess import CalledProcessError
 
 from .abc import Hook
-from xud_docker_bot.xud_docker import XudDockerRepo
+from ..clients import GithubClientError
+from ..dependency_index import UPSTREAM_IMAGES
+from ..log import log_context, in_log_context
+from ..xud_docker import get_branch_tag, get_path_images, check_pushed_ref, Retag, NULL_REVISION
 
 
-Event = namedtuple("Event", ["repo", "ref", "commit_message"])
+# paths are the files added or modified by the push, None if the payload does not list all of them
+Event = namedtuple("Event", ["repo", "ref", "revision", "commit_message", "paths"])
+
+# GitHub push payloads list at most 20 commits
+MAX_PAYLOAD_COMMITS = 20
+
+# Platforms built by Travis for every image
+PLATFORMS = ["linux/amd64", "linux/arm64"]
+
+# Seconds to wait before retrying a failed xud-docker repository initialization
+INIT_RETRY_DELAY = 60
 
 
 class GithubHook(Hook):
     def __init__(self, context):
         super().__init__(context)
-        repo_dir = os.path.expanduser("~/.xud-docker-bot/xud-docker")
-        registry_client = context.dockerhub_client
-        self.xud_docker = XudDockerRepo(repo_dir, registry_client)
+        self.xud_docker = context.xud_docker
         self.queue = Queue()
+        self.ready = AsyncEvent()
+
+    async def init_repo(self):
+        """Initialize the xud-docker repository in the background. Queued events are processed once it is ready."""
+        while True:
+            try:
+                await self.context.loop.run_in_executor(None, self.xud_docker.ensure_repo)
+                break
+            except Exception:
+                self.logger.exception("Failed to initialize xud-docker repository (retry in %d seconds)",
+                                      INIT_RETRY_DELAY)
+                await sleep(INIT_RETRY_DELAY)
+        self.ready.set()
 
-    async def handle_upstream_update(self, repo, branch, message):
+    def _get_unpublished_platforms(self, image, branch, revision) -> List[str]:
+        """Get platforms whose image of the xud-docker branch was not built from the upstream revision yet"""
+        tag = get_branch_tag(branch)
+        images = self.context.dockerhub_client.get_images(f"exchangeunion/{image}", tag)
+        published = set()
+        for img in images:
+            if img.app_revision and revision and \
+                    (img.app_revision.startswith(revision) or revision.startswith(img.app_revision)):
+                published.add(img.platform)
+        return [p for p in PLATFORMS if p not in published]
 
-        if repo == "ExchangeUnion/xud":
-            image = "xud"
-        elif repo == "ExchangeUnion/market-maker-tools":
-            image = "arby"
-        elif repo == "BoltzExchange/boltz-lnd":
-            image = "boltz"
-        else:
+    async def handle_upstream_update(self, repo, branch, revision, message):
+
+        image = UPSTREAM_IMAGES.get(repo)
+        if not image:
             raise RuntimeError("Unsupported repository: " + repo)
 
         branches = self.xud_docker.get_affected_branches(image, branch)
+        try:
+            pulls = await self.context.github_client.get_open_pulls()
+            branches = [b for b in branches if b == "master" or b in pulls]
+        except GithubClientError:
+            self.logger.exception("Failed to get open PRs of xud-docker, keep all unmerged branches")
+
+        # Skip (or narrow down) builds whose upstream revision is already published, e.g. re-delivered webhooks
+        platforms = {}
+        for b in list(branches):
+            try:
+                platforms[b] = await self.context.loop.run_in_executor(
+                    None, self._get_unpublished_platforms, image, b, revision)
+            except Exception:
+                self.logger.exception("Failed to check published %s image of branch %s", image, b)
+                platforms[b] = PLATFORMS
+            if len(platforms[b]) == 0:
+                self.logger.debug("Image %s of branch %s is already built from %s(%s) %s",
+                                  image, b, repo, branch, revision)
+                branches.remove(b)
+
         if len(branches) == 0:
             return
+        futures = []
         branch_list = ", ".join(branches)
         lines = message.splitlines()
         first_line = lines[0]
@@ -42,86 +96,209 @@ class GithubHook(Hook):
         self.context.discord_template.publish_message(msg)
         for b in branches:
             travis_msg = "%s(%s): %s" % (repo, branch, message)
-            self.context.travis_client.trigger_travis_build2(b, travis_msg, [f"{image}:latest"])
+            if platforms[b] == PLATFORMS:
+                futures.append(self.context.build_scheduler.submit(b, [f"{image}:latest"], travis_msg))
+            else:
+                futures.append(self.context.build_scheduler.submit(
+                    b, [f"{image}:latest"], travis_msg, platforms=platforms[b]))
+        await self._wait_dispatched(futures)
+
+    async def _wait_dispatched(self, futures: List[asyncio.Future]) -> None:
+        """Wait until the build requests are dispatched to Travis, so that the event is only done then. Withdrawn
+        requests count as dispatched.
+        """
+        if len(futures) > 0:
+            await asyncio.wait(futures)
+        for future in futures:
+            if not future.cancelled() and future.exception():
+                raise future.exception()
+
+    def _retag(self, retags: List[Retag]) -> List[str]:
+        """Copy published manifests to the branch tags. Returns images which failed and need to be built instead."""
+        client = self.context.dockerhub_client
+        failed = []
+        for retag in retags:
+            repo = f"exchangeunion/{retag.image}"
+            try:
+                client.copy_manifest(repo, retag.digest, retag.tag)
+                self.xud_docker.record_published(retag.image, retag.tag, retag.tree, retag.digest)
+                msg = "♻️ Retagged {}:**{}** as **{}** (same images/{} tree, no build needed)".format(
+                    repo, retag.source_tag.replace("__", r"\__"), retag.tag.replace("__", r"\__"), retag.image)
+                self.context.discord_template.publish_message(msg)
+            except Exception:
+                self.logger.exception("Failed to retag %s:%s as %s", repo, retag.source_tag, retag.tag)
+                failed.append(f"{retag.image}:latest")
+        return failed
+
+    def _get_branch(self, ref) -> str:
+        if ref.startswith("refs/heads/"):
+            return ref.replace("refs/heads/", "")
+        else:
+            raise RuntimeError("Failed to parse branch from reference %s" % ref)
+
+    async def _fix_up(self, branch, submitted, images: List[str], retags: List[Retag]) \
+            -> Tuple[List[str], List[Retag]]:
+        """Reconcile the images submitted by the fast path with the full analysis. Returns the images still to
+        submit and the retags to do.
+        """
+        future, candidates = submitted
+        withdrawn = await self.context.build_scheduler.withdraw(future, [i for i in candidates if i not in images])
+        # Images of an already dispatched fast path build are published by that build
+        retags = [r for r in retags if f"{r.image}:latest" not in candidates or f"{r.image}:latest" in withdrawn]
+        missing = [i for i in images if i not in candidates]
+        if withdrawn or missing:
+            self.logger.debug("Fixed up fast path build of branch %s: withdrew %r, added %r", branch, withdrawn,
+                              missing)
+        if withdrawn:
+            self.context.discord_template.publish_message(
+                "Verified xud-docker branch **{}**: dropped images {} (up-to-date or retagged).".format(
+                    branch, ", ".join(withdrawn)))
+        return missing, retags
 
     async def process_queue(self):
+        await self.ready.wait()
         while True:
-            ref = await self.queue.get()
-            self.logger.debug("Process xud-docker %s", ref)
-            try:
-                client = self.context.travis_client
-                git_ref, images = self.xud_docker.get_modified_images(ref)
-                if len(images) > 0:
-                    if ref.startswith("refs/heads/"):
-                        branch = ref.replace("refs/heads/", "")
-                    else:
-                        raise RuntimeError("Failed to parse branch from reference %s" % ref)
-
-                    lines = git_ref.commit_message.splitlines()
-                    first_line = lines[0].strip()
-                    if len(images) == 0:
-                        build_msg = "Will build **no** images."
-                    else:
-                        build_msg = "Will build images: {}.".format(", ".join(images))
-                    msg = "ExchangeUnion/xud-docker branch **{}** was pushed ({}). {}" \
-                        .format(branch, first_line, build_msg)
-                    self.context.discord_template.publish_message(msg)
-
-                    remaining_requests, request_id = client.trigger_travis_build2(branch, git_ref.commit_message, images)
-                    self.logger.debug("Created Travis build request %s for images: %s (%s request(s) left)",
-                                      request_id, ", ".join(images), remaining_requests)
-            except Exception as e:
-                p = e
-                while p:
-                    if isinstance(p, CalledProcessError):
-                        self.logger.error("Failed to execute command\n$ %s\n%s", p.cmd, p.output.decode().strip())
-                        break
-                    p = e.__cause__
-                self.logger.exception("Failed to process xud-docker %s", ref)
-
-    async def handle_xud_docker_update(self, ref):
+            ref, revision, submitted, done = await self.queue.get()
+            with log_context(ref=ref, revision=revision):
+                await self._process_item(ref, revision, submitted, done)
+
+    async def _process_item(self, ref, revision, submitted, done):
+        self.logger.debug("Process xud-docker %s (%s)", ref, revision)
+        futures = []
+        try:
+            if revision == NULL_REVISION:
+                await self.context.loop.run_in_executor(
+                    None, in_log_context(self.xud_docker.update_ref, ref, revision))
+                done.set_result(futures)
+                return
+            branch = self._get_branch(ref)
+            git_ref, images, retags = await self.context.loop.run_in_executor(
+                None, in_log_context(self.xud_docker.get_modified_images, ref, revision))
+            if submitted:
+                images, retags = await self._fix_up(branch, submitted, images, retags)
+            for image in self._retag(retags):
+                if image not in images:
+                    images.append(image)
+            if len(images) > 0:
+                lines = git_ref.commit_message.splitlines()
+                first_line = lines[0].strip()
+                if submitted:
+                    msg = "Verified xud-docker branch **{}**: will also build images: {}." \
+                        .format(branch, ", ".join(images))
+                else:
+                    msg = "ExchangeUnion/xud-docker branch **{}** was pushed ({}). Will build images: {}." \
+                        .format(branch, first_line, ", ".join(images))
+                self.context.discord_template.publish_message(msg)
+
+                futures.append(self.context.build_scheduler.submit(branch, images, git_ref.commit_message))
+            done.set_result(futures)
+        except Exception as e:
+            p = e
+            while p:
+                if isinstance(p, CalledProcessError):
+                    self.logger.error("Failed to execute command\n$ %s\n%s", p.cmd, p.output.decode().strip())
+                    break
+                p = p.__cause__
+            self.logger.exception("Failed to process xud-docker %s", ref)
+            done.set_exception(e)
+
+    async def handle_xud_docker_update(self, ref, revision, message=None, paths=None):
+        """Queue the pushed revision for analysis and wait until its builds are dispatched. When the payload lists
+        every changed path, images under added or modified images/<image>/ folders are submitted right away, held
+        until the analysis has verified (and fixed up) them.
+        """
+        done = self.context.loop.create_future()
+        if revision == NULL_REVISION:
+            await self.queue.put((ref, revision, None, done))
+            await done
+            return
         self.context.discord_template.publish_message("Submit xud-docker %s build task" % ref)
-        await self.queue.put(ref)
+        submitted = None
+        if paths is not None:
+            images = get_path_images(paths)
+            if len(images) > 0:
+                branch = self._get_branch(ref)
+                first_line = message.splitlines()[0].strip() if message else ""
+                self.context.discord_template.publish_message(
+                    "ExchangeUnion/xud-docker branch **{}** was pushed ({}). Will build images: {}."
+                    .format(branch, first_line, ", ".join(images)))
+                future = self.context.build_scheduler.submit(branch, images, message, hold=True)
+                submitted = (future, images)
+        await self.queue.put((ref, revision, submitted, done))
+        try:
+            futures = await done
+        finally:
+            if submitted:
+                # Verified, or the analysis failed and the images are built as submitted
+                await self.context.build_scheduler.release(submitted[0])
+        if submitted:
+            futures.append(submitted[0])
+        await self._wait_dispatched(futures)
+
+    def _get_changed_paths(self, payload) -> Optional[List[str]]:
+        """Collect the paths added or modified by a push, without the ones removed by a later commit. Returns None if
+        the payload may not list all of them: truncated commit lists, force pushes and new branches (whose commits
+        are not compared with a published revision).
+        """
+        commits = payload.get("commits") or []
+        if payload.get("created") or payload.get("forced") or payload.get("deleted") \
+                or len(commits) == 0 or len(commits) >= MAX_PAYLOAD_COMMITS:
+            return None
+        paths = set()
+        for commit in commits:
+            paths.update(commit.get("added", []))
+            paths.update(commit.get("modified", []))
+            # Removed folders have nothing to build, the analysis finds images which still need a build
+            paths.difference_update(commit.get("removed", []))
+        return sorted(paths)
 
-    async def _parse_request(self, request: web.Request) -> Event:
+    def _parse_payload(self, body: str) -> Event:
         try:
-            j = await request.json()
+            j = json.loads(body)
             repo = j["repository"]["full_name"]
             ref = j["ref"]
+            revision = j.get("after")
             msg = None
             try:
                 msg = j["head_commit"]["message"]
             except:
                 pass
 
-            return Event(repo, ref, msg)
+            # The payload is not authenticated, the ref and revision end up in git commands
+            if ref.startswith("refs/heads/"):
+                check_pushed_ref(ref, revision)
+            return Event(repo, ref, revision, msg, self._get_changed_paths(j))
 
         except Exception as e:
             raise RuntimeError("Failed to parse GitHub webhook") from e
 
-    async def handle(self, request: web.Request) -> web.Response:
+    def get_partition_key(self, body: str) -> str:
+        j = json.loads(body)
+        return "{}:{}".format(j["repository"]["full_name"], j["ref"])
+
+    async def process(self, body: str) -> None:
+        # Events ignored on purpose (pings, tag pushes, invalid payloads) return normally, they must not be replayed
         try:
-            event = await self._parse_request(request)
+            event = self._parse_payload(body)
+        except Exception as e:
+            # Pings and other events without a ref are expected, invalid payloads and refs are not
+            level = logging.WARNING if isinstance(e.__cause__, ValueError) else logging.DEBUG
+            self.logger.log(level, "Ignore GitHub webhook: %s", e.__cause__ or e)
+            return
+        if not event.ref.startswith("refs/heads/"):
+            self.logger.debug("Ignore GitHub push of %s", event.ref)
+            return
 
+        try:
             ref = event.ref
             repo = event.repo
             msg = event.commit_message
+            branch = ref.replace("refs/heads/", "")
 
-            if ref.startswith("refs/heads/"):
-                branch = ref.replace("refs/heads/", "")
-            else:
-                raise RuntimeError("Failed to parse branch from reference %s" % ref)
-
-            if repo == "ExchangeUnion/xud":
-                await self.handle_upstream_update(repo, branch, msg)
-            elif repo == "ExchangeUnion/market-maker-tools":
-                await self.handle_upstream_update(repo, branch, msg)
-            elif repo == "BoltzExchange/boltz-lnd":
-                await self.handle_upstream_update(repo, branch, msg)
+            if repo in UPSTREAM_IMAGES:
+                await self.handle_upstream_update(repo, branch, event.revision, msg)
             elif repo == "ExchangeUnion/xud-docker":
-                await self.handle_xud_docker_update(ref)
-        except:
-            # TODO save failed payload for further analyzing
+                await self.handle_xud_docker_update(ref, event.revision, msg, event.paths)
+        except Exception:
             self.logger.exception("Failed to process GitHub webhook")
-
-        return web.Response()
+            raise
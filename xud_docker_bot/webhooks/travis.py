@@ -6,7 +6,6 @@ from urllib.parse import parse_qs
 from discord.ext.commands import Cog
 import re
 
-from aiohttp import web
 from .abc import Hook
 
 if TYPE_CHECKING:
@@ -14,9 +13,8 @@ if TYPE_CHECKING:
 
 
 class TravisHook(Hook):
-    async def handle(self, request: web.Request) -> web.Response:
-        t = await request.text()
-        params = parse_qs(t)
+    async def process(self, body: str) -> None:
+        params = parse_qs(body)
         j = json.loads(params["payload"][0])
         repo = j["repository"]["name"]
         if repo == "xud-docker":
@@ -26,6 +24,8 @@ class TravisHook(Hook):
             branch = j["branch"]
             commit = j["commit"]
             commit_message = j["message"]
+            # A new build may belong to a request whose builds are awaited
+            self.context.travis_client.nudge(branch)
             status = result.lower()
             if status == "passed":
                 status2 = f"**{status}** 🎉"
@@ -36,10 +36,10 @@ class TravisHook(Hook):
             msg += f"\n**Branch:** {branch}"
             msg += f"\n**Commit:** `{commit}`"
             msg += f"\n**Message:** {commit_message}"
-            message = await self.context.discord_template.publish_message_async(msg)
+            reactions = []
             if status == "pending":
-                await message.add_reaction('🚫')
+                reactions.append('🚫')
             elif status == "canceled" or status == "passed":
-                await message.add_reaction('🔄')
-        return web.Response()
+                reactions.append('🔄')
+            self.context.discord_template.publish_message(msg, reactions)
 
@@ -1,14 +1,20 @@
 import os
+import re
 from subprocess import Popen, PIPE, STDOUT, CalledProcessError
 import logging
 import shutil
-from requests import get
-from typing import List, Dict, Tuple
+import tempfile
+import threading
+from typing import List, Dict, Tuple, Optional, FrozenSet
 from collections import namedtuple
 from contextlib import contextmanager
 
 from xud_docker_bot.utils import execute
 from xud_docker_bot.clients import DockerhubClient, DockerImage
+from xud_docker_bot.clients.singleflight import SingleFlight
+from xud_docker_bot.config import XUD_DOCKER_REPO_URL
+from xud_docker_bot.dependency_index import DependencyIndex
+from xud_docker_bot.log import Lazy
 
 SCRIPT = """\
 from launcher.config.template import nodes_config
@@ -33,34 +39,111 @@ ADD launcher launcher
 
 VersionChange = namedtuple("ImageChange", ["network", "old_version", "new_version"])
 GitReference = namedtuple("GitReference", ["ref", "revision", "commit_message"])
+Retag = namedtuple("Retag", ["image", "source_tag", "digest", "tag", "tree"], defaults=(None,))
 
-@contextmanager
-def workspace(dir):
-    wd = os.getcwd()
-    try:
-        os.chdir(dir)
-        yield
-    finally:
-        os.chdir(wd)
+# The "after" revision of push events which delete a branch
+NULL_REVISION = "0" * 40
+
+# Platforms a published manifest must contain before it can be reused for another tag
+PLATFORMS = {"linux/amd64", "linux/arm64"}
+
+
+def get_branch_tag(branch, tag="latest"):
+    """Get the registry tag of images built from a xud-docker branch, like "latest__feat-foo" """
+    if branch == "master":
+        return tag
+    return tag + "__" + branch.replace("/", "-")
+
+
+def get_path_images(paths) -> List[str]:
+    """Map changed repository paths to the images they belong to, like "images/xud/Dockerfile" to "xud:latest".
+    Changes of the utils template (images/utils/...) therefore map to utils as well.
+    """
+    result = set()
+    for path in paths:
+        parts = path.split("/")
+        if len(parts) > 2 and parts[0] == "images":
+            result.add(parts[1] + ":latest")
+    return sorted(result)
+
+
+# Branch names come from Discord commands and webhooks, only these characters ever reach git
+BRANCH_PATTERN = re.compile(r"^[A-Za-z0-9._/-]+$")
+
+
+# Full commit hashes, revisions of unauthenticated webhook payloads must match it
+REVISION_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+
+
+def is_valid_branch(branch: str) -> bool:
+    """Check a branch name like "git check-ref-format --branch" does, without running git on the event loop"""
+    if not BRANCH_PATTERN.match(branch) or branch.startswith("-") or branch == "HEAD":
+        return False
+    if ".." in branch or branch.endswith("."):
+        return False
+    for component in branch.split("/"):
+        # Also rejects leading, trailing and consecutive slashes
+        if not component or component.startswith(".") or component.endswith(".lock"):
+            return False
+    return True
+
+
+def check_pushed_ref(ref: str, revision: Optional[str]) -> None:
+    """Raise ValueError unless the ref is a valid branch ref and the revision a full commit hash (or None)"""
+    if not ref.startswith("refs/heads/") or not is_valid_branch(ref.replace("refs/heads/", "", 1)):
+        raise ValueError("Invalid ref: %r" % ref)
+    if revision is not None and not REVISION_PATTERN.match(revision):
+        raise ValueError("Invalid revision: %r" % revision)
+
+
+def is_tree_tag(tag: str) -> bool:
+    """Multi-arch tags of images built from a branch, like "latest" and "latest__feat-foo" """
+    if tag != "latest" and not tag.startswith("latest__"):
+        return False
+    return not tag.endswith("__x86_64") and not tag.endswith("__aarch64")
+
+
+def _format_template(template: Dict[str, str]) -> str:
+    return "\n".join([f"{key} {value}" for key, value in template.items()])
 
 
 class XudDockerRepo:
-    def __init__(self, repo_dir, dockerhub_client: DockerhubClient):
+    def __init__(self, repo_dir, dockerhub_client: DockerhubClient,
+                 repo_url=XUD_DOCKER_REPO_URL):
         self._logger = logging.getLogger("xud_docker_bot.XudDockerRepo")
         self.repo_dir = repo_dir
+        self.repo_url = repo_url
         self.dockerhub_client = dockerhub_client
-        repo_url = "https://github.com/ExchangeUnion/xud-docker.git"
-        self._ensure_repo(repo_url, self.repo_dir)
+        self.dependency_index = DependencyIndex(repo_dir)
+        # (revision, image) -> tree hash of images/<image>
+        self._trees: Dict[Tuple[str, str], Optional[str]] = {}
+        # commit -> names of images/ folders at that commit
+        self._catalogs: Dict[str, FrozenSet[str]] = {}
+        # image -> tree hash -> (tag, manifest digest) of published multi-arch images
+        self._tree_index: Dict[str, Dict[str, Tuple[str, str]]] = {}
+        # image -> tag -> last update of the tags added to the tree index
+        self._indexed_tags: Dict[str, Dict[str, Optional[str]]] = {}
+        # Guards both, they are used by the analysis executor threads, the plan command and Docker Hub pushes
+        self._index_lock = threading.Lock()
+        # Refs are analysed concurrently by the plan command, so utils images are built once per revision
+        self._flight = SingleFlight()
+        self.ready = False
 
     def _clone_repo(self, repo_url, repo_dir):
+        # Clone into a temporary folder first so that an interrupted clone is never mistaken for a valid one.
+        # The blobless partial clone only downloads commits and trees, blobs are fetched on demand.
+        tmp_dir = repo_dir + ".tmp"
         try:
-            execute(f"git clone {repo_url} {repo_dir}")
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            execute(f"git clone --filter=blob:none {repo_url} {tmp_dir}")
+            os.rename(tmp_dir, repo_dir)
         except Exception as e:
             raise RuntimeError("Failed to clone repository %s to folder %s" %(repo_url, repo_dir)) from e
 
-    def _get_origin_url(self):
+    def _get_origin_url(self, repo_dir):
         try:
-            output = execute(f"git remote get-url origin")
+            output = execute(f"git remote get-url origin", cwd=repo_dir)
             return output.strip()
         except Exception as e:
             raise RuntimeError("Failed to get origin URL") from e
@@ -68,8 +151,7 @@ class XudDockerRepo:
     def _check(self, repo_url, repo_dir):
         if not os.path.exists(repo_dir) or not os.path.isdir(repo_dir):
             return False
-        with workspace(repo_dir):
-            return self._get_origin_url() == repo_url
+        return self._get_origin_url(repo_dir) == repo_url
 
     def _ensure_repo(self, repo_url, repo_dir):
         if not self._check(repo_url, repo_dir):
@@ -79,56 +161,81 @@ class XudDockerRepo:
         if not os.path.exists(repo_dir):
             self._clone_repo(repo_url, repo_dir)
 
-    def get_affected_branches(self, image, branch):
-        # FIXME get all branches in xud-docker which are affected by upstream branch changes
-        # branches = filter_merged_branches(branches)
-        if branch == "master":
-            return ["master"]
-        else:
-            return []
-
-    def get_pr(self, branch):
+    def ensure_repo(self) -> None:
+        """Make sure the local xud-docker repository exists. This may take a while on a fresh host, so it is
+        called from a background thread instead of the constructor.
+        """
+        self._logger.info("Initializing xud-docker repository in %s", self.repo_dir)
+        self._ensure_repo(self.repo_url, self.repo_dir)
+        self._fetch_updates()
+        self.ready = True
+        self._logger.info("The xud-docker repository is ready")
+
+    def get_image_catalog(self, revision) -> FrozenSet[str]:
+        """Get the images available at the revision, derived from its images/ tree"""
+        commit = execute(["git", "rev-parse", "--verify", f"{revision}^{{commit}}"], cwd=self.repo_dir).strip()
+        catalog = self._catalogs.get(commit)
+        if catalog is None:
+            output = execute(["git", "ls-tree", "-d", "--name-only", commit, "images/"], cwd=self.repo_dir)
+            catalog = frozenset(line.replace("images/", "", 1) for line in output.splitlines())
+            self._catalogs[commit] = catalog
+        return catalog
+
+    def get_branch_catalog(self, branch) -> FrozenSet[str]:
+        """Get the images available at the head of a xud-docker branch. Unknown branches are fetched first."""
+        if not is_valid_branch(branch):
+            raise ValueError("Invalid branch name: %r" % branch)
+        remote_ref = f"refs/remotes/origin/{branch}"
         try:
-            r = get(f"https://api.github.com/repos/exchangeunion/xud-docker/pulls?head=exchangeunion:{branch}")
-            j = r.json()
-            if len(j) == 0:
-                return None
-            elif len(j) == 1:
-                return j[0]
-            elif len(j) > 1:
-                raise RuntimeError("There are multiple PRs related to branch {}".format(branch))
-        except:
-            pass
-        return None
-
-    def filter_merged_branches(self, branches):
-        result = []
-        for b in branches:
-            if b == "master":
-                result.append(b)
-                continue
-            pr = self.get_pr(b)
-            if pr and pr["state"] == "open":
-                result.append(b)
-
-        return result
+            return self.get_image_catalog(remote_ref)
+        except CalledProcessError:
+            execute(["git", "fetch", "origin", f"+refs/heads/{branch}:{remote_ref}"], cwd=self.repo_dir)
+            return self.get_image_catalog(remote_ref)
+
+    def get_affected_branches(self, image, branch) -> List[str]:
+        """Get xud-docker branches which build the image from the upstream branch"""
+        if not self.dependency_index.ready:
+            # The repository is still being initialized
+            if branch == "master":
+                return ["master"]
+            else:
+                return []
+        return self.dependency_index.lookup(image, branch)
 
-    def _diff_image_with_revision(self, image, revision) -> bool:
-        cmd = f"git diff --name-status {revision} -- images/{image}"
-        output = execute(cmd)
+    def _diff_image_with_revision(self, image, revision, target) -> bool:
+        cmd = f"git diff --name-status {revision} {target} -- images/{image}"
+        output = execute(cmd, cwd=self.repo_dir)
         lines = output.splitlines()
         if len(lines) > 0:
-            self._logger.debug("Image %s is different from %s\n%s", image, revision, "\n".join(lines))
+            self._logger.debug("Image %s is different from %s\n%s", image, revision, output.strip())
             return True
         else:
             return False
 
     def _ensure_utils_dockerfile(self):
         dockerfile = os.path.expanduser("~/.xud-docker-bot/utils.Dockerfile")
+        if os.path.exists(dockerfile):
+            with open(dockerfile) as f:
+                if f.read() == DOCKERFILE:
+                    return dockerfile
         with open(dockerfile, "w") as f:
             f.write(DOCKERFILE)
         return dockerfile
 
+    @contextmanager
+    def _worktree(self, revision):
+        """Check out the revision into a temporary worktree, so that the repository itself is never checked out
+        and several revisions can be worked on at the same time
+        """
+        tmp_dir = tempfile.mkdtemp(prefix="xud-docker-")
+        work_dir = os.path.join(tmp_dir, "xud-docker")
+        try:
+            execute(["git", "worktree", "add", "--detach", work_dir, revision], cwd=self.repo_dir)
+            yield work_dir
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            execute("git worktree prune", cwd=self.repo_dir)
+
     def _utils_exists(self, revision) -> bool:
         filter = f"reference=utils:{revision}"
         format = "{{.ID}}"
@@ -142,12 +249,16 @@ class XudDockerRepo:
             raise RuntimeError("There shouldn't be multiple utils images with filter: " + filter)
 
     def _build_utils(self, revision) -> str:
-        dockerfile = self._ensure_utils_dockerfile()
+        return self._flight.do(("utils", revision), self._build_utils_once, revision)
+
+    def _build_utils_once(self, revision) -> str:
         tag = f"utils:{revision}"
-        self._checkout_revision(revision)
-        with workspace("images/utils/"):
-            execute(f"docker build . -f {dockerfile} -t {tag}")
+        if self._utils_exists(revision):
             return tag
+        dockerfile = self._ensure_utils_dockerfile()
+        with self._worktree(revision) as work_dir:
+            execute(f"docker build . -f {dockerfile} -t {tag}", cwd=os.path.join(work_dir, "images/utils"))
+        return tag
 
     def _dump_template(self, utils_image) -> Dict[str, str]:
         """Dump utils image template.py as a Dict.
@@ -168,21 +279,16 @@ class XudDockerRepo:
             result[key] = value
         return result
 
-    def _diff_template_py(self, registry_utils_image: DockerImage) -> Dict[str, VersionChange]:
+    def _diff_template_py(self, registry_utils_image: DockerImage, current_revision) -> Dict[str, VersionChange]:
         registry_revision = registry_utils_image.revision
 
         registry_utils = self._build_utils(registry_revision)
         r1 = self._dump_template(registry_utils)
-        self._logger.debug("Registry utils:%s template\n%s",
-                           registry_revision,
-                           "\n".join([f"{key} {value}" for key, value in r1.items()]))
+        self._logger.debug("Registry utils:%s template\n%s", registry_revision, Lazy(_format_template, r1))
 
-        current_revision = execute("git rev-parse HEAD").strip()
         current_utils = self._build_utils(current_revision)
         r2 = self._dump_template(current_utils)
-        self._logger.debug("Current utils:%s template\n%s",
-                           current_revision,
-                           "\n".join([f"{key} {value}" for key, value in r1.items()]))
+        self._logger.debug("Current utils:%s template\n%s", current_revision, Lazy(_format_template, r2))
 
         result = {}
 
@@ -196,12 +302,12 @@ class XudDockerRepo:
                 result[image] = VersionChange(network, None, new_version)
 
         self._logger.debug("Image utils template diff result: %s",
-                           "\n".join([f"- {k}: {v}" for k, v in result.items()]))
+                           Lazy(lambda: "\n".join([f"- {k}: {v}" for k, v in result.items()])))
 
         return result
 
-    def _get_template_modified_images(self, registry_utils_image: DockerImage) -> List[str]:
-        diff = self._diff_template_py(registry_utils_image)
+    def _get_template_modified_images(self, registry_utils_image: DockerImage, current_revision) -> List[str]:
+        diff = self._diff_template_py(registry_utils_image, current_revision)
         result = set()
         for key, value in diff.items():
             # TODO improve new_version parsing
@@ -210,43 +316,159 @@ class XudDockerRepo:
         return list(result)
 
     def _fetch_updates(self) -> None:
-        output = execute(f"git fetch")
+        output = execute(f"git fetch --prune", cwd=self.repo_dir)
         self._logger.debug("Fetched xud-docker updates\n%s", output.strip())
+        self.dependency_index.update()
 
-    def _get_ref_details(self, ref) -> GitReference:
-        revision = execute("git rev-parse HEAD")
-        commit_message = execute("git show --format='%s' --no-patch HEAD").strip()
-        return GitReference(ref, revision, commit_message)
-
-    def _show_head(self) -> None:
-        output = execute("git show --no-patch HEAD")
-        self._logger.debug("Current HEAD of xud-docker repository\n%s", output.strip())
-
-    def _checkout_origin_ref(self, ref) -> None:
-        remote_ref = ref.replace("refs/heads", "refs/remotes/origin")
-        execute(f"git checkout --detach {remote_ref}")
-
-    def _checkout_revision(self, revision) -> None:
+    def _has_commit(self, revision) -> bool:
         try:
-            execute(f"git checkout {revision}")
-        except Exception as e:
-            raise RuntimeError("Failed to checkout revision %s" % revision) from e
+            execute(["git", "cat-file", "-e", f"{revision}^{{commit}}"], cwd=self.repo_dir)
+            return True
+        except CalledProcessError:
+            return False
+
+    def update_ref(self, ref, revision=None) -> None:
+        """Update the remote-tracking ref of a pushed ref to the pushed revision. Only the pushed ref is fetched, and
+        nothing at all when the revision is already present locally. A NULL_REVISION removes the ref.
+        """
+        check_pushed_ref(ref, revision)
+        remote_ref = ref.replace("refs/heads/", "refs/remotes/origin/")
+        if revision == NULL_REVISION:
+            self._logger.debug("Remove deleted ref %s", remote_ref)
+            execute(["git", "update-ref", "-d", remote_ref], cwd=self.repo_dir)
+        elif revision and self._has_commit(revision):
+            self._logger.debug("Revision %s of %s is present, skip fetching", revision, ref)
+            execute(["git", "update-ref", remote_ref, revision], cwd=self.repo_dir)
+        else:
+            output = execute(["git", "fetch", "origin", f"+{ref}:{remote_ref}"], cwd=self.repo_dir)
+            self._logger.debug("Fetched xud-docker %s\n%s", ref, output.strip())
+        self.dependency_index.update()
+
+    def _get_ref_details(self, ref, target) -> GitReference:
+        revision = execute(["git", "rev-parse", "--verify", f"{target}^{{commit}}"], cwd=self.repo_dir).strip()
+        commit_message = execute(["git", "show", "--format=%s", "--no-patch", revision], cwd=self.repo_dir).strip()
+        output = execute(["git", "show", "--no-patch", revision], cwd=self.repo_dir)
+        self._logger.debug("Analysing xud-docker %s\n%s", ref, output.strip())
+        return GitReference(ref, revision, commit_message)
 
-    def _get_current_branch_history(self, branch) -> List[str]:
+    def _get_current_branch_history(self, branch, revision) -> List[str]:
         if branch == "master":
             # The commit 66f5d19 is the first commit that introduces utils image
             # Use this commit to shorten master history length
-            output = execute("git log --pretty=format:'%H' --no-patch 66f5d19..")
+            output = execute(["git", "log", "--pretty=format:%H", "--no-patch", f"66f5d19..{revision}"],
+                             cwd=self.repo_dir)
         else:
-            output = execute("git log --pretty=format:'%H' --no-patch origin/master..")
+            output = execute(["git", "log", "--pretty=format:%H", "--no-patch", f"origin/master..{revision}"],
+                             cwd=self.repo_dir)
         return output.splitlines()
 
-    def _is_valid_branch_image(self, image: DockerImage, current_branch_history: List[str]) -> bool:
-        if image.revision not in current_branch_history:
+    def _get_tree(self, revision, image) -> Optional[str]:
+        """Get the git tree hash of images/<image> at the revision"""
+        if not revision or revision.endswith("-dirty"):
+            return None
+        key = (revision, image)
+        if key not in self._trees:
+            try:
+                self._trees[key] = execute(["git", "rev-parse", f"{revision}:images/{image}"],
+                                           cwd=self.repo_dir).strip()
+            except CalledProcessError:
+                # Unknown revision or the image does not exist at that revision
+                self._trees[key] = None
+        return self._trees[key]
+
+    def _get_image_tree(self, docker_image: DockerImage, image) -> Optional[str]:
+        if docker_image.tree:
+            return docker_image.tree
+        return self._get_tree(docker_image.revision, image)
+
+    def _drop_tag(self, image, tag) -> None:
+        # The tag was pushed again, it may have another tree now. Call with the index lock held.
+        index = self._tree_index.setdefault(image, {})
+        for tree in [t for t, (t_tag, _) in index.items() if t_tag == tag]:
+            del index[tree]
+
+    def _index_tag(self, image, tag) -> None:
+        """Add the tree of a published multi-arch tag to the tree index"""
+        repo = f"exchangeunion/{image}"
+        client = self.dockerhub_client
+        images = client.get_images(repo, tag)
+        tree = None
+        if PLATFORMS <= {img.platform for img in images}:
+            amd64 = next(img for img in images if img.platform == "linux/amd64")
+            tree = self._get_image_tree(amd64, image)
+        with self._index_lock:
+            self._drop_tag(image, tag)
+            if tree:
+                self._tree_index[image][tree] = (tag, client.tag_digests[(repo, tag)])
+
+    def record_published(self, image, tag, tree=None, digest=None) -> None:
+        """Update the tree index with a pushed or retagged tag, so that lookups of its tree find it without listing
+        the registry. The tree and digest of a retag are known, a pushed tag is read from the registry.
+        """
+        if not is_tree_tag(tag):
+            return
+        if tree and digest:
+            with self._index_lock:
+                self._drop_tag(image, tag)
+                self._tree_index[image].setdefault(tree, (tag, digest))
+        else:
+            self._index_tag(image, tag)
+
+    def _scan_tags(self, image) -> None:
+        """Index the tags of the image which are new or were updated since they were indexed"""
+        indexed = self._indexed_tags.setdefault(image, {})
+        for t in self.dockerhub_client.get_tags(f"exchangeunion/{image}"):
+            if not is_tree_tag(t.name):
+                continue
+            with self._index_lock:
+                if t.name in indexed and indexed[t.name] == t.last_updated:
+                    continue
+            self._index_tag(image, t.name)
+            with self._index_lock:
+                indexed[t.name] = t.last_updated
+
+    def _find_published_tree(self, image, tree) -> Optional[Tuple[str, str]]:
+        """Find a published multi-arch manifest of the image built from the same images/<image> tree.
+        Returns (tag, manifest digest) or None.
+
+        Tags are read from the registry once and again only when they are updated, so a miss costs a tag listing
+        until the next push. Concurrent lookups of an image share the listing.
+        """
+        repo = f"exchangeunion/{image}"
+        with self._index_lock:
+            published = self._tree_index.setdefault(image, {}).get(tree)
+
+        if published:
+            tag, digest = published
+            if self.dockerhub_client.get_manifest_digest(repo, tag) == digest:
+                return published
+            with self._index_lock:
+                if self._tree_index[image].get(tree) == published:
+                    del self._tree_index[image][tree]
+
+        self._flight.do(("tree-index", image), self._scan_tags, image)
+        with self._index_lock:
+            return self._tree_index[image].get(tree)
+
+    def _is_valid_branch_image(
+            self,
+            docker_image: DockerImage,
+            image: str,
+            current_branch_history: List[str],
+            current_tree: Optional[str]) -> bool:
+        # Images retagged from another branch are valid as long as they are built from the same tree
+        if current_tree and self._get_image_tree(docker_image, image) == current_tree:
+            return True
+        if docker_image.revision not in current_branch_history:
             return False
         return True
 
-    def _select_registry_image(self, branch: str, image: str, current_branch_history: List[str]) -> DockerImage:
+    def _select_registry_image(
+            self,
+            branch: str,
+            image: str,
+            current_branch_history: List[str],
+            current_tree: Optional[str]) -> DockerImage:
         """
         Select registry image (foo:tag or foo:tag__branch)
         """
@@ -254,11 +476,12 @@ class XudDockerRepo:
             tag = "latest"
             docker_image = self.dockerhub_client.get_image(f"exchangeunion/{image}", tag)
         else:
-            tag = "latest__" + branch.replace("/", "-")
+            tag = get_branch_tag(branch)
             docker_image = self.dockerhub_client.get_image(f"exchangeunion/{image}", tag)
             self._logger.debug("docker_image=%r", docker_image)
             self._logger.debug("current_branch_history=%r", current_branch_history)
-            if not docker_image or not self._is_valid_branch_image(docker_image, current_branch_history):
+            if not docker_image or \
+                    not self._is_valid_branch_image(docker_image, image, current_branch_history, current_tree):
                 tag = "latest"
                 docker_image = self.dockerhub_client.get_image(f"exchangeunion/{image}", tag)
 
@@ -269,52 +492,84 @@ class XudDockerRepo:
 
         return docker_image
 
-    def get_modified_images(self, ref) -> Tuple[GitReference, List[str]]:
-        with workspace(self.repo_dir):
-            self._fetch_updates()
-            self._checkout_origin_ref(ref)
-            self._show_head()
-            git_ref = self._get_ref_details(ref)
-            branch = ref.replace("refs/heads/", "")
-            current_branch_history = self._get_current_branch_history(branch)
-
-            images = os.listdir("images")
-
-            latest_images = []
-            version_images = []
-            for image in images:
-                self._checkout_origin_ref(ref)
-                self._show_head()
-
-                self._logger.debug("Check %s", image)
-
-                docker_image = self._select_registry_image(branch, image, current_branch_history)
-
-                if docker_image:
-                    revision = docker_image.revision
-                    if revision.endswith("-dirty"):
-                        self._logger.debug("Image %s is dirty", image)
+    def _find_retag(self, branch, image, current_tree) -> Optional[Retag]:
+        if not current_tree or not self.dockerhub_client.can_push:
+            return None
+        try:
+            published = self._find_published_tree(image, current_tree)
+        except Exception:
+            self._logger.exception("Failed to look up published %s images with tree %s", image, current_tree)
+            return None
+        if not published:
+            return None
+        source_tag, digest = published
+        tag = get_branch_tag(branch)
+        if source_tag == tag:
+            return None
+        return Retag(image, source_tag, digest, tag, current_tree)
+
+    def get_modified_images(self, ref, revision=None, fetch=True) -> Tuple[GitReference, List[str], List[Retag]]:
+        """Get images to build for the ref at the pushed revision (the head of the remote ref if it is not given).
+        Images whose images/<image> tree is already published under another tag are returned as retags instead,
+        which only copy the manifest in the registry.
+
+        The repository is never checked out, so several refs can be analysed at the same time once fetched.
+        """
+        check_pushed_ref(ref, revision)
+        if fetch:
+            self.update_ref(ref, revision)
+        git_ref = self._get_ref_details(ref, revision or ref.replace("refs/heads/", "refs/remotes/origin/"))
+        revision = git_ref.revision
+        branch = ref.replace("refs/heads/", "")
+        current_branch_history = self._get_current_branch_history(branch, revision)
+
+        images = sorted(self.get_image_catalog(revision))
+
+        latest_images = []
+        version_images = []
+        retags = []
+        for image in images:
+            self._logger.debug("Check %s", image)
+
+            current_tree = self._get_tree(revision, image)
+            docker_image = self._select_registry_image(branch, image, current_branch_history, current_tree)
+
+            if docker_image:
+                registry_revision = docker_image.revision
+                if registry_revision.endswith("-dirty"):
+                    self._logger.debug("Image %s is dirty", image)
+                    latest_images.append(f"{image}:latest")
+                else:
+                    if self._diff_image_with_revision(image, registry_revision, revision):
                         latest_images.append(f"{image}:latest")
                     else:
-                        if self._diff_image_with_revision(image, revision):
-                            latest_images.append(f"{image}:latest")
-                        else:
-                            self._logger.debug("Image %s is up-to-date (%s)", image, revision)
-                        if image == "utils":
-                            version_images = self._get_template_modified_images(docker_image)
-                else:
-                    self._logger.debug("Registry image not found")
-                    latest_images.append(f"{image}:latest")
-
-            result = latest_images + version_images
-
-            if len(result) > 0:
-                self._logger.debug("Images to build: %s", ", ".join(result))
+                        self._logger.debug("Image %s is up-to-date (%s)", image, registry_revision)
+                    if image == "utils":
+                        version_images = self._get_template_modified_images(docker_image, revision)
             else:
-                self._logger.debug("No images need to build")
+                self._logger.debug("Registry image not found")
+                latest_images.append(f"{image}:latest")
+
+        for image_tag in list(latest_images):
+            image = image_tag.split(":")[0]
+            current_tree = self._get_tree(revision, image)
+            retag = self._find_retag(branch, image, current_tree)
+            if retag:
+                self._logger.debug("Image %s tree %s is published as %s:%s", image, current_tree, image,
+                                   retag.source_tag)
+                latest_images.remove(image_tag)
+                retags.append(retag)
+
+        retagged = {f"{retag.image}:latest" for retag in retags}
+        result = latest_images + [image for image in version_images if image not in retagged]
+
+        if len(result) > 0:
+            self._logger.debug("Images to build: %s", ", ".join(result))
+        else:
+            self._logger.debug("No images need to build")
 
-            result = set(result)
-            result = sorted(result)
-            result = list(result)
+        result = set(result)
+        result = sorted(result)
+        result = list(result)
 
-            return git_ref, result
+        return git_ref, result, retags